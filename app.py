@@ -1,10 +1,22 @@
+import asyncio
 import json
+from src.constants import ConfigKeys
 from src.discordrpc import DiscordRPC
 
 with open('config.json', mode='rt', encoding='utf-8') as f:
-    app = DiscordRPC(json.load(f))
-
-app.start()
-app.loop()
-app.close()
+    config = json.load(f)
 
+if ConfigKeys.Clients in config:
+    from src.presence_pool import PresencePool
+    app = PresencePool(config)
+    app.start()
+    app.loop()
+    app.close()
+elif config.get(ConfigKeys.Async, False):
+    from src.async_discordrpc import AsyncDiscordRPC
+    asyncio.run(AsyncDiscordRPC(config).run())
+else:
+    app = DiscordRPC(config)
+    app.start()
+    app.loop()
+    app.close()
@@ -0,0 +1,129 @@
+"""
+End-to-end benchmark of DiscordRPC against FakeDiscordServer, using the real pypresence client.
+
+Measures time from DiscordRPC.start() to the first SET_ACTIVITY received by the server,
+and latency from reloadProfile() to the server receiving the activity, under sustained load.
+
+Usage:
+    python -m benchmarks.e2e [--updates 1000] [--rate 0] [--delay 0] [--rate-limit 5/20] [--drop-after N]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter, sleep
+from typing import List, Optional
+
+from benchmarks.fake_discord import FakeDiscordServer
+from benchmarks.run import gitRevision, percentile
+from benchmarks.stubs import benchRPC, quiet
+from src.discordrpc import DiscordRPC
+from src.type_hints import JSON
+
+
+def summarize(samples: List[float]) -> JSON:
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_s': sum(samples) / len(samples),
+        'p50_s': percentile(samples, 50),
+        'p95_s': percentile(samples, 95),
+        'p99_s': percentile(samples, 99),
+        'max_s': max(samples)
+    }
+
+
+def run(
+        updates: int,
+        rate: float,
+        delay: float,
+        rateLimit: Optional[str],
+        dropAfter: Optional[int],
+        clientRateLimit: bool
+) -> JSON:
+    limit = None
+    if rateLimit:
+        count, period = rateLimit.split('/')
+        limit = (int(count), float(period))
+    # Keep fake server away from a real discord client, by pointing pypresence to a private directory.
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['XDG_RUNTIME_DIR'] = directory
+        with FakeDiscordServer(delay=delay, rateLimit=limit, dropAfter=dropAfter) as server, \
+                benchRPC(10, rpcClass=DiscordRPC, rateLimit=clientRateLimit) as rpc:
+            started = perf_counter()
+            with quiet():
+                rpc.start()
+            first = server.firstActivityAfter(started)
+            startup = None if first is None else first.timestamp - started
+
+            latencies: List[float] = []
+            roundTrips: List[float] = []
+            errors = 0
+            interval = 1 / rate if rate > 0 else 0
+            for _ in range(updates):
+                received = len(server.activities)
+                begin = perf_counter()
+                try:
+                    rpc.reloadProfile()
+                    for task in rpc.scheduler.due():    # Reconnection attempts, as the client loop does.
+                        task.callback()
+                except Exception:
+                    errors += 1
+                end = perf_counter()
+                roundTrips.append(end - begin)
+                if len(server.activities) > received:
+                    latencies.append(server.activities[-1].timestamp - begin)
+                if interval:
+                    sleep(max(0.0, interval - (end - begin)))
+            try:
+                with quiet():
+                    rpc.close()
+            except Exception:
+                pass
+
+    return {
+        'meta': {'revision': gitRevision(), 'python': sys.version},
+        'parameters': {
+            'updates': updates, 'rate': rate, 'delay': delay, 'rate_limit': rateLimit, 'drop_after': dropAfter,
+            'client_rate_limit': clientRateLimit
+        },
+        'start_to_first_activity_s': startup,
+        'update_latency': summarize(latencies),
+        'reload_round_trip': summarize(roundTrips),
+        'sent': rpc.updateStats.toJson(),
+        'reconnects': rpc.connection.reconnects,
+        'server': {
+            'frames': len(server.frames),
+            'activities': len(server.activities),
+            'rate_limited': server.rateLimited,
+            'dropped': server.dropped,
+            'connections': server.connections
+        },
+        'client_errors': errors
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='PyroRPC end-to-end benchmark against fake discord IPC server')
+    parser.add_argument('--updates', type=int, default=1000, help='number of reloadProfile() calls')
+    parser.add_argument('--rate', type=float, default=0, help='reloads per second. 0 is as fast as possible')
+    parser.add_argument('--delay', type=float, default=0, help='seconds server waits before each response')
+    parser.add_argument('--rate-limit', help='server side rate limit of SET_ACTIVITY, like 5/20')
+    parser.add_argument('--drop-after', type=int, help='server drops connection after this many frames')
+    parser.add_argument('--client-rate-limit', action='store_true', help="keep client's own rate limiter")
+    parser.add_argument('--output', default='e2e_results.json')
+    args = parser.parse_args(argv)
+
+    result = run(args.updates, args.rate, args.delay, args.rate_limit, args.drop_after, args.client_rate_limit)
+    with open(args.output, mode='wt', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Stand-in for Discord client, speaking Discord IPC on a unix socket at `discord-ipc-N`, where pypresence looks for it.
+Used to measure end-to-end latency of presence updates without running Discord.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+from collections import deque
+from time import perf_counter
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from src.type_hints import JSON
+
+# Discord IPC opcodes
+OP_HANDSHAKE = 0
+OP_FRAME = 1
+OP_CLOSE = 2
+OP_PING = 3
+OP_PONG = 4
+
+_HEADER = struct.Struct('<II')
+
+
+def ipcDirectory() -> str:
+    """Directory where pypresence looks for discord-ipc-N sockets."""
+    return os.environ.get('XDG_RUNTIME_DIR') or (
+        f'/run/user/{os.getuid()}' if os.path.exists(f'/run/user/{os.getuid()}') else tempfile.gettempdir()
+    )
+
+
+class FrameRecord:
+    """A frame received by FakeDiscordServer."""
+    __slots__ = ('timestamp', 'connection', 'op', 'payload')
+
+    def __init__(self, timestamp: float, connection: int, op: int, payload: JSON) -> None:
+        self.timestamp: float = timestamp      # time.perf_counter() when the frame is received.
+        self.connection: int = connection
+        self.op: int = op
+        self.payload: JSON = payload
+
+    @property
+    def command(self) -> Optional[str]:
+        return self.payload.get('cmd')
+
+    def __repr__(self) -> str:
+        return f'FrameRecord(op={self.op}, cmd={self.command}, connection={self.connection})'
+
+
+class FakeDiscordServer:
+    """
+    Fake Discord IPC server running on its own thread.
+
+    Supports handshake, SET_ACTIVITY, SUBSCRIBE (other commands are answered with empty data), ping and close.
+    Events can be sent to subscribed connections with dispatch().
+    Responses can be delayed, rate limited and connections can be dropped, to reproduce unhealthy Discord clients.
+    """
+
+    def __init__(
+            self,
+            pipe: int = 0,
+            directory: Optional[str] = None,
+            delay: float = 0.0,
+            rateLimit: Optional[Tuple[int, float]] = None,
+            dropAfter: Optional[int] = None,
+            dropProbability: float = 0.0,
+            seed: Optional[int] = None
+    ) -> None:
+        """
+        Initialize FakeDiscordServer.
+
+        Args:
+            pipe (int) : Number N of `discord-ipc-N` socket.
+            directory (Optional[str]) : Directory to create socket in. Same directory as pypresence uses if not given.
+            delay (float) : Seconds to wait before responding to each frame.
+            rateLimit (Optional[Tuple[int, float]]) : (count, seconds). SET_ACTIVITY over this limit gets an error.
+            dropAfter (Optional[int]) : Drop each connection after receiving this many frames.
+            dropProbability (float) : Probability of dropping connection instead of responding to a frame.
+            seed (Optional[int]) : Seed of random generator used for dropProbability.
+        """
+        self._path: str = os.path.join(ipcDirectory() if directory is None else directory, f'discord-ipc-{pipe}')
+        self.delay: float = delay
+        self.rateLimit: Optional[Tuple[int, float]] = rateLimit
+        self.dropAfter: Optional[int] = dropAfter
+        self.dropProbability: float = dropProbability
+        self._random = random.Random(seed)
+        self._activityTimes: Deque[float] = deque()
+        self._connections: int = 0
+        self._writers: Dict[int, asyncio.StreamWriter] = {}
+        self.subscriptions: Dict[int, Set[str]] = {}     # Events subscribed by each open connection.
+        self.frames: List[FrameRecord] = []
+        self.activities: List[FrameRecord] = []
+        self.dropped: int = 0
+        self.rateLimited: int = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def connections(self) -> int:
+        return self._connections
+
+    def reset(self) -> None:
+        """Forget recorded frames."""
+        self.frames.clear()
+        self.activities.clear()
+        self.dropped = self.rateLimited = 0
+
+    def dispatch(self, event: str, data: Optional[JSON] = None) -> int:
+        """
+        Send event to every connection subscribed to it. Can be called from any thread.
+
+        Returns:
+            Number of connections the event is sent to.
+        """
+        async def send() -> int:
+            sent = 0
+            for connection, writer in tuple(self._writers.items()):
+                if event in self.subscriptions.get(connection, ()):
+                    self._write(writer, OP_FRAME, {'cmd': 'DISPATCH', 'evt': event, 'data': data or {}, 'nonce': None})
+                    await writer.drain()
+                    sent += 1
+            return sent
+        return asyncio.run_coroutine_threadsafe(send(), self._loop).result()
+
+    def firstActivityAfter(self, timestamp: float) -> Optional[FrameRecord]:
+        for record in self.activities:
+            if record.timestamp >= timestamp:
+                return record
+        return None
+
+    # Lifecycle
+
+    def start(self) -> FakeDiscordServer:
+        if sys.platform == 'win32':
+            raise NotImplementedError('FakeDiscordServer only supports unix sockets.')
+        self._thread = threading.Thread(target=self._run, name='fake-discord', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def __enter__(self) -> FakeDiscordServer:
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        self._loop = loop = asyncio.new_event_loop()
+        try:
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+            self._server = loop.run_until_complete(asyncio.start_unix_server(self._handle, path=self._path))
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            self._server.close()
+            for task in asyncio.all_tasks(loop):
+                task.cancel()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    # Protocol
+
+    @staticmethod
+    def _write(writer: asyncio.StreamWriter, op: int, payload: JSON) -> None:
+        data = json.dumps(payload).encode('utf-8')
+        writer.write(_HEADER.pack(op, len(data)) + data)
+
+    def _isRateLimited(self, now: float) -> bool:
+        if self.rateLimit is None:
+            return False
+        count, period = self.rateLimit
+        while self._activityTimes and now - self._activityTimes[0] > period:
+            self._activityTimes.popleft()
+        if len(self._activityTimes) >= count:
+            return True
+        self._activityTimes.append(now)
+        return False
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections += 1
+        connection = self._connections
+        received = 0
+        self._writers[connection] = writer
+        self.subscriptions[connection] = set()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_HEADER.size)
+                    op, length = _HEADER.unpack(header)
+                    payload = json.loads(await reader.readexactly(length))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                record = FrameRecord(perf_counter(), connection, op, payload)
+                self.frames.append(record)
+                received += 1
+                if op == OP_CLOSE:
+                    return
+                if (self.dropAfter is not None and received > self.dropAfter) or \
+                        (self.dropProbability and self._random.random() < self.dropProbability):
+                    self.dropped += 1
+                    return
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                if op == OP_HANDSHAKE:
+                    self._write(writer, OP_FRAME, {
+                        'cmd': 'DISPATCH',
+                        'evt': 'READY',
+                        'data': {
+                            'v': 1,
+                            'config': {'cdn_host': 'cdn.discordapp.com', 'api_endpoint': '//discord.com/api'},
+                            'user': {'id': '0', 'username': 'fake', 'discriminator': '0000'}
+                        },
+                        'nonce': None
+                    })
+                elif op == OP_PING:
+                    self._write(writer, OP_PONG, payload)
+                elif payload.get('cmd') == 'SUBSCRIBE':
+                    self.subscriptions[connection].add(payload.get('evt'))
+                    self._write(writer, OP_FRAME, {
+                        'cmd': 'SUBSCRIBE', 'evt': None, 'data': {'evt': payload.get('evt')}, 'nonce': payload.get('nonce')
+                    })
+                elif payload.get('cmd') == 'SET_ACTIVITY':
+                    if self._isRateLimited(record.timestamp):
+                        self.rateLimited += 1
+                        self._write(writer, OP_FRAME, {
+                            'cmd': 'SET_ACTIVITY',
+                            'evt': 'ERROR',
+                            'data': {'code': 5000, 'message': 'You are being rate limited.'},
+                            'nonce': payload.get('nonce')
+                        })
+                    else:
+                        self.activities.append(record)
+                        self._write(writer, OP_FRAME, {
+                            'cmd': 'SET_ACTIVITY',
+                            'evt': None,
+                            'data': payload.get('args', {}).get('activity'),
+                            'nonce': payload.get('nonce')
+                        })
+                else:
+                    self._write(writer, OP_FRAME, {
+                        'cmd': payload.get('cmd'), 'evt': None, 'data': {}, 'nonce': payload.get('nonce')
+                    })
+                await writer.drain()
+        finally:
+            del self._writers[connection], self.subscriptions[connection]
+            writer.close()
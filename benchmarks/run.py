@@ -0,0 +1,261 @@
+"""
+Benchmarks of profile, script and update hot paths. Discord is not needed.
+
+Usage:
+    python -m benchmarks.run [--sizes 10 100 1000 10000] [--only NAME ...] [--output FILE] [--compare FILE]
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from benchmarks.stubs import benchRPC, makeEngine, makeProfileJson, quiet
+from src.constants import ProfileKeys
+from src.discordrpc import Profile
+from src.profile_store import ProfileStore
+from src.snapshot import ProfileSnapshot
+from src.script_support import ScriptEvent
+from src.type_hints import JSON
+
+# name : function taking size n, and yielding a callable running one iteration over n items.
+Benchmark = Callable[[int], Iterator[Callable[[], None]]]
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+
+def benchmark(func: Benchmark) -> Benchmark:
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+@benchmark
+def profile_fromJson(n: int):
+    data = [makeProfileJson(index) for index in range(n)]
+    yield lambda: [Profile.fromJson(raw) for raw in data]
+
+
+@benchmark
+def profile_toJson(n: int):
+    profiles = [Profile.fromJson(makeProfileJson(index)) for index in range(n)]
+    yield lambda: [profile.toJson() for profile in profiles]
+
+
+@benchmark
+def profile_toJson_changed(n: int):
+    profiles = [Profile.fromJson(makeProfileJson(index)) for index in range(n)]
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        for profile in profiles:
+            profile.setVariables(cpu=counter[0])
+            profile.toJson()
+    yield run
+
+
+@benchmark
+def parse_resource(n: int):
+    keys = [makeProfileJson(index)[ProfileKeys.LargeIcon] for index in range(n)]
+    yield lambda: [ProfileKeys.parseResource(key) for key in keys]
+
+
+@benchmark
+def store_fromJson(n: int):
+    data = {'format': '2021.02.dev', 'data': [makeProfileJson(index) for index in range(n)]}
+    yield lambda: ProfileStore.fromJson(data, Profile.fromJson)
+
+
+@benchmark
+def store_reload_unchanged(n: int):
+    data = {'format': '2021.02.dev', 'data': [makeProfileJson(index) for index in range(n)]}
+    store = ProfileStore.fromJson(data, Profile.fromJson)
+    yield lambda: ProfileStore.fromJson(data, Profile.fromJson, previous=store)
+
+
+def _writeProfiles(directory: str, n: int) -> str:
+    path = os.path.join(directory, 'profiles.json')
+    with open(path, mode='wt', encoding='utf-8') as f:
+        json.dump({'format': '2021.02.dev', 'data': [makeProfileJson(index) for index in range(n)]}, f)
+    mtime = os.stat(path).st_mtime - 60     # Older than the racy window of snapshots.
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@benchmark
+def store_load(n: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = _writeProfiles(directory, n)
+        yield lambda: ProfileStore.load(path, Profile.fromJson)
+
+
+@benchmark
+def store_load_snapshot(n: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = _writeProfiles(directory, n)
+        snapshot = ProfileSnapshot(f'{path}.snapshot')
+        ProfileStore.load(path, Profile.fromJson, snapshot=snapshot)
+        yield lambda: ProfileStore.load(path, Profile.fromJson, snapshot=snapshot)
+
+
+@benchmark
+def store_find(n: int):
+    store = ProfileStore.fromJson(
+        {'format': '2021.02.dev', 'data': [makeProfileJson(index) for index in range(n)]}, Profile.fromJson
+    )
+    keys = [f'profile-{index}' if index % 2 else f'Profile #{index}' for index in range(n)]
+    yield lambda: [store.find(key) for key in keys]
+
+
+@benchmark
+def engine_construct(n: int):
+    yield lambda: makeEngine(n)
+
+
+@benchmark
+def engine_emit_global(n: int):
+    engine, _ = makeEngine(n)
+    yield lambda: engine.emit(ScriptEvent.OnStart)
+
+
+@benchmark
+def engine_emit_profile(n: int):
+    engine, _ = makeEngine(n)
+    profiles = [Profile.fromJson(makeProfileJson(index, f'bench.Script{index}')) for index in range(n)]
+    yield lambda: [engine.emit(ScriptEvent.OnReload, profile) for profile in profiles]
+
+
+@benchmark
+def rpc_reloadProfile(n: int):
+    with benchRPC(n, scripts=max(1, n // 10)) as rpc:
+        with quiet():
+            rpc.updateProfile(rpc.profiles[0])
+        yield lambda: [rpc.reloadProfile() for _ in range(n)]
+
+
+@benchmark
+def rpc_updateProfile(n: int):
+    with benchRPC(n, scripts=max(1, n // 10)) as rpc:
+        profiles = rpc.profiles
+
+        def run():
+            for profile in profiles:
+                rpc.updateProfile(profile)
+        with quiet():
+            run()   # Import scripts and bind them before measuring.
+        yield run
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(run: Callable[[], None], n: int, budget: float, minIterations: int) -> JSON:
+    run()   # Warm up
+    samples: List[float] = []
+    started = perf_counter()
+    gc.collect()
+    while len(samples) < minIterations or perf_counter() - started < budget:
+        begin = perf_counter()
+        run()
+        samples.append(perf_counter() - begin)
+
+    # Allocations are measured separately, since tracemalloc slows everything down.
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    run()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = sum(samples) / len(samples)
+    return {
+        'n': n,
+        'iterations': len(samples),
+        'mean_s': mean,
+        'p50_s': percentile(samples, 50),
+        'p95_s': percentile(samples, 95),
+        'p99_s': percentile(samples, 99),
+        'items_per_s': n / mean if mean else None,
+        'alloc_peak_bytes': peak - before,
+        'alloc_retained_bytes': after - before,
+        'alloc_peak_bytes_per_item': (peak - before) / n
+    }
+
+
+def gitRevision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[JSON], baseline: JSON) -> None:
+    previous: Dict[Tuple[str, int], JSON] = {(r['name'], r['n']): r for r in baseline['results']}
+    print(f'\nCompared with {baseline["meta"].get("revision")} ({baseline["meta"].get("timestamp")}) :')
+    for result in results:
+        old = previous.get((result['name'], result['n']))
+        if old is None:
+            continue
+        ratio = result['p50_s'] / old['p50_s'] if old['p50_s'] else float('nan')
+        print(f'{result["name"]:<24} n={result["n"]:<6} p50 x{ratio:.2f}  '
+              f'alloc {old["alloc_peak_bytes"]} -> {result["alloc_peak_bytes"]} bytes')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='PyroRPC benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--budget', type=float, default=0.5, help='seconds to spend on each case')
+    parser.add_argument('--min-iterations', type=int, default=5)
+    parser.add_argument('--output', default='bench_results.json', help='file to write results as json')
+    parser.add_argument('--compare', help='results file of previous run to compare with')
+    args = parser.parse_args(argv)
+
+    results: List[JSON] = []
+    print(f'{"benchmark":<24} {"n":>6} {"items/s":>12} {"p50":>10} {"p95":>10} {"p99":>10} {"peak alloc/item":>16}')
+    for name in args.only or BENCHMARKS:
+        for n in args.sizes:
+            setup = BENCHMARKS[name](n)
+            run = next(setup)
+            result = measure(run, n, args.budget, args.min_iterations)
+            setup.close()
+            result['name'] = name
+            results.append(result)
+            print(f'{name:<24} {n:>6} {result["items_per_s"]:>12.0f} {result["p50_s"] * 1e3:>8.3f}ms '
+                  f'{result["p95_s"] * 1e3:>8.3f}ms {result["p99_s"] * 1e3:>8.3f}ms '
+                  f'{result["alloc_peak_bytes_per_item"]:>14.0f}B')
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': gitRevision(),
+            'python': sys.version,
+            'platform': platform.platform()
+        },
+        'results': results
+    }
+    with open(args.output, mode='wt', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nResults are written to {args.output}')
+    if args.compare:
+        with open(args.compare, mode='rt', encoding='utf-8') as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
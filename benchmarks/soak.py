@@ -0,0 +1,235 @@
+"""
+Soak test of DiscordRPC, driving the client loop for simulated days on a virtual clock.
+
+Nothing sleeps: the loop jumps straight to its next due task, so days of reloads, profile switches, button clicks,
+profile file reloads and dropped connections run in seconds against a stub presence client.
+Allocations are tracked with tracemalloc and update latency is measured for each part of the run,
+and the run fails if memory keeps growing or latency drifts after warm-up.
+
+Usage:
+    python -m benchmarks.soak [--days 7] [--interval 15] [--max-growth 262144] [--max-drift 1.5]
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import logging
+import random
+import sys
+import tracemalloc
+from functools import partial
+from time import perf_counter
+from typing import List, Optional
+
+from pypresence.exceptions import PipeClosed
+
+from benchmarks.run import gitRevision, percentile
+from benchmarks.stubs import BenchRPC, StubPresence, benchRPC, quiet
+from src.constants import ConfigKeys, IpcEvents
+from src.discordrpc import setupLogger
+from src.scheduler import Scheduler
+from src.system_metrics import MetricsSampler
+from src.type_hints import JSON
+
+_DaySeconds: float = 24 * 60 * 60
+
+
+class VirtualClock:
+    """Monotonic clock moved forward by the harness instead of by real time."""
+
+    def __init__(self, start: float = 0.0) -> None:
+        self._now: float = start
+
+    def __call__(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float) -> None:
+        self._now += max(0.0, seconds)
+
+
+class FlakyPresence(StubPresence):
+    """StubPresence whose connection can be broken, like discord being restarted."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.broken: bool = False
+
+    def update(self, **payload) -> JSON:
+        if self.broken:
+            raise PipeClosed
+        return super().update(**payload)
+
+
+class SoakRPC(BenchRPC):
+    """
+    BenchRPC on a virtual clock. Waiting for the next task moves the clock instead of sleeping.
+    The clock is given to the scheduler, which shares it with the update pipeline and the script engine.
+    """
+
+    def __init__(self, config: JSON, metrics: Optional[MetricsSampler] = None, clock: VirtualClock = None) -> None:
+        self.clock: VirtualClock = VirtualClock() if clock is None else clock
+        super().__init__(config, metrics)
+
+    def _createClient(self) -> FlakyPresence:
+        return FlakyPresence()
+
+    def _createScheduler(self) -> Scheduler:
+        return Scheduler(clock=self.clock, wakeup=self._wake)
+
+    def _wait(self, timeout: Optional[float]) -> None:
+        if self._wakeup.is_set():
+            self._wakeup.clear()
+        else:
+            self.clock.advance(1.0 if timeout is None else timeout)
+
+    def dropConnection(self) -> None:
+        client = self._connection.client
+        if client is not None:
+            client.broken = True
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    """Allocations of the client, leaving out the ones of this harness and tracemalloc."""
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__)
+    ))
+
+
+def _size(snapshot: tracemalloc.Snapshot) -> int:
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+
+def run(
+        days: float,
+        interval: float,
+        profiles: int,
+        scripts: int,
+        switchEvery: float,
+        clickEvery: float,
+        reloadEvery: float,
+        dropEvery: float,
+        windows: int,
+        maxGrowth: int,
+        maxDrift: float
+) -> JSON:
+    """
+    Run the client for `days` simulated days, split into `windows` parts. The first part is warm-up,
+    and memory and latency of the last part are compared with the part right after warm-up.
+    """
+    logger = setupLogger()
+    clock = VirtualClock()
+    tracemalloc.start()
+    soakRPC = partial(SoakRPC, clock=clock)
+    with benchRPC(profiles, scripts, rpcClass=soakRPC, rateLimit=True, config={ConfigKeys.Interval: interval}) as rpc:
+        rpc.logger.setLevel(logging.ERROR)     # Connections are lost on purpose.
+        with quiet():
+            rpc.start()
+        keys = [profile.id for profile in rpc.profiles]
+        rng = random.Random(0)
+        scheduler = rpc.scheduler
+        scheduler.every(switchEvery, lambda: rpc.switchProfile(rng.choice(keys)), 'soak-switch')
+        scheduler.every(clickEvery, lambda: rpc._onDiscordEvent(IpcEvents.ActivityJoin, {}), 'soak-click')
+        scheduler.every(reloadEvery, lambda: rpc._onFileChanged(rpc._profilesPath), 'soak-profiles')
+        scheduler.every(dropEvery, rpc.dropConnection, 'soak-drop')
+
+        windowLength = days * _DaySeconds / windows
+        parts: List[JSON] = []
+        snapshots: List[tracemalloc.Snapshot] = []
+        started = perf_counter()
+        for window in range(windows):
+            end = clock() + windowLength
+            latencies: List[float] = []
+            while clock() < end:
+                client = rpc.connection.client
+                sent = 0 if client is None else client.updates
+                begin = perf_counter()
+                rpc.runOnce()
+                elapsed = perf_counter() - begin
+                if rpc.connection.client is client and client is not None and client.updates > sent:
+                    latencies.append(elapsed)
+            snapshots = [*snapshots[:1], _snapshot()] if window else []
+            parts.append({
+                'day': clock() / _DaySeconds,
+                'memory_bytes': _size(snapshots[-1]) if snapshots else None,
+                'updates': len(latencies),
+                'p50_s': percentile(latencies, 50) if latencies else None,
+                'p95_s': percentile(latencies, 95) if latencies else None,
+                'scheduled_tasks': len(scheduler),
+                'wakeups': rpc.wakeups
+            })
+            del latencies
+        wallTime = perf_counter() - started
+        with quiet():
+            rpc.close()
+    tracemalloc.stop()
+    # Clients made later must not add their own console handler to the shared logger.
+    with benchRPC(1, rpcClass=soakRPC, rateLimit=True) as other, quiet():
+        other.close()
+    handlers = len(logger.handlers)
+
+    baseline, last = parts[min(1, windows - 1)], parts[-1]
+    growth = 0 if len(snapshots) < 2 else last['memory_bytes'] - baseline['memory_bytes']
+    drift = None
+    if baseline['p50_s'] and last['p50_s']:
+        drift = last['p50_s'] / baseline['p50_s']
+    failures: List[str] = []
+    growers: List[str] = []
+    if growth > maxGrowth:
+        failures.append(f'memory grew {growth} bytes after warm-up (limit {maxGrowth})')
+        growers = [str(stat) for stat in snapshots[-1].compare_to(snapshots[0], 'lineno')[:10]]
+    if drift is not None and drift > maxDrift:
+        failures.append(f'p50 update latency drifted x{drift:.2f} after warm-up (limit x{maxDrift})')
+    if last['scheduled_tasks'] > baseline['scheduled_tasks']:
+        failures.append(f'scheduled tasks grew from {baseline["scheduled_tasks"]} to {last["scheduled_tasks"]}')
+    if handlers != 1:
+        failures.append(f'pyrorpc logger has {handlers} handlers after making 2 clients, instead of 1')
+
+    return {
+        'meta': {'revision': gitRevision(), 'python': sys.version},
+        'parameters': {
+            'days': days, 'interval': interval, 'profiles': profiles, 'scripts': scripts,
+            'switch_every': switchEvery, 'click_every': clickEvery, 'reload_every': reloadEvery,
+            'drop_every': dropEvery, 'windows': windows, 'max_growth': maxGrowth, 'max_drift': maxDrift
+        },
+        'wall_time_s': wallTime,
+        'sent': rpc.updateStats.toJson(),
+        'reconnects': rpc.connection.reconnects,
+        'memory_growth_bytes': growth,
+        'memory_growth_top': growers,
+        'latency_drift': drift,
+        'windows': parts,
+        'failures': failures
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='PyroRPC soak test on a virtual clock')
+    parser.add_argument('--days', type=float, default=7, help='simulated days to run')
+    parser.add_argument('--interval', type=float, default=15, help='seconds between profile reloads')
+    parser.add_argument('--profiles', type=int, default=20)
+    parser.add_argument('--scripts', type=int, default=4)
+    parser.add_argument('--switch-every', type=float, default=600, help='seconds between profile switches')
+    parser.add_argument('--click-every', type=float, default=300, help='seconds between button clicks')
+    parser.add_argument('--reload-every', type=float, default=3600, help='seconds between profile file reloads')
+    parser.add_argument('--drop-every', type=float, default=6 * 3600, help='seconds between lost connections')
+    parser.add_argument('--windows', type=int, default=10, help='parts of the run to measure, first is warm-up')
+    parser.add_argument('--max-growth', type=int, default=256 * 1024, help='bytes memory may grow after warm-up')
+    parser.add_argument('--max-drift', type=float, default=1.5, help='ratio p50 latency may grow after warm-up')
+    parser.add_argument('--output', default='soak_results.json')
+    args = parser.parse_args(argv)
+
+    result = run(
+        args.days, args.interval, args.profiles, args.scripts, args.switch_every, args.click_every,
+        args.reload_every, args.drop_every, args.windows, args.max_growth, args.max_drift
+    )
+    with open(args.output, mode='wt', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
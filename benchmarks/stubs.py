@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+from src.constants import ConfigKeys, Resources
+from src.discordrpc import DiscordRPC
+from src.script_support import Script, ScriptEngine
+from src.system_metrics import MetricsSampler
+from src.type_hints import JSON
+from src.update_pipeline import TokenBucket, UpdatePipeline
+
+BENCH_MODULE = 'bench'     # filename used to register generated scripts
+
+
+class StubPresence:
+    """Stand-in for pypresence.Presence, which records payloads instead of sending them."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.updates: int = 0
+        self.last: Optional[JSON] = None
+
+    def connect(self) -> None:
+        pass
+
+    def update(self, **payload) -> JSON:
+        self.updates += 1
+        self.last = payload
+        return {'cmd': 'SET_ACTIVITY', 'evt': None, 'data': payload}
+
+    def close(self) -> None:
+        pass
+
+
+class BenchRPC(DiscordRPC):
+    """DiscordRPC using StubPresence, without file watching, metrics sampling and rate limit."""
+
+    def _createClient(self) -> StubPresence:
+        return StubPresence()
+
+
+def _unlimitedPipeline(self: DiscordRPC) -> UpdatePipeline:
+    # Measure the update path itself, not the rate limiter holding payloads back.
+    return UpdatePipeline(TokenBucket(capacity=1 << 62, period=1, clock=self._scheduler.clock))
+
+
+def unlimited(rpcClass: Type[DiscordRPC]) -> Type[DiscordRPC]:
+    """Subclass of rpcClass whose update pipeline is never rate limited."""
+    return type(rpcClass.__name__, (rpcClass,), {'_createPipeline': _unlimitedPipeline})
+
+
+def quiet():
+    """Silence debug prints of ScriptEngine and DiscordRPC."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def makeProfileJson(index: int, scriptName: str = f'{BENCH_MODULE}.Script0') -> JSON:
+    resources = [resource.value for resource in Resources]
+    return {
+        'id': f'profile-{index}',
+        'name': f'Profile #{index}',
+        'tags': [f'group-{index % 10}'],
+        'enabled': True,
+        'details': f'Benchmark profile #{index}, cpu={{cpu}}%',
+        'state': 'ram={ram}%',
+        'large_image': f'client.{resources[index % len(resources)]}',
+        'large_text': f'Large text #{index}',
+        'small_image': 'client.profile',
+        'small_text': 'Made by benchmark',
+        'buttons': [
+            {'label': 'Button {cpu}', 'url': 'https://example.com', 'script': scriptName},
+            {'label': 'Repository', 'url': 'https://example.com/repo', 'script': scriptName}
+        ],
+        'script': scriptName
+    }
+
+
+def makeScriptClasses(count: int) -> List[Type[Script]]:
+    """
+    Generate and register script classes. Each class overrides onReload and onLoad, and sets template variables.
+    Previously generated classes are removed from ScriptEngine registry.
+    """
+    registered: Dict[str, Dict[str, type]] = getattr(ScriptEngine, '__scripts__', None) or {}
+    setattr(ScriptEngine, '__scripts__', registered)
+    registered.pop(BENCH_MODULE, None)
+    classes = []
+
+    def onLoad(self, profile) -> None:
+        profile.setVariables(cpu=self.value, ram=self.value)
+
+    def onReload(self, profile) -> None:
+        self.value += 1
+        profile.setVariables(cpu=self.value, ram=self.value)
+
+    def onStart(self) -> None:
+        self.value = 0
+
+    for index in range(count):
+        cls = type(f'Script{index}', (Script,), {
+            'value': 0,
+            'onLoad': onLoad,
+            'onReload': onReload,
+            'onStart': onStart,
+            '__module__': f'scripts.{BENCH_MODULE}'
+        })
+        with quiet():
+            ScriptEngine.register(cls, BENCH_MODULE)
+        classes.append(cls)
+    return classes
+
+
+class FakeScriptsPackage:
+    """Stand-in for `scripts` package passed to ScriptEngine."""
+    __name__ = 'scripts'
+    __file__ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', '__init__.py')
+
+
+@contextlib.contextmanager
+def benchRPC(
+        profiles: int,
+        scripts: int = 1,
+        rpcClass: Type[DiscordRPC] = BenchRPC,
+        rateLimit: bool = False,
+        config: Optional[JSON] = None
+) -> Iterator[DiscordRPC]:
+    """
+    Create BenchRPC with generated profiles.json and scripts.
+
+    Args:
+        profiles (int) : Number of profiles.
+        scripts (int) : Number of scripts. Profiles are assigned to scripts in round robin.
+        rpcClass (Type[DiscordRPC]) : Class of client to create. DiscordRPC uses real pypresence client.
+        rateLimit (bool) : Keep the rate limit of update pipeline. Without it, rpcClass must be a class to subclass.
+        config (Optional[Dict[str, Any]]) : Other keys of config.json, like `interval`.
+    """
+    makeScriptClasses(scripts)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'profiles.json')
+        with open(path, mode='wt', encoding='utf-8') as f:
+            json.dump({
+                ConfigKeys.Format: '2021.02.dev',
+                ConfigKeys.Data: [
+                    makeProfileJson(index, f'{BENCH_MODULE}.Script{index % scripts}') for index in range(profiles)
+                ]
+            }, f)
+        config = {
+            ConfigKeys.Version: '2021.02',
+            ConfigKeys.ClientID: '0',
+            ConfigKeys.Profiles: path,
+            ConfigKeys.Watch: False,
+            **(config or {})
+        }
+        if not rateLimit:
+            rpcClass = unlimited(rpcClass)
+        with quiet():
+            rpc = rpcClass(config, metrics=MetricsSampler(defaults=False))
+        rpc.logger.setLevel(logging.WARNING)
+        yield rpc
+
+
+def makeEngine(scripts: int) -> Tuple[ScriptEngine, Any]:
+    makeScriptClasses(scripts)
+    with quiet():
+        engine = ScriptEngine(_LoggerClient(), FakeScriptsPackage)
+    return engine, engine.client
+
+
+class _LoggerClient:
+    logger = logging.getLogger('pyrorpc.bench')
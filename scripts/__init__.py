@@ -1,2 +1 @@
-from . import sample
-from . import *
+# Script modules are imported by ScriptEngine when a profile using them is activated.
@@ -1,8 +1,9 @@
-from typing import Tuple
+from src.script_support import Script, ScriptEngine, ScriptEvent, provide, subscribe
 
-import psutil
 
-from src.script_support import Script, ScriptEngine
+@ScriptEngine.event
+def OnCalled(self, *args, **kwargs) -> None:
+    """Custom event, emitted by other scripts with `self.client.scriptEngine.emit('onCalled', ...)`."""
 
 
 @ScriptEngine.register
@@ -44,16 +45,29 @@ class ButtonTest(Script):
     def onClick(self, profile, button) -> None:
         pass
 
+    @subscribe(ScriptEvent.OnConnectionChange, batch=5)
+    def onConnectionChanges(self, events) -> None:
+        # Flapping connection is reported once per 5 seconds.
+        self.client.logger.info(f'Script > sample.ButtonTest > connection is now {events[-1].args[0].value}')
+
 
 @ScriptEngine.register
 class HWStatus(Script):
     def __init__(self, client):
         super().__init__(client)
 
-    def getHWStatus(self) -> Tuple[float, float]:
-        cpu = round(psutil.cpu_percent())
-        ram = round(psutil.virtual_memory().percent, 1)
-        return cpu, ram
+    # Template variables `{cpu}` and `{ram}`, computed at most once per 5 seconds for every profile using them.
+    @provide(ttl=5)
+    def cpu(self) -> int:
+        return round(self.client.metrics.average('cpu'))
+
+    @provide(ttl=5)
+    def ram(self) -> float:
+        return round(self.client.metrics.latest('ram'), 1)
+
+    @provide(depends=('cpu', 'ram'))
+    def load(self, cpu: int, ram: float) -> str:
+        return 'busy' if cpu > 80 or ram > 80 else 'idle'
 
     def onStart(self) -> None:
         print('Hello world from Script[HWStatus]!')
@@ -63,20 +77,14 @@ class HWStatus(Script):
         pass
 
     def onLoad(self, profile) -> None:
-        cpu, ram = self.getHWStatus()
-        profile.state = profile.state.format(cpu=cpu, ram=ram)
+        pass
 
     def onUnload(self, profile) -> None:
         pass
 
     def onReload(self, profile) -> None:
-        cpu, ram = self.getHWStatus()
-        # TODO : state가 초기에 값이 바뀐 이후로 foramt 문자열이 사라져 더이상 변경이 불가함. 문제 해결을 위한 대책 필요.
-        print(profile.state)    # TODO : Support wildcard values for profile objects : keep wildcard expression, but send formatted data.
-        text: str = profile.state.format(cpu=cpu, ram=ram)
-        print(f'text={text}')
-        profile.state = text
-        self.client.logger.info(f'Script > sample.HWStatus > cpu={cpu},ram={ram}')
+        variables = self.client.scriptEngine.variables
+        self.client.logger.info(f'Script > sample.HWStatus > cpu={variables.get("cpu")},ram={variables.get("ram")}')
 
     def onUpdate(self, profile) -> None:
         pass
@@ -6,6 +6,8 @@ from src.type_hints import JSON
 
 
 class JsonObject(metaclass=ABCMeta):
+    __slots__ = ()
+
     @classmethod
     @abstractmethod
     def fromJson(cls, data: JSON) -> JsonObject:
@@ -32,6 +34,7 @@ class JsonObject(metaclass=ABCMeta):
 
 
 class Scriptable(metaclass=ABCMeta):
+    __slots__ = ()
 
     def getScript(self):
         """
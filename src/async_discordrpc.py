@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+from time import perf_counter
+from typing import Optional
+
+from src.connection import AsyncConnectionManager, ConnectionState, SendResult
+from src.constants import ConfigKeys
+from src.discordrpc import DiscordRPC, Profile
+from src.ipc_events import AioEventPresence     # The asyncio version of EventPresence
+from src.script_support import ScriptEvent
+from src.system_metrics import MetricsSampler
+from src.type_hints import JSON
+
+
+class AsyncDiscordRPC(DiscordRPC):
+    """
+    asyncio based presence client.
+    Every method talking to discord or scripts is a coroutine, so this client can share an event loop with other
+    services. Blocking script hooks are run on the loop's executor, and coroutine hooks are awaited directly.
+    """
+
+    def __init__(
+            self,
+            config: JSON,
+            interval: Optional[float] = None,
+            timeout: float = 10,
+            metrics: Optional[MetricsSampler] = None
+    ) -> None:
+        """
+        Initialize AsyncDiscordRPC.
+
+        Args:
+            config (Dict[str, Any]) : Parsed config.json data.
+            interval (Optional[float]) : Seconds between profile reloads. `interval` of config.json is used if not given.
+            timeout (float) : Seconds to wait for discord to respond on each IPC call.
+            metrics (Optional[MetricsSampler]) : Metrics sampler to share. New one is created if not given.
+        """
+        self._timeout: float = timeout
+        super().__init__(config, metrics)
+        if interval is not None:
+            self._interval = interval
+        self._loopTask: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._asyncWakeup: Optional[asyncio.Event] = None
+
+    def _createClient(self) -> AioEventPresence:
+        # AioPresence binds itself to an event loop, so it is created on connection, where the running loop is known.
+        return AioEventPresence(
+            self._client_id, pipe=self._config.get(ConfigKeys.Pipe), loop=asyncio.get_running_loop(),
+            eventHandler=self._onDiscordEvent
+        )
+
+    def _createConnection(self) -> AsyncConnectionManager:
+        return AsyncConnectionManager(
+            self._createClient, self._scheduler, self.logger, self._onConnectionChanged,
+            onReplayed=self._onReplayed, timeout=self._timeout
+        )
+
+    def _onConnectionChanged(self, state: ConnectionState, previous: ConnectionState):
+        self.logger.info(f'Connection state : {previous.value} -> {state.value}')
+        self._followConnection()
+        return self._scriptEngine.emitAsync(ScriptEvent.OnConnectionChange, state, previous)
+
+    @property
+    def running(self) -> bool:
+        return self._loopTask is not None and not self._loopTask.done()
+
+    async def start(self) -> None:
+        self.logger.info('Starting presence client...')
+        self._loop = asyncio.get_running_loop()
+        self._asyncWakeup = asyncio.Event()
+        await self._connection.connect()
+        self._metrics.start()
+        if self._exporter is not None:
+            self._exporter.start()
+        if self._control is not None:
+            self._control.start()
+        if self._watcher is not None:
+            self._watcher.start()
+        if self._scriptWatcher is not None:
+            self._scriptWatcher.start()
+        await self._scriptEngine.emitAsync(ScriptEvent.OnStart)
+        if self._currentProfile is None:
+            await self.updateProfile(self._defaultProfile())
+        self.logger.info('Lapis0875@rpc > Started!')
+
+    async def _sendPayload(self, payload: Optional[JSON]) -> None:
+        if payload is None:
+            return
+        started = perf_counter()
+        try:
+            result = await self._connection.send(payload)
+        except Exception as e:
+            self._updateErrors += 1
+            self._pipeline.invalidate()
+            self.logger.error(f'Failed to update presence : {e!r}')
+            return
+        if result is SendResult.Delivered:
+            self._pipeline.delivered()
+            self._updateLatency.observe(perf_counter() - started)
+        else:
+            self._pipeline.queued()
+
+    async def _send(self, profile: Profile) -> bool:
+        if self._paused:
+            return False
+        self._provideVariables(profile)
+        suppressed = self._pipeline.stats.suppressed
+        await self._sendPayload(self._pipeline.submit(profile.toJson()))
+        return self._pipeline.stats.suppressed == suppressed
+
+    async def flush(self) -> None:
+        await self._sendPayload(self._pipeline.flush())
+
+    async def switchProfile(self, key: str) -> bool:
+        profile = self._store.find(key)
+        if profile is None or not self._canActivate(profile):
+            return False
+        await self.updateProfile(profile)
+        return True
+
+    async def updateProfile(self, profile: Profile):
+        if not self._canActivate(profile):
+            return
+        self.logger.info('Updating presence profile...')
+        if profile != self._currentProfile:
+            loaded = self._loadProfileScript(profile)
+            if loaded:
+                await self._scriptEngine.emitToAsync(loaded, ScriptEvent.OnStart)
+            if self._currentProfile is not None:
+                await self._scriptEngine.emitAsync(ScriptEvent.OnUnload, self._currentProfile)
+            await self._scriptEngine.emitAsync(ScriptEvent.OnLoad, profile)
+            self._currentProfile = profile
+            self._scheduleReload(profile)
+            self._scheduleRotation(profile)
+        await self._send(profile)
+
+    async def rotateProfile(self) -> None:
+        profile = self._nextProfile()
+        if profile is not None:
+            await self.updateProfile(profile)
+
+    async def reloadProfile(self):
+        self.logger.info('Reloading presence profile...')
+        await self._scriptEngine.emitAsync(ScriptEvent.OnReload, self._currentProfile)
+        self._adaptReload(await self._send(self._currentProfile))
+
+    async def reloadProfiles(self) -> bool:
+        reloaded, replacement = self._applyProfiles()
+        if replacement is not None:
+            await self.updateProfile(replacement)
+        return reloaded
+
+    def _wake(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._asyncWakeup.set)
+
+    async def _wait(self, timeout: Optional[float]) -> None:
+        try:
+            await asyncio.wait_for(self._asyncWakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+        self._asyncWakeup.clear()
+
+    async def reloadScript(self, filename: str) -> bool:
+        try:
+            current, scripts = self._loadScripts(filename)
+        except Exception as e:
+            self.logger.error(f'Failed to reload scripts in {filename} : {e!r}')
+            return False
+        if current is not None:
+            await self._scriptEngine.emitAsync(ScriptEvent.OnUnload, current)
+        await self._scriptEngine.emitToAsync(self._scriptEngine.loadedScripts(filename).values(), ScriptEvent.OnClose)
+        self._replaceScripts(filename, scripts)
+        await self._scriptEngine.emitToAsync(scripts.values(), ScriptEvent.OnStart)
+        if current is not None:
+            await self._scriptEngine.emitAsync(ScriptEvent.OnLoad, current)
+            self._scheduleReload(current)
+            await self._send(current)
+        return True
+
+    async def _handleRequests(self) -> None:
+        while self._scriptsChanged:
+            await self.reloadScript(self._scriptsChanged.pop())
+        if self._profilesChanged:
+            self._profilesChanged = False
+            await self.reloadProfiles()
+        while self._discordEvents:
+            await self._handleDiscordEvent(*self._discordEvents.popleft())
+        if self._controlCommands:
+            target, switch, queries = self._applyControl()
+            error: Optional[Exception] = None
+            if target is not None:
+                try:
+                    await self.updateProfile(target)
+                except Exception as e:
+                    self.logger.error(f'Failed to switch profile : {e!r}')
+                    error = e
+            self._answerControl(switch, queries, error)
+        if self._updateRequested:
+            self._updateRequested = False
+            if self._currentProfile is not None and await self._send(self._currentProfile):
+                self._adaptReload(True)
+
+    async def _handleDiscordEvent(self, event: str, data: JSON) -> None:
+        button = self._clickedButton(event)
+        if button is None:
+            self.logger.debug(f'Ignored discord event {event} : {data}')
+            return
+        await self._scriptEngine.emitAsync(ScriptEvent.OnClick, self._currentProfile, button)
+
+    async def runOnce(self) -> None:
+        """Sleep until something is due or requested, and handle it. One iteration of loop()."""
+        await self._wait(self._waitTimeout())
+        self._wakeups += 1
+        await self._handleRequests()
+        tasks = self._scheduler.due()
+        if tasks:
+            self._loopDrift.observe(self._scheduler.lateness)
+        for task in tasks:
+            result = task.callback()
+            if inspect.isawaitable(result):
+                await result
+        await self._scriptEngine.flushBatchesAsync()
+        await self.flush()
+
+    async def loop(self):
+        while True:
+            await self.runOnce()
+
+    def schedule(self) -> asyncio.Task:
+        """
+        Start reloading current profile periodically on the running event loop.
+
+        Returns:
+            asyncio.Task running the scheduler. Cancelling it stops the scheduler.
+        """
+        if not self.running:
+            self._loopTask = asyncio.get_running_loop().create_task(self.loop())
+        return self._loopTask
+
+    async def cancel(self) -> None:
+        """Stop the scheduler started by schedule(), and wait until it is stopped."""
+        if self._loopTask is None:
+            return
+        self._loopTask.cancel()
+        try:
+            await self._loopTask
+        except asyncio.CancelledError:
+            pass
+        self._loopTask = None
+
+    async def close(self) -> None:
+        self.logger.info('Closing presence client...')
+        await self.cancel()
+        self._scheduler.clear()
+        if self._currentProfile is not None:
+            await self._scriptEngine.emitAsync(ScriptEvent.OnUnload, self._currentProfile)
+        await self._connection.close()
+        await self._scriptEngine.emitAsync(ScriptEvent.OnClose)
+        await self._scriptEngine.flushBatchesAsync(force=True)
+        self._scriptEngine.shutdown()
+        self._metrics.stop()
+        if self._exporter is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._exporter.stop)
+        if self._control is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._control.stop)
+        if self._watcher is not None:
+            self._watcher.stop()
+        if self._scriptWatcher is not None:
+            self._scriptWatcher.stop()
+        self.dumpStats()
+        self.logger.info(f'Closed! {self._pipeline.stats}, {self._wakeups} wakeups')
+
+    async def run(self) -> None:
+        """Start client, and keep updating presence until cancelled."""
+        await self.start()
+        try:
+            await self.schedule()
+        finally:
+            await self.close()
@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import logging
+import random
+from enum import Enum
+from typing import Any, Callable, Optional
+
+from pypresence.exceptions import (
+    ConnectionTimeout, DiscordNotFound, InvalidPipe, PipeClosed, ResponseTimeout
+)
+from src.scheduler import ScheduledTask, Scheduler
+from src.type_hints import JSON
+
+# Errors meaning the IPC connection is gone (or was never made). Other errors, like ServerError of a rejected
+# payload, are raised to the caller and the connection is kept.
+ConnectionErrors = (
+    PipeClosed, ResponseTimeout, ConnectionTimeout, InvalidPipe, DiscordNotFound, OSError, EOFError,
+    asyncio.TimeoutError, asyncio.IncompleteReadError
+)
+
+
+class ConnectionState(Enum):
+    Disconnected = 'disconnected'
+    Connecting = 'connecting'
+    Connected = 'connected'
+    Closed = 'closed'
+
+
+class SendResult(Enum):
+    Delivered = 'delivered'     # Discord took the payload.
+    Queued = 'queued'           # Kept until connected, replacing older one.
+
+
+class Backoff:
+    """Exponential backoff with full jitter. The n-th delay is a random value in [0, min(maximum, base * factor ** n)]."""
+
+    def __init__(
+            self,
+            base: float = 0.5,
+            factor: float = 2,
+            maximum: float = 30,
+            rng: Optional[random.Random] = None
+    ) -> None:
+        self._base: float = base
+        self._factor: float = factor
+        self._maximum: float = maximum
+        self._random: random.Random = random.Random() if rng is None else rng
+        self._attempts: int = 0
+
+    @property
+    def attempts(self) -> int:
+        return self._attempts
+
+    def next(self) -> float:
+        """Delay before the next attempt."""
+        ceiling = min(self._maximum, self._base * self._factor ** min(self._attempts, 32))
+        self._attempts += 1
+        return self._random.uniform(0, ceiling)
+
+    def reset(self) -> None:
+        self._attempts = 0
+
+
+StateListener = Callable[[ConnectionState, ConnectionState], Any]
+
+
+class ConnectionManager:
+    """
+    Keeps presence client connected to discord.
+
+    Broken connections are detected by errors of the client, and reconnected on the scheduler with jittered
+    exponential backoff. Payloads sent while disconnected are not lost: the latest one is kept,
+    and sent right after the handshake succeeds.
+    """
+
+    def __init__(
+            self,
+            factory: Callable[[], Any],
+            scheduler: Scheduler,
+            logger: logging.Logger,
+            onStateChanged: Optional[StateListener] = None,
+            backoff: Optional[Backoff] = None,
+            onReplayed: Optional[Callable[[], Any]] = None
+    ) -> None:
+        """
+        Initialize ConnectionManager.
+
+        Args:
+            factory (Callable[[], Any]) : Function creating a new presence client. Called on every connection attempt.
+            scheduler (Scheduler) : Scheduler to run reconnection attempts on.
+            logger (logging.Logger) : Logger of the client.
+            onStateChanged (Optional[Callable]) : Called with (state, previous) when state is changed.
+            backoff (Optional[Backoff]) : Backoff of reconnection attempts.
+            onReplayed (Optional[Callable[[], Any]]) : Called when the payload kept while disconnected is delivered
+                after connecting.
+        """
+        self._factory: Callable[[], Any] = factory
+        self._scheduler: Scheduler = scheduler
+        self.logger: logging.Logger = logger
+        self._onStateChanged: Optional[StateListener] = onStateChanged
+        self._backoff: Backoff = Backoff() if backoff is None else backoff
+        self._onReplayed: Optional[Callable[[], Any]] = onReplayed
+        self._client: Any = None
+        self._state: ConnectionState = ConnectionState.Disconnected
+        self._pending: Optional[JSON] = None
+        self._retryTask: Optional[ScheduledTask] = None
+        self.reconnects: int = 0
+        self.errors: int = 0        # Connection attempts failed and connections lost.
+
+    @property
+    def client(self) -> Any:
+        """Presence client of the current connection. None if not connected."""
+        return self._client
+
+    @property
+    def state(self) -> ConnectionState:
+        return self._state
+
+    @property
+    def connected(self) -> bool:
+        return self._state is ConnectionState.Connected
+
+    @property
+    def pending(self) -> Optional[JSON]:
+        """Latest payload waiting for the connection."""
+        return self._pending
+
+    def _setState(self, state: ConnectionState) -> Any:
+        previous, self._state = self._state, state
+        if previous is state or self._onStateChanged is None:
+            return None
+        try:
+            return self._onStateChanged(state, previous)
+        except Exception as e:
+            # Reconnecting must go on whatever listeners do.
+            self.logger.error(f'Connection state listener raised {e!r}')
+            return None
+
+    def _scheduleRetry(self) -> None:
+        self._scheduler.cancel(self._retryTask)
+        delay = self._backoff.next()
+        self.logger.info(f'Reconnecting to discord in {delay:.1f} seconds. (attempt {self._backoff.attempts})')
+        self._retryTask = self._scheduler.callLater(delay, self.connect, 'reconnect')
+
+    def _discard(self) -> None:
+        """Drop the client of broken connection, without talking to discord."""
+        client, self._client = self._client, None
+        if client is None:
+            return
+        stopEvents = getattr(client, 'stopEvents', None)
+        if stopEvents is not None:
+            stopEvents()
+        writer = getattr(client, 'sock_writer', None)
+        loop = getattr(client, 'loop', None)
+        try:
+            if writer is not None:
+                writer.close()
+            if loop is not None and not getattr(client, 'isasync', False) and not loop.is_closed():
+                # Sync clients own their event loop. Let it close the socket, and close the loop.
+                loop.run_until_complete(asyncio.sleep(0))
+                loop.close()
+        except Exception:
+            pass
+
+    def _lost(self, error: BaseException) -> Any:
+        self.errors += 1
+        if self._state is ConnectionState.Connecting:
+            self.logger.warning(f'Failed to connect to discord : {error!r}')
+        else:
+            self.logger.warning(f'Connection to discord is lost : {error!r}')
+        self._discard()
+        self._scheduleRetry()
+        return self._setState(ConnectionState.Disconnected)
+
+    def connect(self) -> bool:
+        """
+        Try to connect once. If it fails, another attempt is scheduled.
+
+        Returns:
+            True if connected.
+        """
+        if self._state in (ConnectionState.Connected, ConnectionState.Closed):
+            return self.connected
+        self._scheduler.cancel(self._retryTask)
+        self._retryTask = None
+        self._setState(ConnectionState.Connecting)
+        try:
+            self._client = self._factory()
+            self._client.connect()
+        except ConnectionErrors as e:
+            self._lost(e)
+            return False
+        except Exception:
+            # Errors like invalid client id are not fixed by retrying.
+            self._discard()
+            self._setState(ConnectionState.Disconnected)
+            raise
+        self._connected()
+        if self._pending is not None and self.send(self._pending) is SendResult.Delivered:
+            self._replayed()
+        return self.connected
+
+    def _replayed(self) -> None:
+        if self._onReplayed is not None:
+            self._onReplayed()
+
+    def _connected(self) -> Any:
+        if self._backoff.attempts:
+            self.reconnects += 1
+        self._backoff.reset()
+        self.logger.info('Connected to discord.')
+        return self._setState(ConnectionState.Connected)
+
+    def send(self, payload: JSON) -> SendResult:
+        """
+        Send presence payload. If not connected, payload is kept until connected, replacing older one.
+
+        Returns:
+            SendResult.Delivered if discord took the payload, or SendResult.Queued if it is kept for later.
+        """
+        if not self.connected:
+            self._pending = payload
+            return SendResult.Queued
+        try:
+            response = self._client.update(**payload)
+        except ConnectionErrors as e:
+            self._pending = payload
+            self._lost(e)
+            return SendResult.Queued
+        self._pending = None
+        self.logger.debug(f'{response =}')
+        return SendResult.Delivered
+
+    def close(self) -> None:
+        self._scheduler.cancel(self._retryTask)
+        self._retryTask = None
+        if self.connected:
+            try:
+                self._client.close()
+            except ConnectionErrors:
+                pass
+            self._client = None
+        self._discard()
+        self._setState(ConnectionState.Closed)
+
+
+class AsyncConnectionManager(ConnectionManager):
+    """ConnectionManager of asyncio based client. Every IPC call is limited by `timeout`."""
+
+    def __init__(self, *args, timeout: float = 10, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._timeout: float = timeout
+
+    async def _notify(self, result: Any) -> None:
+        if not inspect.isawaitable(result):
+            return
+        try:
+            await result
+        except Exception as e:
+            self.logger.error(f'Connection state listener raised {e!r}')
+
+    async def connect(self) -> bool:
+        if self._state in (ConnectionState.Connected, ConnectionState.Closed):
+            return self.connected
+        self._scheduler.cancel(self._retryTask)
+        self._retryTask = None
+        await self._notify(self._setState(ConnectionState.Connecting))
+        try:
+            self._client = self._factory()
+            await asyncio.wait_for(self._client.connect(), self._timeout)
+        except ConnectionErrors as e:
+            await self._notify(self._lost(e))
+            return False
+        except Exception:
+            self._discard()
+            await self._notify(self._setState(ConnectionState.Disconnected))
+            raise
+        await self._notify(self._connected())
+        if self._pending is not None and await self.send(self._pending) is SendResult.Delivered:
+            self._replayed()
+        return self.connected
+
+    async def send(self, payload: JSON) -> SendResult:
+        if not self.connected:
+            self._pending = payload
+            return SendResult.Queued
+        try:
+            response = await asyncio.wait_for(self._client.update(**payload), self._timeout)
+        except ConnectionErrors as e:
+            self._pending = payload
+            await self._notify(self._lost(e))
+            return SendResult.Queued
+        self._pending = None
+        self.logger.debug(f'{response =}')
+        return SendResult.Delivered
+
+    async def close(self) -> None:
+        self._scheduler.cancel(self._retryTask)
+        self._retryTask = None
+        if self.connected:
+            # AioPresence.close() also closes the event loop, which is not ours to close when embedded.
+            try:
+                self._client.send_data(2, {'v': 1, 'client_id': self._client.client_id})
+            except ConnectionErrors:
+                pass
+        self._discard()
+        await self._notify(self._setState(ConnectionState.Closed))
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Final
+from typing import Dict, Final
 
 
 class ConfigKeys:
@@ -7,6 +7,21 @@ class ConfigKeys:
     Version: Final[str] = 'version'
     ClientID: Final[str] = 'client_id'
     Profiles: Final[str] = 'profiles'
+    Async: Final[str] = 'async'
+    ScriptBudget: Final[str] = 'script_budget'
+    ScriptWorkers: Final[str] = 'script_workers'
+    ScriptDeadline: Final[str] = 'script_deadline'
+    Watch: Final[str] = 'watch'
+    WatchScripts: Final[str] = 'watch_scripts'
+    DefaultProfile: Final[str] = 'default_profile'
+    Interval: Final[str] = 'interval'
+    IdleInterval: Final[str] = 'idle_interval'
+    Pipe: Final[str] = 'pipe'
+    Clients: Final[str] = 'clients'
+    Name: Final[str] = 'name'
+    Snapshot: Final[str] = 'snapshot'
+    MetricsExport: Final[str] = 'metrics_export'
+    Control: Final[str] = 'control'
     # profiles.json
     Format: Final[str] = 'format'
     Data: Final[str] = 'data'
@@ -26,12 +41,30 @@ class Resources(Enum):
 class ButtonKeys:
     Label: Final[str] = 'label'
     URL: Final[str] = 'url'
+    Script: Final[str] = 'script'
+
+
+class PartyKeys:
+    Id: Final[str] = 'id'
+    Size: Final[str] = 'size'
+
+
+class SecretKeys:
+    # Also keys of the presence payload.
+    Join: Final[str] = 'join'
+    Spectate: Final[str] = 'spectate'
+    Match: Final[str] = 'match'
 
 
 class ProfileKeys:
     # Flags
     Enabled: Final[str] = 'enabled'
 
+    # Lookup keys
+    Id: Final[str] = 'id'
+    Name: Final[str] = 'name'
+    Tags: Final[str] = 'tags'
+
     # JSON keys
     State: Final[str] = 'state'
     Details: Final[str] = 'details'
@@ -40,20 +73,104 @@ class ProfileKeys:
     SmallIcon: Final[str] = 'small_image'
     SmallText: Final[str] = 'small_text'
     Buttons: Final[str] = 'buttons'
+    Party: Final[str] = 'party'
+    Secrets: Final[str] = 'secrets'
+
+    # Payload keys of party, made from `party` object of the profile
+    PartyId: Final[str] = 'party_id'
+    PartySize: Final[str] = 'party_size'
 
     # Script features
     Script: Final[str] = 'script'
 
+    # Rotation
+    Schedule: Final[str] = 'schedule'
+
     # Format constants
     Client: Final[str] = 'client.'
 
     @staticmethod
     def parseResource(resource_key: str) -> Resources:
+        resource = ResourceKeys.get(resource_key)
+        if resource is not None:
+            return resource
         if resource_key.startswith(ProfileKeys.Client):
-            key = resource_key.replace(ProfileKeys.Client, '')
-            return tuple(filter(
-                lambda e: e.value == key,
-                Resources.__members__.values()
-            ))[0]
-        else:
-            raise ValueError('Currently, only resources in client can be used :(')
+            raise ValueError(f'Unknown resource {resource_key}')
+        raise ValueError('Currently, only resources in client can be used :(')
+
+
+# Resource keys used in profiles.json (like `client.study`), mapped to resources.
+ResourceKeys: Final[Dict[str, Resources]] = {
+    f'{ProfileKeys.Client}{resource.value}': resource for resource in Resources
+}
+
+
+class IpcEvents:
+    # Events of discord IPC the client subscribes to. Discord shows its Ask to Join and Spectate buttons for
+    # activities with a party and join / spectate secrets, and sends these events when they are used.
+    # Clicks on url buttons are never sent.
+    ActivityJoin: Final[str] = 'ACTIVITY_JOIN'
+    ActivitySpectate: Final[str] = 'ACTIVITY_SPECTATE'
+    ActivityJoinRequest: Final[str] = 'ACTIVITY_JOIN_REQUEST'
+
+
+# IPC events mapped to index of the button slot they are sent for. `Ask to Join` takes the first slot.
+ButtonEvents: Final[Dict[str, int]] = {
+    IpcEvents.ActivityJoin: 0,
+    IpcEvents.ActivityJoinRequest: 0,
+    IpcEvents.ActivitySpectate: 1
+}
+
+
+class ExportKeys:
+    # metrics_export of config.json
+    Host: Final[str] = 'host'
+    Port: Final[str] = 'port'
+    Socket: Final[str] = 'socket'
+    File: Final[str] = 'file'
+    Interval: Final[str] = 'interval'
+
+
+class ControlKeys:
+    # Requests and responses of the control server
+    Id: Final[str] = 'id'
+    Command: Final[str] = 'cmd'
+    Args: Final[str] = 'args'
+    Ok: Final[str] = 'ok'
+    Data: Final[str] = 'data'
+    Error: Final[str] = 'error'
+    # Arguments
+    Profile: Final[str] = 'profile'
+    Values: Final[str] = 'values'
+    Client: Final[str] = 'client'
+
+
+class ControlCommands:
+    Switch: Final[str] = 'switch'
+    Variables: Final[str] = 'variables'
+    Pause: Final[str] = 'pause'
+    Resume: Final[str] = 'resume'
+    State: Final[str] = 'state'
+
+
+class ScheduleKeys:
+    Duration: Final[str] = 'duration'
+    Weight: Final[str] = 'weight'
+    Window: Final[str] = 'window'
+
+
+class RateLimits:
+    # Discord accepts 5 activity updates per 20 seconds.
+    ActivityUpdates: Final[int] = 5
+    ActivityPeriod: Final[float] = 20
+
+
+class ActivityLimits:
+    # Limits of activity fields, checked when profiles.json is loaded.
+    MinTextLength: Final[int] = 2
+    MaxTextLength: Final[int] = 128
+    MaxButtons: Final[int] = 2
+    MaxButtonLabelLength: Final[int] = 32
+    MaxButtonURLLength: Final[int] = 512
+    MaxPartyIdLength: Final[int] = 128
+    MaxSecretLength: Final[int] = 128
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import errno
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, List, Optional
+
+from src.constants import ControlKeys
+from src.ipc_events import FrameDecoder
+from src.type_hints import JSON
+
+logger = logging.getLogger('pyrorpc.control')
+
+# Same framing as discord IPC : little-endian uint32 opcode and length, followed by UTF-8 JSON.
+_Header = struct.Struct('<II')
+OpCommand: int = 1
+OpClose: int = 2
+MaxFrameLength: int = 1 << 16     # Longest request accepted. Connections sending longer ones are closed.
+
+
+def encodeFrame(payload: JSON, op: int = OpCommand) -> bytes:
+    data = json.dumps(payload, separators=(',', ':'), default=str).encode('utf-8')
+    return _Header.pack(op, len(data)) + data
+
+
+class ControlError(Exception):
+    """Command rejected by the client, like switching to an unknown profile. Sent back as the error of response."""
+
+
+class ControlCommand:
+    """Command received by ControlServer. The client loop applies it, and answers it through `future`."""
+    __slots__ = ('id', 'cmd', 'args', 'future')
+
+    @classmethod
+    def fromJson(cls, data: Any) -> ControlCommand:
+        if not isinstance(data, dict):
+            command = cls(None, None, {})
+            command.reject('Request must be an object')
+            return command
+        args = data.get(ControlKeys.Args)
+        command = cls(data.get(ControlKeys.Id), data.get(ControlKeys.Command), args if args is not None else {})
+        if not isinstance(command.args, dict):
+            command.reject('args must be an object')
+        return command
+
+    def __init__(self, commandId: Any, cmd: Optional[str], args: JSON) -> None:
+        self.id: Any = commandId
+        self.cmd: Optional[str] = cmd
+        self.args: JSON = args
+        self.future: Future = Future()
+
+    def __repr__(self) -> str:
+        return f'ControlCommand(id={self.id!r}, cmd={self.cmd!r}, args={self.args!r})'
+
+    def resolve(self, data: Any = None) -> None:
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def reject(self, error: str) -> None:
+        if not self.future.done():
+            self.future.set_exception(ControlError(error))
+
+    def response(self, timeout: Optional[float]) -> JSON:
+        """Wait until the command is applied, and make its response."""
+        try:
+            data = self.future.result(timeout)
+        except ControlError as e:
+            return {ControlKeys.Id: self.id, ControlKeys.Ok: False, ControlKeys.Error: str(e)}
+        except FutureTimeout:
+            return {ControlKeys.Id: self.id, ControlKeys.Ok: False, ControlKeys.Error: 'Timed out'}
+        return {ControlKeys.Id: self.id, ControlKeys.Ok: True, ControlKeys.Data: data}
+
+
+Submit = Callable[[List[ControlCommand]], Any]
+
+
+class _ControlHandler(socketserver.BaseRequestHandler):
+    server: _ControlUnixServer
+
+    def handle(self) -> None:
+        try:
+            self._serve()
+        except OSError:
+            pass    # Peer went away.
+
+    def _serve(self) -> None:
+        decoder = FrameDecoder(MaxFrameLength)
+        sock = self.request
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            try:
+                frames = decoder.feed(data)
+            except ValueError as e:
+                # Stream can't be resynchronized after a broken frame.
+                sock.sendall(encodeFrame({ControlKeys.Ok: False, ControlKeys.Error: f'Invalid frame : {e}'}, OpClose))
+                return
+            commands: List[ControlCommand] = []
+            closing = False
+            for op, payload in frames:
+                if op == OpClose:
+                    closing = True
+                    break
+                commands.append(ControlCommand.fromJson(payload))
+            # Commands read together are applied together, and answered in the order they are sent.
+            pending = [command for command in commands if not command.future.done()]
+            if pending:
+                self.server.submit(pending)
+            if commands:
+                timeout = self.server.responseTimeout
+                sock.sendall(b''.join(encodeFrame(command.response(timeout)) for command in commands))
+            if closing:
+                return
+
+
+def _isServing(path: str) -> bool:
+    """Whether something accepts connections on the unix socket at path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+class _ControlUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    submit: Submit
+    responseTimeout: float
+
+    def server_bind(self) -> None:
+        if os.path.exists(self.server_address):
+            if _isServing(self.server_address):
+                raise OSError(errno.EADDRINUSE, f'Control socket {self.server_address} is used by another client')
+            os.remove(self.server_address)  # Left by a previous run which was killed.
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)    # Only the user running the client can control it.
+
+
+class ControlServer:
+    """
+    Local control API of the client, served on a unix socket.
+
+    Requests `{"id": 1, "cmd": "switch", "args": {"profile": "study"}}` are sent in frames of discord IPC
+    (opcode 1), and answered in order with `{"id": 1, "ok": true, "data": ...}` or `{"id": 1, "ok": false,
+    "error": "..."}`. Opcode 2 closes the connection. Requests can be pipelined: commands read together are handed
+    to the client as one batch, so their updates are coalesced.
+    """
+
+    def __init__(self, path: str, submit: Submit, timeout: float = 5) -> None:
+        """
+        Initialize ControlServer.
+
+        Args:
+            path (str) : Path of the unix socket.
+            submit (Callable[[List[ControlCommand]], Any]) : Hands commands to the client loop. Called on
+                connection threads.
+            timeout (float) : Seconds to wait for the client to apply a command, before answering it with an error.
+        """
+        self._path: str = path
+        self._submit: Submit = submit
+        self._timeout: float = timeout
+        self._server: Optional[_ControlUnixServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def start(self) -> None:
+        server = _ControlUnixServer(self._path, _ControlHandler)
+        server.submit = self._submit
+        server.responseTimeout = self._timeout
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, name='pyrorpc-control', daemon=True)
+        self._thread.start()
+        logger.info(f'Serving control API on unix socket {self._path}')
+
+    def stop(self) -> None:
+        server, self._server = self._server, None
+        if server is None:
+            return
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._thread.join()
+        self._thread = None
@@ -1,34 +1,53 @@
 from __future__ import annotations
 
 import importlib
-import json
 import logging
-from time import sleep
+import os
+import threading
+from collections import deque
 from sys import stdout
-from typing import Optional, List, Tuple
+from time import perf_counter
+from typing import Optional, List, Tuple, Mapping, Any, Dict, Set, Deque
 
-from pypresence import Presence     # The simple rich presence client in pypresence
 from src.script_support import ScriptEngine, ScriptEvent, Script
 from src.type_hints import JSON
 from src.abstracts import JsonObject, Scriptable
-from src.constants import Resources, ButtonKeys, ProfileKeys, ConfigKeys
+from src.constants import (
+    Resources, ButtonKeys, ButtonEvents, ProfileKeys, PartyKeys, ConfigKeys, ControlCommands, ControlKeys
+)
+from src.control import ControlCommand, ControlError, ControlServer
+from src.ipc_events import EventPresence
+from src.update_pipeline import TokenBucket, UpdatePipeline, UpdateStats
+from src.templates import RenderPlan
+from src.system_metrics import MetricsSampler
+from src.file_watcher import FileWatcher
+from src.connection import ConnectionManager, ConnectionState, SendResult
+from src.profile_store import ProfileStore
+from src.snapshot import ProfileSnapshot
+from src.telemetry import Counter, Histogram, HistogramChild, MetricsExporter, MetricsRegistry
+from src.scheduler import Scheduler, ScheduledTask, ProfileSchedule, ProfileRotation
 
 
 class Button(JsonObject, Scriptable):
+    __slots__ = ('_label', '_url', '_scriptInfo', '_script')
+
     @classmethod
     def fromJson(cls, data: JSON) -> Button:
         return cls(
             data[ButtonKeys.Label],
-            data[ButtonKeys.URL]
+            data[ButtonKeys.URL],
+            scriptName=data.get(ButtonKeys.Script)
         )
 
     def __init__(
             self,
             label: str,
-            url: str
+            url: str,
+            scriptName: Optional[str] = None
     ) -> None:
         self._label: str = label
         self._url: str = url
+        self._scriptInfo: Tuple[str, ...] = () if scriptName is None else tuple(scriptName.split('.'))
         self._script: Optional[Script] = None
 
     @property
@@ -39,6 +58,11 @@ class Button(JsonObject, Scriptable):
     def url(self) -> str:
         return self._url
 
+    @property
+    def scriptInfo(self) -> Tuple[str, ...]:
+        """(module, class name) of the script receiving clicks of this button. Empty if it has no script."""
+        return self._scriptInfo
+
     @property
     def script(self) -> Script:
         return self._script
@@ -50,6 +74,14 @@ class Button(JsonObject, Scriptable):
 
     setScript.__doc__ = Scriptable.setScript.__doc__
 
+    def loadScript(self, engine: ScriptEngine) -> Optional[Script]:
+        """Bind script referenced by scriptInfo. See Profile.loadScript()."""
+        if self._script is None and self._scriptInfo:
+            script = engine.getScript(*self._scriptInfo)
+            if script is not None:
+                self.setScript(script)
+        return self._script
+
     def toJson(self) -> JSON:
         return {
             ButtonKeys.Label: self._label,
@@ -58,18 +90,33 @@ class Button(JsonObject, Scriptable):
 
 
 class Profile(JsonObject, Scriptable):
+    __slots__ = (
+        '_enabled', '_id', '_name', '_tags', '_details', '_state',
+        '_largeIcon', '_largeText', '_smallIcon', '_smallText', '_buttons',
+        '_partyId', '_partySize', '_secrets',
+        '_scriptInfo', '_script', '_schedule', '_renderPlan', '_payload', '_version', '_payloadVersion'
+    )
+
     @classmethod
     def fromJson(cls, data: JSON) -> Profile:
         return cls(
             data[ProfileKeys.Enabled],
-            data[ProfileKeys.State],
-            data[ProfileKeys.Details],
-            data.get(ProfileKeys.LargeIcon),
-            data.get(ProfileKeys.LargeText),
-            data.get(ProfileKeys.SmallIcon),
-            data.get(ProfileKeys.SmallText),
-            data.get(ProfileKeys.Buttons),
-            data.get(ProfileKeys.Script)
+            description=data[ProfileKeys.Details],
+            state=data[ProfileKeys.State],
+            large_icon=data.get(ProfileKeys.LargeIcon),
+            large_text=data.get(ProfileKeys.LargeText),
+            small_icon=data.get(ProfileKeys.SmallIcon),
+            small_text=data.get(ProfileKeys.SmallText),
+            buttons=data.get(ProfileKeys.Buttons),
+            party=data.get(ProfileKeys.Party),
+            secrets=data.get(ProfileKeys.Secrets),
+            scriptName=data.get(ProfileKeys.Script),
+            profileId=data.get(ProfileKeys.Id),
+            name=data.get(ProfileKeys.Name),
+            tags=data.get(ProfileKeys.Tags),
+            schedule=None if data.get(ProfileKeys.Schedule) is None else ProfileSchedule.fromJson(
+                data[ProfileKeys.Schedule]
+            )
         )
 
     def __init__(
@@ -82,10 +129,20 @@ class Profile(JsonObject, Scriptable):
             small_icon: Optional[str] = None,
             small_text: Optional[str] = None,
             buttons: Optional[List[JSON]] = None,
-            scriptName: Optional[str] = None
+            party: Optional[JSON] = None,
+            secrets: Optional[Dict[str, str]] = None,
+            scriptName: Optional[str] = None,
+            profileId: Optional[str] = None,
+            name: Optional[str] = None,
+            tags: Optional[List[str]] = None,
+            schedule: Optional[ProfileSchedule] = None
     ) -> None:
         # Flag
         self._enabled: bool = enabled
+        # Lookup keys
+        self._id: Optional[str] = profileId
+        self._name: Optional[str] = name
+        self._tags: Tuple[str, ...] = tuple(tags or ())
         # Info
         self._details: str = '' if description is None else description
         self._state: str = state
@@ -95,13 +152,56 @@ class Profile(JsonObject, Scriptable):
         self._smallIcon: Optional[Resources] = None if small_icon is None else ProfileKeys.parseResource(small_icon)
         self._smallText: str = small_text
 
-        # Buttons
-        buttons = [Button.fromJson(data) for data in buttons]
-        if len(buttons) > 2:
-            buttons = buttons[:1]
-        self._buttons: Tuple[Button] = tuple(buttons)
+        # Buttons (discord shows 2 buttons at most)
+        self._buttons: Tuple[Button, ...] = tuple(Button.fromJson(data) for data in (buttons or ())[:2])
+        # Party and secrets make discord show its Ask to Join / Spectate buttons, in place of url buttons.
+        self._partyId: Optional[str] = None if party is None else party[PartyKeys.Id]
+        size = None if party is None else party.get(PartyKeys.Size)
+        self._partySize: Optional[Tuple[int, int]] = None if size is None else (size[0], size[1])
+        self._secrets: Dict[str, str] = dict(secrets or {})
         self._scriptInfo: Tuple[str, ...] = tuple(scriptName.split('.'))
         self._script: Optional[Script] = None
+        # Rotation
+        self._schedule: Optional[ProfileSchedule] = schedule
+
+        # Text fields are kept as templates, and rendered into payload in toJson().
+        templates = {
+            ProfileKeys.Details: self._details,
+            ProfileKeys.State: self._state,
+            ProfileKeys.LargeText: self._largeText,
+            ProfileKeys.SmallText: self._smallText
+        }
+        for index, button in enumerate(self._buttons):
+            templates[self._buttonKey(index)] = button.label
+        self._renderPlan: RenderPlan = RenderPlan(templates)
+        # Payload is cached, and built again only after something is changed.
+        # Changes bump _version, and cached payload is valid while _payloadVersion is the same.
+        self._payload: Optional[JSON] = None
+        self._version: int = 0
+        self._payloadVersion: int = -1
+
+    def _changed(self) -> None:
+        self._version += 1
+
+    @staticmethod
+    def _buttonKey(index: int) -> str:
+        return f'{ProfileKeys.Buttons}.{index}.{ButtonKeys.Label}'
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @property
+    def id(self) -> Optional[str]:
+        return self._id
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._name
+
+    @property
+    def tags(self) -> Tuple[str, ...]:
+        return self._tags
 
     @property
     def details(self) -> str:
@@ -111,7 +211,11 @@ class Profile(JsonObject, Scriptable):
     def details(self, new: str):
         if not isinstance(new, str):
             raise TypeError('Profile.details must be a str object!')
+        if new == self._details:
+            return
         self._details = new
+        self._renderPlan.setTemplate(ProfileKeys.Details, new)
+        self._changed()
 
     @property
     def state(self) -> str:
@@ -121,10 +225,11 @@ class Profile(JsonObject, Scriptable):
     def state(self, new: str):
         if not isinstance(new, str):
             raise TypeError('Profile.state must be a str object!')
-        print(f'Debug: New value for Profile.state in Profile<details={self.details}>')
-        print(f'value = {new}')
+        if new == self._state:
+            return
         self._state = new
-        print(f'changed profile value to {self._state}')
+        self._renderPlan.setTemplate(ProfileKeys.State, new)
+        self._changed()
 
     @property
     def largeIcon(self) -> Resources:
@@ -134,7 +239,10 @@ class Profile(JsonObject, Scriptable):
     def largeIcon(self, new: Resources):
         if not isinstance(new, Resources):
             raise TypeError('Profile.largeIcon must be a Resources enum!')
+        if new is self._largeIcon:
+            return
         self._largeIcon = new
+        self._changed()
 
     @property
     def largeText(self) -> str:
@@ -144,7 +252,11 @@ class Profile(JsonObject, Scriptable):
     def largeText(self, new: str):
         if not isinstance(new, str):
             raise TypeError('Profile.largeText must be a str object!')
+        if new == self._largeText:
+            return
         self._largeText = new
+        self._renderPlan.setTemplate(ProfileKeys.LargeText, new)
+        self._changed()
 
     @property
     def smallIcon(self) -> Resources:
@@ -154,7 +266,10 @@ class Profile(JsonObject, Scriptable):
     def smallIcon(self, new: Resources):
         if not isinstance(new, Resources):
             raise TypeError('Profile.smallIcon must be a Resources enum!')
+        if new is self._smallIcon:
+            return
         self._smallIcon = new
+        self._changed()
 
     @property
     def smallText(self) -> str:
@@ -164,12 +279,66 @@ class Profile(JsonObject, Scriptable):
     def smallText(self, new: str):
         if not isinstance(new, str):
             raise TypeError('Profile.smallText must be a str object!')
+        if new == self._smallText:
+            return
         self._smallText = new
+        self._renderPlan.setTemplate(ProfileKeys.SmallText, new)
+        self._changed()
 
     @property
     def scriptInfo(self) -> Tuple[str, str]:
         return self._scriptInfo
 
+    @property
+    def script(self) -> Optional[Script]:
+        return self._script
+
+    @property
+    def schedule(self) -> Optional[ProfileSchedule]:
+        return self._schedule
+
+    @property
+    def buttons(self) -> Tuple[Button, ...]:
+        return self._buttons
+
+    @property
+    def partyId(self) -> Optional[str]:
+        return self._partyId
+
+    @property
+    def partySize(self) -> Optional[Tuple[int, int]]:
+        """(current, max) size of the party."""
+        return self._partySize
+
+    @property
+    def secrets(self) -> Mapping[str, str]:
+        """Join, spectate and match secrets sent to discord. Scripts of buttons receive OnClick when they are used."""
+        return self._secrets
+
+    @property
+    def renderPlan(self) -> RenderPlan:
+        return self._renderPlan
+
+    @property
+    def variables(self) -> Mapping[str, Any]:
+        """Values of template variables used to render text fields."""
+        return self._renderPlan.variables
+
+    def setVariables(self, values: Optional[Mapping[str, Any]] = None, /, **variables) -> None:
+        """
+        Set values of template variables. Text fields are formatted with these values when payload is created.
+        Templates themselves are not changed, so they can be formatted again with new values.
+
+        Args:
+            values (Optional[Mapping[str, Any]]) : Name and value of template variables, for names which can't be
+                keyword arguments.
+            **variables (Any) : Name and value of template variables.
+        """
+        if values:
+            variables = {**values, **variables}
+        if self._renderPlan.update(variables):
+            self._changed()
+
     def setScript(self, script: Script):
         if not isinstance(script, Script):
             raise TypeError('Only Script objects can be set as Profile.script')
@@ -177,55 +346,276 @@ class Profile(JsonObject, Scriptable):
 
     setScript.__doc__ = Scriptable.setScript.__doc__
 
-    def loadScript(self):
-        importlib.import_module(f'scripts.{".".join(self._scriptInfo)}')
+    def loadScript(self, engine: ScriptEngine) -> Optional[Script]:
+        """
+        Bind script referenced by scriptInfo, importing its module on first use.
+
+        Args:
+            engine (ScriptEngine) : ScriptEngine to load script from.
+
+        Returns:
+            Script object bound to this profile.
+        """
+        if self._script is None:
+            script = engine.getScript(*self._scriptInfo)
+            if script is not None:
+                self.setScript(script)
+        return self._script
+
+    @property
+    def dirty(self) -> bool:
+        """Whether profile is changed since the last toJson() call."""
+        return self._version != self._payloadVersion
 
     def toJson(self) -> JSON:
-        return {
-            ProfileKeys.State: self._state,
-            ProfileKeys.Details: self._details,
-            ProfileKeys.LargeIcon: self._largeIcon.value,
-            ProfileKeys.LargeText: self._largeText,
-            ProfileKeys.SmallIcon: self._smallIcon.value,
-            ProfileKeys.SmallText: self._smallText,
-            ProfileKeys.Buttons: [button.toJson() for button in self._buttons]
+        """
+        Presence payload of this profile. Payload is cached until something is changed,
+        so the same dict object is returned for unchanged profile. It must not be modified.
+
+        Returns:
+            json data of the profile.
+        """
+        version = self._version
+        if version == self._payloadVersion:
+            return self._payload
+        rendered = self._renderPlan.render()
+        self._payload = {
+            ProfileKeys.State: rendered.get(ProfileKeys.State),
+            ProfileKeys.Details: rendered.get(ProfileKeys.Details),
+            ProfileKeys.LargeIcon: None if self._largeIcon is None else self._largeIcon.value,
+            ProfileKeys.LargeText: rendered.get(ProfileKeys.LargeText),
+            ProfileKeys.SmallIcon: None if self._smallIcon is None else self._smallIcon.value,
+            ProfileKeys.SmallText: rendered.get(ProfileKeys.SmallText),
+            ProfileKeys.Buttons: None if self._secrets else [
+                {ButtonKeys.Label: rendered[self._buttonKey(index)], ButtonKeys.URL: button.url}
+                for index, button in enumerate(self._buttons)
+            ]
         }
+        if self._partyId is not None:
+            self._payload[ProfileKeys.PartyId] = self._partyId
+            if self._partySize is not None:
+                self._payload[ProfileKeys.PartySize] = list(self._partySize)
+        # Discord doesn't accept url buttons together with secrets. Buttons are kept for their scripts.
+        self._payload.update(self._secrets)
+        # Changes made while building payload (by scripts on worker threads) keep it dirty.
+        self._payloadVersion = version
+        return self._payload
 
 
-class DiscordRPC:
-    def __init__(self, config: JSON) -> None:
-        self.logger = logging.getLogger('pyrorpc')
-        self.logger.setLevel(logging.DEBUG)
-        consoleHandler = logging.StreamHandler(stdout)
-        consoleHandler.setFormatter(
-            logging.Formatter(
-                style='{',
-                fmt='[{asctime}] [{levelname}] {name} > {message}'
-            )
+_ConsoleHandler: str = 'pyrorpc.console'
+
+
+def loopDriftHistogram(registry: MetricsRegistry) -> Histogram:
+    return registry.histogram('loop_drift_seconds', 'Delay of scheduled tasks behind their time, when they are run.')
+
+
+def loopWakeupsCounter(registry: MetricsRegistry) -> Counter:
+    return registry.counter('loop_wakeups_total', 'Times the client loop woke up from sleep.')
+
+
+def threadWakeupsCounter(registry: MetricsRegistry) -> Counter:
+    return registry.counter('thread_wakeups_total', 'Times the metrics sampler and file watcher threads woke up.')
+
+
+def setupLogger() -> logging.Logger:
+    """Logger of PyroRPC, printing to stdout. The console handler is added only once, however many clients are made."""
+    logger = logging.getLogger('pyrorpc')
+    logger.setLevel(logging.DEBUG)
+    if any(handler.get_name() == _ConsoleHandler for handler in logger.handlers):
+        return logger
+    consoleHandler = logging.StreamHandler(stdout)
+    consoleHandler.set_name(_ConsoleHandler)
+    consoleHandler.setFormatter(
+        logging.Formatter(
+            style='{',
+            fmt='[{asctime}] [{levelname}] {name} > {message}'
         )
-        self.logger.addHandler(consoleHandler)
+    )
+    logger.addHandler(consoleHandler)
+    return logger
+
+
+class DiscordRPC:
+    def __init__(self, config: JSON, metrics: Optional[MetricsSampler] = None) -> None:
+        self.logger = self._createLogger()
         self._config = config
         self._version = config[ConfigKeys.Version]
         self._client_id: int = config[ConfigKeys.ClientID]
-        self._client: Presence = Presence(self._client_id)
+        # Wakes the loop up when something should be handled before the next reload.
+        self._wakeup = threading.Event()
+        # Clock of the scheduler is shared by everything timed on the loop.
+        self._scheduler: Scheduler = self._createScheduler()
+        self._pipeline: UpdatePipeline = self._createPipeline()
+        self._metrics: MetricsSampler = MetricsSampler() if metrics is None else metrics
         scriptModule = importlib.import_module('scripts')
-        self._scriptEngine: ScriptEngine = ScriptEngine(self, scriptModule)
-
-        with open('./{}'.format(config[ConfigKeys.Profiles]), mode='rt', encoding='utf-8') as f:
-            profiles = json.load(f)
-        self._profileFormat: str = profiles[ConfigKeys.Format]
-        # self._profiles = [Profile.fromJson(profile) for profile in profiles[ConfigKeys.Data]]
-        self._profiles = list(
-            map(
-                lambda p: Profile.fromJson(p),
-                profiles[ConfigKeys.Data]
-            )
-        )
-        for profile in self._profiles:
-            script = self._scriptEngine.getScript(*profile.scriptInfo)
-            if script is not None:
-                profile.setScript(script)
+        self._scriptEngine: ScriptEngine = self._createScriptEngine(scriptModule)
+
+        self._profilesPath: str = os.path.abspath(config[ConfigKeys.Profiles])
+        self._interval: float = config.get(ConfigKeys.Interval, 15)
+        self._idleInterval: float = config.get(ConfigKeys.IdleInterval, 120)
+        self._idleLevel: int = 0        # Reload interval is doubled this many times, while nothing changes.
+        self._updateRequested: bool = False
+        self._paused: bool = False
+        self._wakeups: int = 0
+        self._snapshot: Optional[ProfileSnapshot] = self._createSnapshot()
+        self._store: Optional[ProfileStore] = None
         self._currentProfile: Optional[Profile] = None
+        self._store = self._readProfiles()
+
+        self._connection: ConnectionManager = self._createConnection()
+        self._rotation: ProfileRotation = ProfileRotation()
+        self._reloadTask: Optional[ScheduledTask] = None
+        self._rotateTask: Optional[ScheduledTask] = None
+        self._profilesChanged: bool = False
+        self._scriptsChanged: Set[str] = set()
+        self._discordEvents: Deque[Tuple[str, JSON]] = deque()     # Received on the IPC reader.
+        self._controlCommands: Deque[ControlCommand] = deque()     # Received on the control server.
+        self._watchInterval: float = 1.0       # Polling interval of watchers, while profiles are reloaded often.
+        self._watcher: Optional[FileWatcher] = None
+        if config.get(ConfigKeys.Watch, True):
+            self._watcher = FileWatcher(self._onFileChanged, interval=self._watchInterval)
+            self._watcher.watch(self._profilesPath)
+        self._scriptsPath: str = os.path.dirname(os.path.abspath(scriptModule.__file__))
+        self._scriptWatcher: Optional[FileWatcher] = None
+        if config.get(ConfigKeys.WatchScripts, False):
+            self._scriptWatcher = FileWatcher(self._onScriptChanged, suffix='.py', interval=self._watchInterval)
+            self._scriptWatcher.watch(self._scriptsPath)
+
+        self._registry: MetricsRegistry = self._createRegistry()
+        self._exporter: Optional[MetricsExporter] = self._createExporter()
+        self._control: Optional[ControlServer] = self._createControlServer()
+        self._updateErrors: int = 0
+        self._updateLatency: HistogramChild = self._registerMetrics()
+        self._loopDrift: HistogramChild = self._registerLoopMetrics()
+
+    def _createLogger(self) -> logging.Logger:
+        return setupLogger()
+
+    def _createClient(self) -> EventPresence:
+        """
+        Create presence client used to communicate with discord.
+
+        Returns:
+            pypresence.Presence object, receiving IPC events.
+        """
+        return EventPresence(
+            self._client_id, pipe=self._config.get(ConfigKeys.Pipe), eventHandler=self._onDiscordEvent
+        )
+
+    def _createConnection(self) -> ConnectionManager:
+        return ConnectionManager(
+            self._createClient, self._scheduler, self.logger, self._onConnectionChanged,
+            onReplayed=self._onReplayed
+        )
+
+    def _createScriptEngine(self, scriptModule) -> ScriptEngine:
+        return ScriptEngine.fromConfig(self, scriptModule, self._config, clock=self._scheduler.clock)
+
+    def _createScheduler(self) -> Scheduler:
+        return Scheduler(wakeup=self._wake)
+
+    def _createPipeline(self) -> UpdatePipeline:
+        return UpdatePipeline(TokenBucket(clock=self._scheduler.clock))
+
+    def _createRegistry(self) -> MetricsRegistry:
+        return MetricsRegistry()
+
+    def _createExporter(self) -> Optional[MetricsExporter]:
+        """
+        Create exporter serving metrics, configured by `metrics_export` of config.
+
+        Returns:
+            MetricsExporter, or None if metrics are not exported.
+        """
+        data = self._config.get(ConfigKeys.MetricsExport)
+        return None if not data else MetricsExporter.fromConfig(self._registry, data)
+
+    def _createControlServer(self) -> Optional[ControlServer]:
+        """
+        Create control server of the client, on the unix socket at `control` of config.
+
+        Returns:
+            ControlServer, or None if the client is not controlled from outside.
+        """
+        path = self._config.get(ConfigKeys.Control)
+        return None if not path else ControlServer(path, self._submitControl)
+
+    def _metricLabels(self) -> Dict[str, str]:
+        """Labels of metrics reported by this client."""
+        return {}
+
+    def _registerMetrics(self) -> HistogramChild:
+        """
+        Report health of this client to the registry. Values kept anyway (like UpdateStats) are read only when
+        metrics are scraped, so nothing is added to the update path except the latency histogram.
+
+        Returns:
+            Histogram of update latency.
+        """
+        registry = self._registry
+        labels = self._metricLabels()
+        stats = self._pipeline.stats
+        connection = self._connection
+        registry.counter('updates_sent_total', 'Presence updates delivered to discord.').track(
+            lambda: stats.sent, **labels
+        )
+        registry.counter('updates_queued_total', 'Presence updates kept while disconnected from discord.').track(
+            lambda: stats.queued, **labels
+        )
+        registry.counter('updates_suppressed_total', 'Presence updates dropped as same as the last sent one.').track(
+            lambda: stats.suppressed, **labels
+        )
+        registry.counter('updates_coalesced_total', 'Presence updates replaced by newer ones under rate limit.').track(
+            lambda: stats.coalesced, **labels
+        )
+        registry.counter('update_errors_total', 'Presence updates rejected by discord.').track(
+            lambda: self._updateErrors, **labels
+        )
+        registry.counter('ipc_errors_total', 'Failed connection attempts and lost connections to discord.').track(
+            lambda: connection.errors, **labels
+        )
+        registry.counter('reconnects_total', 'Connections made again after they were lost.').track(
+            lambda: connection.reconnects, **labels
+        )
+        registry.gauge('connected', 'Whether the client is connected to discord.').track(
+            lambda: int(connection.connected), **labels
+        )
+        registry.gauge('profiles', 'Profiles loaded from the profiles file.').track(
+            lambda: len(self._store), **labels
+        )
+        if self._scriptEngine.client is self:
+            self._scriptEngine.registerMetrics(registry)
+        latency: Histogram = registry.histogram(
+            'update_latency_seconds', 'Time taken to send presence updates to discord.'
+        )
+        return latency.labels(**labels)
+
+    def _registerLoopMetrics(self) -> HistogramChild:
+        """
+        Report wakeups of the loop, the metrics sampler and the file watchers to the registry.
+
+        Returns:
+            Histogram of loop drift.
+        """
+        loopWakeupsCounter(self._registry).track(lambda: self._wakeups)
+        threads = threadWakeupsCounter(self._registry)
+        threads.track(lambda: self._metrics.wakeups, thread='metrics')
+        for name, watcher in (('watcher', self._watcher), ('scripts_watcher', self._scriptWatcher)):
+            if watcher is not None:
+                threads.track(lambda watcher=watcher: watcher.wakeups, thread=name)
+        return loopDriftHistogram(self._registry).labels()
+
+    def _createSnapshot(self) -> Optional[ProfileSnapshot]:
+        """
+        Create snapshot of profiles.json, used to start without parsing it again.
+
+        Returns:
+            ProfileSnapshot at `snapshot` of config (`<profiles>.snapshot` by default), or None if it is disabled.
+        """
+        path = self._config.get(ConfigKeys.Snapshot, True)
+        if path is False or path is None:
+            return None
+        return ProfileSnapshot(f'{self._profilesPath}.snapshot' if path is True else os.path.abspath(path))
 
     @property
     def client_id(self) -> int:
@@ -236,52 +626,608 @@ class DiscordRPC:
         return self._version
 
     @property
-    def profiles(self) -> List[Profile]:
-        return self._profiles
+    def profiles(self) -> Tuple[Profile, ...]:
+        return self._store.profiles
+
+    @property
+    def profileStore(self) -> ProfileStore:
+        return self._store
+
+    @property
+    def currentProfile(self) -> Optional[Profile]:
+        return self._currentProfile
+
+    @property
+    def connection(self) -> ConnectionManager:
+        return self._connection
+
+    @property
+    def interval(self) -> float:
+        """Seconds between profile reloads, for scripts without their own tickInterval."""
+        return self._interval
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    @property
+    def wakeups(self) -> int:
+        """Times the loop woke up from sleep. Measures how much the client costs while idle."""
+        return self._wakeups
+
+    @property
+    def scheduler(self) -> Scheduler:
+        return self._scheduler
+
+    @property
+    def registry(self) -> MetricsRegistry:
+        """Runtime metrics of the client, exported by `metrics_export` of config."""
+        return self._registry
 
     @property
     def scriptEngine(self) -> ScriptEngine:
         return self._scriptEngine
 
+    @property
+    def metrics(self) -> MetricsSampler:
+        """System metrics sampled in background. Scripts should read system status from here."""
+        return self._metrics
+
+    @property
+    def updateStats(self) -> UpdateStats:
+        return self._pipeline.stats
+
+    def _readProfiles(self) -> ProfileStore:
+        """
+        Read and validate profiles.json, and build ProfileStore.
+        Profiles not changed since the last read are reused, keeping their script bindings and variables.
+        Nothing is changed in this method, so invalid files can be rejected as a whole.
+
+        Returns:
+            ProfileStore of the file.
+        """
+        return ProfileStore.load(self._profilesPath, Profile.fromJson, previous=self._store, snapshot=self._snapshot)
+
+    def _applyProfiles(self) -> Tuple[bool, Optional[Profile]]:
+        try:
+            store = self._readProfiles()
+        except Exception as e:
+            self.logger.error(f'Rejected invalid profiles file {self._profilesPath} : {e!r}')
+            return False, None
+        added = sum(1 for profile in store if profile not in self._store)
+        removed = sum(1 for profile in self._store if profile not in store)
+        replacement: Optional[Profile] = None
+        if self._currentProfile is not None and self._currentProfile not in store:
+            # Current profile is changed or removed. Use enabled profile at the same position instead.
+            replacement = store.nearestEnabled(self._store.indexOf(self._currentProfile))
+        self._store = store
+        self.logger.info(f'Reloaded profiles : {added} added or changed, {removed} removed or changed.')
+        return True, replacement
+
+    def reloadProfiles(self) -> bool:
+        """
+        Read profiles.json again, and apply only added, removed or changed profiles.
+        If the file is invalid, nothing is changed.
+
+        Returns:
+            True if profiles are reloaded.
+        """
+        reloaded, replacement = self._applyProfiles()
+        if replacement is not None:
+            self.updateProfile(replacement)
+        return reloaded
+
+    def _loadProfileScript(self, profile: Profile) -> Tuple[Script, ...]:
+        """
+        Load scripts of profile and its buttons, if not loaded yet.
+        Scripts are loaded when profile is activated for the first time.
+
+        Returns:
+            Scripts of newly imported modules, which should receive OnStart.
+        """
+        targets = (profile, *(button for button in profile.buttons if button.scriptInfo))
+        imported = []
+        for target in targets:
+            filename = target.scriptInfo[0]
+            if not self._scriptEngine.isLoaded(filename) and filename not in imported:
+                imported.append(filename)
+            try:
+                target.loadScript(self._scriptEngine)
+            except Exception as e:
+                self.logger.error(f'Failed to load script {".".join(target.scriptInfo)} : {e!r}')
+        return tuple(
+            script for filename in imported if self._scriptEngine.isLoaded(filename)
+            for script in self._scriptEngine.getScripts(filename).values()
+        )
+
+    def _loadScripts(self, filename: str) -> Tuple[Optional[Profile], Dict[str, Script]]:
+        scripts = self._scriptEngine.loadModule(filename)
+        current = self._currentProfile
+        if current is None or current.scriptInfo[0] != filename:
+            current = None
+        return current, scripts
+
+    def _rebindScripts(self, filename: str, scripts: Dict[str, Script]) -> None:
+        for profile in self._store:
+            for target in (profile, *profile.buttons):
+                if target.scriptInfo and target.scriptInfo[0] == filename and target.scriptInfo[1] in scripts:
+                    target.setScript(scripts[target.scriptInfo[1]])
+
+    def _replaceScripts(self, filename: str, scripts: Dict[str, Script]) -> None:
+        self._scriptEngine.replaceScripts(filename, scripts)
+        self._rebindScripts(filename, scripts)
+        self.logger.info(f'Reloaded scripts in {filename} : {", ".join(scripts)}')
+
+    def reloadScript(self, filename: str) -> bool:
+        """
+        Reload script module without restarting client. Scripts in other modules keep running with their state.
+        Old scripts of the module receive OnClose, and new ones receive OnStart. Current profile using the script
+        receives OnUnload from the old script before OnClose, and OnLoad from the new one after OnStart.
+
+        Args:
+            filename (str) : Name of the module in scripts package, like `sample`.
+
+        Returns:
+            True if the module is reloaded. If it fails to import, old scripts are kept.
+        """
+        try:
+            current, scripts = self._loadScripts(filename)
+        except Exception as e:
+            self.logger.error(f'Failed to reload scripts in {filename} : {e!r}')
+            return False
+        if current is not None:
+            self._scriptEngine.emit(ScriptEvent.OnUnload, current)
+        # Listeners of old scripts are removed by _replaceScripts(), so they are closed first.
+        self._scriptEngine.emitTo(self._scriptEngine.loadedScripts(filename).values(), ScriptEvent.OnClose)
+        self._replaceScripts(filename, scripts)
+        self._scriptEngine.emitTo(scripts.values(), ScriptEvent.OnStart)
+        if current is not None:
+            self._scriptEngine.emit(ScriptEvent.OnLoad, current)
+            self._scheduleReload(current)
+            self._send(current)
+        return True
+
+    def _onScriptChanged(self, path: str) -> None:
+        # Called on watcher thread. Changes are applied on the loop.
+        filename = os.path.basename(path)[:-len('.py')]
+        # Modules not loaded yet will be imported with their changes when they are used.
+        if self._scriptEngine.isLoaded(filename):
+            self._scriptsChanged.add(filename)
+            self._wake()
+
+    def _onFileChanged(self, path: str) -> None:
+        # Called on watcher thread. Changes are applied on the loop.
+        if path == self._profilesPath:
+            self._profilesChanged = True
+            self._wake()
+
+    def _followConnection(self) -> None:
+        # Reloads are paused while discord is not connected. The latest payload is sent on connection anyway.
+        if self._currentProfile is not None:
+            self._scheduleReload(self._currentProfile)
+
+    def _onConnectionChanged(self, state: ConnectionState, previous: ConnectionState):
+        self.logger.info(f'Connection state : {previous.value} -> {state.value}')
+        self._followConnection()
+        return self._scriptEngine.emit(ScriptEvent.OnConnectionChange, state, previous)
+
+    def _onReplayed(self) -> None:
+        # Payload kept while disconnected is delivered after reconnecting.
+        self._pipeline.delivered()
+
+    def _onDiscordEvent(self, event: str, data: JSON) -> None:
+        # Called on IPC reader. Events are dispatched on the loop.
+        self._discordEvents.append((event, data))
+        self._wake()
+
+    def _clickedButton(self, event: str) -> Optional[Button]:
+        """Button of the current profile the IPC event is sent for, if it has a script."""
+        index = ButtonEvents.get(event)
+        profile = self._currentProfile
+        if index is None or profile is None or index >= len(profile.buttons):
+            return None
+        button = profile.buttons[index]
+        return button if button.script is not None else None
+
+    def _handleDiscordEvent(self, event: str, data: JSON) -> None:
+        button = self._clickedButton(event)
+        if button is None:
+            self.logger.debug(f'Ignored discord event {event} : {data}')
+            return
+        self._scriptEngine.emit(ScriptEvent.OnClick, self._currentProfile, button)
+
+    def _submitControl(self, commands: List[ControlCommand]) -> None:
+        # Called on control server threads. Commands are applied on the loop.
+        self._controlCommands.extend(commands)
+        self._wake()
+
+    def _controlProfile(self, key: Any) -> Profile:
+        if isinstance(key, bool):
+            raise ControlError(f'No profile {key!r}')
+        profile = self._store.find(key) if isinstance(key, str) else None
+        if isinstance(key, int) and 0 <= key < len(self._store):
+            profile = self._store[key]
+        if profile is None:
+            raise ControlError(f'No profile {key!r}')
+        return profile
+
+    def _applyControl(self) -> Tuple[Optional[Profile], Optional[ControlCommand], List[ControlCommand]]:
+        """
+        Apply commands received by the control server since the last iteration of the loop, as one batch.
+        Only the last profile switch of the batch is made, and variables pushed by the batch are sent in one update.
+        A failing command is answered with its error, and the rest of the batch is still applied.
+
+        Returns:
+            Profile to switch to, the command switching to it, and `state` queries.
+            They are answered by _answerControl() once the batch is applied.
+        """
+        target: Optional[Profile] = None
+        switch: Optional[ControlCommand] = None
+        queries: List[ControlCommand] = []
+        while self._controlCommands:
+            command = self._controlCommands.popleft()
+            try:
+                if command.cmd == ControlCommands.Switch:
+                    profile = self._controlProfile(command.args[ControlKeys.Profile])
+                    if not profile.enabled:
+                        raise ControlError(f'Profile {command.args[ControlKeys.Profile]!r} is disabled')
+                    if switch is not None:
+                        switch.resolve()    # Replaced by this one.
+                    target, switch = profile, command
+                    continue
+                elif command.cmd == ControlCommands.Variables:
+                    values = command.args[ControlKeys.Values]
+                    if not isinstance(values, dict):
+                        raise ControlError('values must be an object')
+                    key = command.args.get(ControlKeys.Profile)
+                    profile = (target or self._currentProfile) if key is None else self._controlProfile(key)
+                    if profile is None:
+                        raise ControlError('No profile is shown')
+                    profile.renderPlan.check(values)
+                    profile.setVariables(values)
+                    self._updateRequested = True
+                elif command.cmd == ControlCommands.Pause:
+                    self.pause()
+                elif command.cmd == ControlCommands.Resume:
+                    self.resume()
+                elif command.cmd == ControlCommands.State:
+                    queries.append(command)
+                    continue
+                else:
+                    raise ControlError(f'Unknown command {command.cmd!r}')
+            except KeyError as e:
+                command.reject(f'Missing argument {e.args[0]!r}')
+            except ControlError as e:
+                command.reject(str(e))
+            except Exception as e:
+                command.reject(repr(e))
+            else:
+                command.resolve()
+        return target, switch, queries
+
+    def _answerControl(
+            self,
+            switch: Optional[ControlCommand],
+            queries: List[ControlCommand],
+            error: Optional[Exception]
+    ) -> None:
+        if switch is not None:
+            if error is None:
+                switch.resolve()
+            else:
+                switch.reject(repr(error))
+        for query in queries:
+            query.resolve(self.status())
+
+    def _profileKey(self, profile: Profile) -> Any:
+        """Key to find profile with, in commands of the control server."""
+        return profile.id or profile.name or self._store.indexOf(profile)
+
+    def status(self) -> JSON:
+        """State of the client, answered to `state` command of the control server."""
+        profile = self._currentProfile
+        return {
+            'profile': None if profile is None else self._profileKey(profile),
+            'paused': self._paused,
+            'connection': self._connection.state.value,
+            'variables': {} if profile is None else dict(profile.variables),
+            'profiles': [self._profileKey(profile) for profile in self._store],
+            'updates': self._pipeline.stats.toJson(),
+            'wakeups': self._wakeups
+        }
+
+    def pause(self) -> None:
+        """Stop updating presence until resume(). Reloads and rotation stop, and the presence is left as it is."""
+        self._paused = True
+        self._scheduler.cancel(self._reloadTask)
+        self._scheduler.cancel(self._rotateTask)
+        self._reloadTask = self._rotateTask = None
+        self._slowWatchers()
+
+    def resume(self) -> None:
+        """Start updating presence again, from the current profile."""
+        if not self._paused:
+            return
+        self._paused = False
+        if self._currentProfile is not None:
+            self._scheduleReload(self._currentProfile)
+            self._scheduleRotation(self._currentProfile)
+        self.requestUpdate()
+
+    def requestUpdate(self) -> None:
+        """
+        Send the current profile as soon as possible, instead of waiting for its next reload.
+        Called when something shown by the profile is changed, like variables invalidated by scripts. Thread safe.
+        """
+        self._updateRequested = True
+        self._wake()
+
+    def _wake(self) -> None:
+        self._wakeup.set()
+
+    def _wait(self, timeout: Optional[float]) -> None:
+        if self._wakeup.wait(timeout):
+            self._wakeup.clear()
+
+    def _handleRequests(self) -> None:
+        while self._scriptsChanged:
+            self.reloadScript(self._scriptsChanged.pop())
+        if self._profilesChanged:
+            self._profilesChanged = False
+            self.reloadProfiles()
+        while self._discordEvents:
+            self._handleDiscordEvent(*self._discordEvents.popleft())
+        if self._controlCommands:
+            target, switch, queries = self._applyControl()
+            error: Optional[Exception] = None
+            if target is not None:
+                try:
+                    self.updateProfile(target)
+                except Exception as e:
+                    self.logger.error(f'Failed to switch profile : {e!r}')
+                    error = e
+            self._answerControl(switch, queries, error)
+        if self._updateRequested:
+            self._updateRequested = False
+            if self._currentProfile is not None and self._send(self._currentProfile):
+                self._adaptReload(True)
+
     def start(self) -> None:
         self.logger.info('Starting presence client...')
-        self._client.connect()
+        self._connection.connect()
+        self._metrics.start()
+        if self._exporter is not None:
+            self._exporter.start()
+        if self._control is not None:
+            self._control.start()
+        if self._watcher is not None:
+            self._watcher.start()
+        if self._scriptWatcher is not None:
+            self._scriptWatcher.start()
         self._scriptEngine.emit(ScriptEvent.OnStart)
         if self._currentProfile is None:
-            self.updateProfile(self._profiles[1])
-        self.logger.info('Lapis0875@rpc > Connected!')
+            self.updateProfile(self._defaultProfile())
+        self.logger.info('Lapis0875@rpc > Started!')
 
-    def updateProfile(self, profile: Profile):
-        self.logger.info('Updating presence profile...')
-        if profile == self._currentProfile:
-            response = self._client.update(**profile.toJson())
-            self.logger.debug(f'{type(response) =}')
-            self.logger.debug(f'{response =}')
+    def _sendPayload(self, payload: Optional[JSON]) -> None:
+        if payload is None:
+            return
+        started = perf_counter()
+        try:
+            result = self._connection.send(payload)
+        except Exception as e:
+            # Discord rejected the payload. Connection errors are handled by ConnectionManager.
+            self._updateErrors += 1
+            self._pipeline.invalidate()
+            self.logger.error(f'Failed to update presence : {e!r}')
             return
+        if result is SendResult.Delivered:
+            self._pipeline.delivered()
+            self._updateLatency.observe(perf_counter() - started)
+        else:
+            self._pipeline.queued()
 
-        if self._currentProfile is not None:
-            self._scriptEngine.emit(ScriptEvent.OnUnload, self._currentProfile)
-        self._scriptEngine.emit(ScriptEvent.OnLoad, profile)
-        self._currentProfile = profile
-        response = self._client.update(**profile.toJson())
-        self.logger.debug(f'{type(response) =}')
-        self.logger.debug(f'{response =}')
+    def _provideVariables(self, profile: Profile) -> None:
+        """Set variables provided by scripts, which are used by templates of profile."""
+        variables = self._scriptEngine.variables
+        if not variables:
+            return
+        plan = profile.renderPlan
+        values = variables.resolve(plan.dependencies, plan.check)
+        if values:
+            profile.setVariables(values)
+
+    def _send(self, profile: Profile) -> bool:
+        """
+        Render profile and send it, unless it is the same as the last sent payload.
+
+        Returns:
+            False if the payload is dropped as unchanged, or updates are paused.
+        """
+        if self._paused:
+            return False
+        self._provideVariables(profile)
+        suppressed = self._pipeline.stats.suppressed
+        self._sendPayload(self._pipeline.submit(profile.toJson()))
+        return self._pipeline.stats.suppressed == suppressed
+
+    def flush(self) -> None:
+        """Send the latest payload held back by rate limit, if it can be sent now."""
+        self._sendPayload(self._pipeline.flush())
+
+    def _tickInterval(self, profile: Profile) -> float:
+        interval = getattr(profile.script, 'tickInterval', None)
+        return self._interval if interval is None else interval
+
+    def _reloadInterval(self, profile: Profile) -> float:
+        interval = self._tickInterval(profile)
+        return max(interval, min(self._idleInterval, interval * 2 ** self._idleLevel))
+
+    def _scheduleReload(self, profile: Profile, idleLevel: int = 0) -> None:
+        """
+        Reload profile at the tick interval of its script, doubled `idleLevel` times (up to `idle_interval`).
+        Nothing is scheduled while discord is not connected, or updates are paused.
+        """
+        self._scheduler.cancel(self._reloadTask)
+        self._reloadTask = None
+        self._idleLevel = idleLevel
+        if self._connection.connected and not self._paused:
+            self._reloadTask = self._scheduler.every(self._reloadInterval(profile), self.reloadProfile)
+        self._slowWatchers()
+
+    def _slowWatchers(self) -> None:
+        """
+        Back off polling of the file watchers together with reloads. They poll at `idle_interval` while
+        nothing is reloaded, as changed files are only applied on the next update anyway.
+        """
+        if self._reloadTask is None:
+            interval = self._idleInterval
+        else:
+            interval = min(self._idleInterval, self._watchInterval * 2 ** self._idleLevel)
+        for watcher in (self._watcher, self._scriptWatcher):
+            if watcher is not None:
+                watcher.interval = max(self._watchInterval, interval)
+
+    def _adaptReload(self, changed: bool) -> None:
+        """
+        Back off reloads which keep sending the same payload, and return to the tick interval once it changes.
+        """
+        profile = self._currentProfile
+        if changed:
+            level = 0
+        elif self._reloadInterval(profile) < self._idleInterval:
+            level = self._idleLevel + 1
+        else:
+            return
+        if level != self._idleLevel:
+            self._scheduleReload(profile, level)
+
+    def _scheduleRotation(self, profile: Profile) -> None:
+        """Rotate to another profile when schedule of the profile says so."""
+        self._scheduler.cancel(self._rotateTask)
+        self._rotateTask = None
+        dwell = self._rotation.dwell(profile)
+        if dwell is not None and not self._paused:
+            self._rotateTask = self._scheduler.callLater(dwell, self.rotateProfile)
+
+    def _nextProfile(self) -> Optional[Profile]:
+        profile = self._rotation.choose(self._store.scheduledProfiles, self._currentProfile)
+        if profile is None or profile is self._currentProfile:
+            # Nothing else to show for now. Check again later.
+            self._scheduler.cancel(self._rotateTask)
+            self._rotateTask = self._scheduler.callLater(ProfileRotation.RetryAfter, self.rotateProfile)
+            return None
+        return profile
+
+    def rotateProfile(self) -> None:
+        """Show the next profile chosen by schedules of profiles."""
+        profile = self._nextProfile()
+        if profile is not None:
+            self.updateProfile(profile)
+
+    def _defaultProfile(self) -> Profile:
+        return self._store.default(self._config.get(ConfigKeys.DefaultProfile))
+
+    def _canActivate(self, profile: Profile) -> bool:
+        if not profile.enabled:
+            self.logger.warning(f'Profile {profile.id or self._store.indexOf(profile)} is disabled. Ignoring it.')
+            return False
+        return True
+
+    def findProfile(self, key: str) -> Optional[Profile]:
+        """
+        Find profile by its id or name. Profiles without id can be found by their position, like `'0'`.
+
+        Returns:
+            Profile found, or None.
+        """
+        return self._store.find(key)
+
+    def switchProfile(self, key: str) -> bool:
+        """
+        Show profile of given id or name.
+
+        Returns:
+            True if the profile is found and enabled.
+        """
+        profile = self._store.find(key)
+        if profile is None or not self._canActivate(profile):
+            return False
+        self.updateProfile(profile)
+        return True
+
+    def updateProfile(self, profile: Profile):
+        if not self._canActivate(profile):
+            return
+        self.logger.info('Updating presence profile...')
+        if profile != self._currentProfile:
+            loaded = self._loadProfileScript(profile)
+            if loaded:
+                self._scriptEngine.emitTo(loaded, ScriptEvent.OnStart)
+            if self._currentProfile is not None:
+                self._scriptEngine.emit(ScriptEvent.OnUnload, self._currentProfile)
+            self._scriptEngine.emit(ScriptEvent.OnLoad, profile)
+            self._currentProfile = profile
+            self._scheduleReload(profile)
+            self._scheduleRotation(profile)
+        self._send(profile)
 
     def reloadProfile(self):
-        print('='*20)
         self.logger.info('Reloading presence profile...')
         self._scriptEngine.emit(ScriptEvent.OnReload, self._currentProfile)
-        print(self._currentProfile.toJson())
-        response = self._client.update(**self._currentProfile.toJson())
+        self._adaptReload(self._send(self._currentProfile))
+
+    def _waitTimeout(self) -> Optional[float]:
+        """
+        Seconds the loop can sleep, until a scheduled task, a payload held back by rate limit
+        or events queued for batched listeners are due.
+        """
+        timeout = self._scheduler.timeUntilNext()
+        for due in (self._pipeline.retryAfter, self._scriptEngine.timeUntilBatch()):
+            if due is not None:
+                timeout = due if timeout is None else min(timeout, due)
+        return timeout
+
+    def runOnce(self) -> None:
+        """Sleep until something is due or requested, and handle it. One iteration of loop()."""
+        self._wait(self._waitTimeout())
+        self._wakeups += 1
+        self._handleRequests()
+        tasks = self._scheduler.due()
+        if tasks:
+            self._loopDrift.observe(self._scheduler.lateness)
+        for task in tasks:
+            task.callback()
+        self._scriptEngine.flushBatches()
+        self.flush()
 
     def loop(self):
         while True:
-            # Temporary loop.
-            self.reloadProfile()
-            sleep(15)
+            self.runOnce()
+
+    def dumpStats(self) -> None:
+        """Log timing statistics of script listeners."""
+        report = self._scriptEngine.scriptStats.report()
+        if report:
+            self.logger.info(f'Script statistics :\n{report}')
 
     def close(self) -> None:
         self.logger.info('Closing presence client...')
+        self._scheduler.clear()
+        if self._currentProfile is not None:
+            self._scriptEngine.emit(ScriptEvent.OnUnload, self._currentProfile)
+        self._connection.close()
         self._scriptEngine.emit(ScriptEvent.OnClose)
-        self._client.close()
-        self.logger.info('Closed!')
+        self._scriptEngine.flushBatches(force=True)
+        self._scriptEngine.shutdown()
+        self._metrics.stop()
+        if self._exporter is not None:
+            self._exporter.stop()
+        if self._control is not None:
+            self._control.stop()
+        if self._watcher is not None:
+            self._watcher.stop()
+        if self._scriptWatcher is not None:
+            self._scriptWatcher.stop()
+        self.dumpStats()
+        self.logger.info(f'Closed! {self._pipeline.stats}, {self._wakeups} wakeups')
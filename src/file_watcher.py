@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+from typing import Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger('pyrorpc.watcher')
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _loadInotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch     # Check whether libc supports inotify.
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """
+    Watches files and directories on background thread, and calls callback with path of changed file.
+    Uses inotify where available, and falls back to polling os.stat() results.
+    Changes are debounced, so saving a file calls callback once even if editor writes it several times.
+    """
+
+    def __init__(
+            self,
+            callback: Callable[[str], None],
+            interval: float = 1.0,
+            debounce: float = 0.2,
+            suffix: Optional[str] = None,
+            usePolling: bool = False
+    ) -> None:
+        """
+        Initialize FileWatcher.
+
+        Args:
+            callback (Callable[[str], None]) : Function called with path of changed file. Called on watcher thread.
+            interval (float) : Seconds between two polls, when inotify is not available.
+            debounce (float) : Seconds to wait for further changes before calling callback.
+            suffix (Optional[str]) : Only files ending with this suffix are reported in watched directories.
+            usePolling (bool) : Always use polling instead of inotify.
+        """
+        self._callback: Callable[[str], None] = callback
+        self._interval: float = interval
+        self._debounce: float = debounce
+        self._suffix: Optional[str] = suffix
+        self._files: Set[str] = set()
+        self._directories: Set[str] = set()
+        self._libc = None if usePolling else _loadInotify()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._pollWakeup = threading.Event()    # Polls right away, with the new interval.
+        self._wakeFds: Optional[Tuple[int, int]] = None
+        self._wakeups: int = 0
+
+    @property
+    def usesInotify(self) -> bool:
+        return self._libc is not None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    @interval.setter
+    def interval(self, new: float):
+        """Seconds between two polls. Clients slow polling down while they are idle. inotify is not affected."""
+        if new <= 0:
+            raise ValueError('FileWatcher.interval must be positive!')
+        if new != self._interval:
+            self._interval = new
+            self._pollWakeup.set()
+
+    @property
+    def wakeups(self) -> int:
+        """Times the watcher thread woke up, to poll files or read inotify events."""
+        return self._wakeups
+
+    def watch(self, path: str) -> None:
+        """
+        Add file or directory to watch. Must be called before start().
+
+        Args:
+            path (str) : Path of file or directory.
+        """
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            self._directories.add(path)
+        else:
+            self._files.add(path)
+
+    def _accepts(self, path: str) -> bool:
+        if path in self._files:
+            return True
+        return os.path.dirname(path) in self._directories and (
+            self._suffix is None or path.endswith(self._suffix)
+        )
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stopped.clear()
+        target = self._runInotify if self._libc is not None else self._runPolling
+        self._thread = threading.Thread(target=target, name='pyrorpc-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._pollWakeup.set()
+        if self._wakeFds is not None:
+            os.write(self._wakeFds[1], b'\0')
+        self._thread.join()
+        self._thread = None
+
+    def _notify(self, paths: Set[str]) -> None:
+        for path in sorted(paths):
+            try:
+                self._callback(path)
+            except Exception as e:
+                logger.error(f'Watcher callback failed for {path} : {e!r}')
+
+    # Polling fallback
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        paths = set(self._files)
+        for directory in self._directories:
+            try:
+                paths.update(os.path.join(directory, name) for name in os.listdir(directory))
+            except OSError:
+                continue
+        snapshot = {}
+        for path in paths:
+            if not self._accepts(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _runPolling(self) -> None:
+        previous = self._snapshot()
+        while True:
+            self._pollWakeup.wait(self._interval)
+            self._pollWakeup.clear()
+            if self._stopped.is_set():
+                return
+            self._wakeups += 1
+            current = self._snapshot()
+            if current == previous:
+                continue
+            # Wait until writer has finished, then compare again.
+            if self._stopped.wait(self._debounce):
+                return
+            current = self._snapshot()
+            changed = {path for path in current.keys() | previous.keys() if current.get(path) != previous.get(path)}
+            previous = current
+            if changed:
+                self._notify(changed)
+
+    # inotify
+
+    def _runInotify(self) -> None:
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning(f'inotify is not available ({os.strerror(ctypes.get_errno())}), polling files instead.')
+            self._libc = None
+            return self._runPolling()
+        self._wakeFds = os.pipe()
+        descriptors: Dict[int, str] = {}
+        try:
+            for directory in self._directories | {os.path.dirname(path) for path in self._files}:
+                wd = self._libc.inotify_add_watch(fd, os.fsencode(directory), _WATCH_MASK)
+                if wd < 0:
+                    logger.error(f'Cannot watch {directory} : {os.strerror(ctypes.get_errno())}')
+                    continue
+                descriptors[wd] = directory
+            changed: Set[str] = set()
+            while not self._stopped.is_set():
+                # Once something is changed, wait for debounce period and report everything changed in it.
+                readable, _, _ = select.select([fd, self._wakeFds[0]], [], [], self._debounce if changed else None)
+                self._wakeups += 1
+                if self._wakeFds[0] in readable:
+                    break
+                if not readable:
+                    self._notify(changed)
+                    changed = set()
+                    continue
+                try:
+                    data = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                    offset += _EVENT_HEADER.size
+                    name = data[offset:offset + length].rstrip(b'\0')
+                    offset += length
+                    directory = descriptors.get(wd)
+                    if directory is None or not name:
+                        continue
+                    path = os.path.join(directory, os.fsdecode(name))
+                    if self._accepts(path):
+                        changed.add(path)
+        finally:
+            os.close(fd)
+            os.close(self._wakeFds[0])
+            os.close(self._wakeFds[1])
+            self._wakeFds = None
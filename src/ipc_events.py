@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pypresence import AioPresence, Presence
+from pypresence.exceptions import PipeClosed, ResponseTimeout, ServerError
+from pypresence.payloads import Payload
+from src.constants import IpcEvents
+from src.type_hints import JSON
+
+logger = logging.getLogger('pyrorpc.ipc')
+
+_Header = struct.Struct('<II')
+_OpFrame: int = 1
+_OpClose: int = 2
+
+# Events subscribed on every connection.
+Subscriptions: Tuple[str, ...] = (IpcEvents.ActivityJoin, IpcEvents.ActivitySpectate, IpcEvents.ActivityJoinRequest)
+
+EventHandler = Callable[[str, JSON], Any]
+
+
+class FrameDecoder:
+    """Incremental decoder of IPC frames. Bytes are fed as they are received, and complete frames are returned."""
+
+    def __init__(self, maxLength: Optional[int] = None) -> None:
+        """
+        Initialize FrameDecoder.
+
+        Args:
+            maxLength (Optional[int]) : Longest payload accepted, in bytes. Longer frames raise ValueError
+                before they are buffered.
+        """
+        self._buffer: bytearray = bytearray()
+        self._maxLength: Optional[int] = maxLength
+
+    def feed(self, data: bytes) -> List[Tuple[int, JSON]]:
+        """
+        Add received bytes.
+
+        Returns:
+            (opcode, payload) of frames completed by the bytes, in order. Incomplete frame is kept for the next call.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames: List[Tuple[int, JSON]] = []
+        offset = 0
+        while len(buffer) - offset >= _Header.size:
+            op, length = _Header.unpack_from(buffer, offset)
+            if self._maxLength is not None and length > self._maxLength:
+                raise ValueError(f'Frame of {length} bytes is longer than {self._maxLength} bytes')
+            end = offset + _Header.size + length
+            if len(buffer) < end:
+                break
+            frames.append((op, json.loads(buffer[offset + _Header.size:end])))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+
+class _EventReceiver(metaclass=ABCMeta):
+    """
+    Reading side of presence clients receiving IPC events.
+
+    pypresence reads the next frame as the response of each command, so an event arriving before the response
+    would be taken as the response. Here frames are read by a reader running on its own (thread or task), and routed:
+    DISPATCH frames go to the event handler, and responses go to the command waiting for their nonce.
+    """
+
+    def _initReceiver(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        self._eventHandler: Optional[EventHandler] = kwargs.pop('eventHandler', None)
+        self._decoder: FrameDecoder = FrameDecoder()
+        self._waiters: Dict[str, Future] = {}
+        self._nonce: Optional[str] = None
+        self._readerError: Optional[BaseException] = None
+        self._reading: bool = False
+        return kwargs
+
+    @abstractmethod
+    def _newWaiter(self) -> Future:
+        """Future resolved with the response of a command, by the reader."""
+        pass
+
+    def send_data(self, op: int, payload) -> None:
+        if isinstance(payload, Payload):
+            payload = payload.data
+        nonce = payload.get('nonce')
+        if self._reading and nonce is not None:
+            if self._readerError is not None:
+                raise self._readerError
+            self._waiters[nonce] = self._newWaiter()
+            self._nonce = nonce
+        super().send_data(op, payload)
+
+    async def read_output(self) -> JSON:
+        waiter = self._waiters.get(self._nonce) if self._reading else None
+        if waiter is None:
+            return await super().read_output()
+        try:
+            payload = await asyncio.wait_for(asyncio.wrap_future(waiter), self.response_timeout)
+        except asyncio.TimeoutError:
+            raise ResponseTimeout
+        finally:
+            self._waiters.pop(self._nonce, None)
+        if payload['evt'] == 'ERROR':
+            raise ServerError(payload['data']['message'])
+        return payload
+
+    def _subscribe(self) -> None:
+        for event in Subscriptions:
+            # Responses are not waited for. Rejected subscriptions are logged by the reader.
+            super().send_data(_OpFrame, Payload.subscribe(event))
+
+    def _route(self, op: int, payload: JSON) -> None:
+        if op == _OpClose:
+            raise PipeClosed
+        if op != _OpFrame:
+            return
+        if payload.get('cmd') == 'DISPATCH':
+            if self._eventHandler is not None and payload.get('evt') != 'READY':
+                self._eventHandler(payload['evt'], payload.get('data') or {})
+            return
+        waiter = self._waiters.get(payload.get('nonce'))
+        if waiter is not None:
+            self._resolve(waiter, payload)
+        elif payload.get('evt') == 'ERROR':
+            logger.debug(f'Discord rejected {payload.get("cmd")} : {payload["data"].get("message")}')
+
+    def _resolve(self, waiter: Future, payload: JSON) -> None:
+        if not waiter.done():
+            waiter.set_result(payload)
+
+    def _feed(self, data: bytes) -> None:
+        for op, payload in self._decoder.feed(data):
+            self._route(op, payload)
+
+    def _fail(self, error: BaseException) -> None:
+        """Connection is gone. Commands waiting for responses, and commands sent from now on, fail with the error."""
+        self._readerError = error
+        for waiter in tuple(self._waiters.values()):
+            if not waiter.done():
+                waiter.set_exception(error)
+
+
+class EventPresence(_EventReceiver, Presence):
+    """
+    pypresence.Presence receiving IPC events. Frames are read by a thread blocked on the socket, so events are
+    delivered as soon as they arrive, without waiting for the next update.
+
+    While a command waits for its response, the calling thread reads the socket itself instead of being handed
+    the response by the reader thread, so updates take no longer than with pypresence.
+    The event handler is called on whichever thread read the event.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **self._initReceiver(kwargs))
+        self._socket: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._readLock = threading.Lock()
+
+    def _newWaiter(self) -> Future:
+        return Future()
+
+    def connect(self) -> None:
+        super().connect()
+        transport = self.sock_writer.transport
+        sock = transport.get_extra_info('socket')
+        if sock is None:
+            return  # Named pipes of windows. Responses are read by pypresence, and events are not received.
+        # The transport only writes from now on. Reading is done on its own descriptor.
+        transport.pause_reading()
+        self._socket = socket.socket(fileno=os.dup(sock.fileno()))
+        self._reading = True
+        self._thread = threading.Thread(target=self._read, name='pyrorpc-ipc', daemon=True)
+        self._thread.start()
+        self._subscribe()
+
+    def _receive(self, sock: socket.socket) -> None:
+        """Read what is available on the socket. Called with _readLock held."""
+        try:
+            data = sock.recv(65536)
+        except BlockingIOError:
+            return  # Taken by the other thread.
+        if not data:
+            raise PipeClosed
+        self._feed(data)
+
+    async def read_output(self) -> JSON:
+        waiter = self._waiters.get(self._nonce) if self._reading else None
+        if waiter is None:
+            return await super().read_output()
+        sock = self._socket
+        deadline = monotonic() + self.response_timeout
+        try:
+            while not waiter.done():
+                remaining = deadline - monotonic()
+                if remaining <= 0 or sock is None:
+                    raise ResponseTimeout
+                with self._readLock:
+                    if not waiter.done() and select.select((sock,), (), (), remaining)[0]:
+                        self._receive(sock)
+        except (PipeClosed, OSError, ValueError):
+            self._fail(PipeClosed())
+        finally:
+            self._waiters.pop(self._nonce, None)
+        payload = waiter.result()
+        if payload['evt'] == 'ERROR':
+            raise ServerError(payload['data']['message'])
+        return payload
+
+    def _read(self) -> None:
+        sock = self._socket
+        try:
+            while True:
+                # The descriptor is shared with the transport, and stays non-blocking.
+                select.select((sock,), (), ())
+                with self._readLock:
+                    self._receive(sock)
+        except (PipeClosed, OSError, ValueError):
+            self._fail(PipeClosed())
+        except Exception as e:
+            logger.error(f'IPC reader stopped : {e!r}')
+            self._fail(PipeClosed())
+
+    def stopEvents(self) -> None:
+        """Stop the reader thread. Called when the connection is closed or discarded."""
+        sock, self._socket = self._socket, None
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)     # Wakes the reader up.
+        except OSError:
+            pass
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        sock.close()
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.stopEvents()
+
+
+class AioEventPresence(_EventReceiver, AioPresence):
+    """pypresence.AioPresence receiving IPC events. Frames are read by a task on the event loop of the client."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **self._initReceiver(kwargs))
+        self._readerTask: Optional[asyncio.Task] = None
+
+    def _newWaiter(self) -> asyncio.Future:
+        return self.loop.create_future()
+
+    async def connect(self) -> None:
+        await super().connect()
+        self._reading = True
+        self._readerTask = self.loop.create_task(self._read())
+        self._subscribe()
+
+    async def _read(self) -> None:
+        reader = self.sock_reader
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    raise PipeClosed
+                self._feed(data)
+        except (PipeClosed, OSError, ValueError):
+            self._fail(PipeClosed())
+        except Exception as e:
+            logger.error(f'IPC reader stopped : {e!r}')
+            self._fail(PipeClosed())
+
+    def stopEvents(self) -> None:
+        task, self._readerTask = self._readerTask, None
+        if task is not None:
+            task.cancel()
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.stopEvents()
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import importlib
+import logging
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from src.constants import ConfigKeys, ControlKeys
+from src.control import ControlCommand, ControlServer
+from src.discordrpc import (
+    DiscordRPC, Profile, loopDriftHistogram, loopWakeupsCounter, setupLogger, threadWakeupsCounter
+)
+from src.file_watcher import FileWatcher
+from src.scheduler import Scheduler
+from src.script_support import Script, ScriptEngine, ScriptEvent
+from src.system_metrics import MetricsSampler
+from src.telemetry import HistogramChild, MetricsExporter, MetricsRegistry
+from src.type_hints import JSON
+
+
+class PooledRPC(DiscordRPC):
+    """
+    Presence connection of PresencePool. It has its own presence client, profiles and update pipeline,
+    and uses scripts, metrics and scheduler of the pool.
+    """
+
+    def __init__(self, pool: PresencePool, name: str, config: JSON) -> None:
+        self._pool: PresencePool = pool
+        self._name: str = name
+        super().__init__(config, metrics=pool.metrics)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def pool(self) -> PresencePool:
+        return self._pool
+
+    def _createLogger(self) -> logging.Logger:
+        # Propagates to the logger of the pool.
+        return logging.getLogger(f'pyrorpc.{self._name}')
+
+    def _createScriptEngine(self, scriptModule) -> ScriptEngine:
+        return self._pool.scriptEngine
+
+    def _createScheduler(self) -> Scheduler:
+        return self._pool.scheduler
+
+    def _createRegistry(self) -> MetricsRegistry:
+        return self._pool.registry
+
+    def _createExporter(self) -> Optional[MetricsExporter]:
+        return None     # Metrics of every connection are exported by the pool.
+
+    def _createControlServer(self) -> Optional[ControlServer]:
+        return None     # Commands are routed to connections by the control server of the pool.
+
+    def _metricLabels(self) -> Dict[str, str]:
+        return {'client': self._name}
+
+    def _registerLoopMetrics(self) -> HistogramChild:
+        watcher = self._watcher
+        if watcher is not None:
+            threadWakeupsCounter(self._registry).track(lambda: watcher.wakeups, thread='watcher', client=self._name)
+        return self._pool._loopDrift     # Loop of the pool.
+
+    def _wake(self) -> None:
+        self._pool._wake()
+
+    def start(self) -> None:
+        self.logger.info('Starting presence client...')
+        self._connection.connect()
+        if self._watcher is not None:
+            self._watcher.start()
+        if self._currentProfile is None:
+            self.updateProfile(self._defaultProfile())
+        self.logger.info('Started!')
+
+    def close(self) -> None:
+        self.logger.info('Closing presence client...')
+        self._scheduler.cancel(self._reloadTask)
+        self._scheduler.cancel(self._rotateTask)
+        if self._currentProfile is not None:
+            self._scriptEngine.emit(ScriptEvent.OnUnload, self._currentProfile)
+        if self._watcher is not None:
+            self._watcher.stop()
+        self._connection.close()
+        self.logger.info(f'Closed! {self._pipeline.stats}')
+
+
+class PresencePool:
+    """
+    Several presence connections served from one process. Each connection (PooledRPC) has its own client id,
+    IPC pipe and profiles, while script instances, metrics and scheduler are shared by all of them.
+
+    Scripts of the pool receive the pool as their client, so `self.client.metrics` and `self.client.logger` work
+    the same as in single client mode.
+    """
+
+    def __init__(self, config: JSON, metrics: Optional[MetricsSampler] = None) -> None:
+        """
+        Initialize PresencePool.
+
+        Args:
+            config (Dict[str, Any]) : Parsed config.json data with `clients` array. Keys of each client override
+                the top level keys, so settings shared by every connection can be written once.
+            metrics (Optional[MetricsSampler]) : Metrics sampler to share. New one is created if not given.
+        """
+        self.logger = setupLogger()
+        self._config = config
+        self._version = config[ConfigKeys.Version]
+        self._metrics: MetricsSampler = MetricsSampler() if metrics is None else metrics
+        self._wakeup = threading.Event()
+        self._wakeups: int = 0
+        self._scheduler: Scheduler = Scheduler(wakeup=self._wake)
+        scriptModule = importlib.import_module('scripts')
+        self._scriptEngine: ScriptEngine = ScriptEngine.fromConfig(
+            self, scriptModule, config, clock=self._scheduler.clock
+        )
+        self._scriptsChanged: Set[str] = set()
+        self._registry: MetricsRegistry = MetricsRegistry()
+        self._scriptEngine.registerMetrics(self._registry)
+        self._loopDrift: HistogramChild = loopDriftHistogram(self._registry).labels()
+        loopWakeupsCounter(self._registry).track(lambda: self._wakeups)
+        threads = threadWakeupsCounter(self._registry)
+        threads.track(lambda: self._metrics.wakeups, thread='metrics')
+        threads.track(
+            lambda: None if self._scriptWatcher is None else self._scriptWatcher.wakeups, thread='scripts_watcher'
+        )
+        exportConfig = config.get(ConfigKeys.MetricsExport)
+        self._exporter: Optional[MetricsExporter] = (
+            MetricsExporter.fromConfig(self._registry, exportConfig) if exportConfig else None
+        )
+
+        controlPath = config.get(ConfigKeys.Control)
+        self._control: Optional[ControlServer] = None if not controlPath else ControlServer(
+            controlPath, self._submitControl
+        )
+
+        self._clients: List[PooledRPC] = []
+        self._clientsByName: Dict[str, PooledRPC] = {}
+        shared = {key: value for key, value in config.items() if key != ConfigKeys.Clients}
+        for index, clientConfig in enumerate(config[ConfigKeys.Clients]):
+            name: str = clientConfig.get(ConfigKeys.Name, str(index))
+            if name in self._clientsByName:
+                raise ValueError(f'Client name {name!r} is used more than once')
+            # Scripts are watched once by the pool.
+            client = PooledRPC(self, name, {**shared, **clientConfig, ConfigKeys.WatchScripts: False})
+            self._clients.append(client)
+            self._clientsByName[name] = client
+
+        self._scriptsPath: str = os.path.dirname(os.path.abspath(scriptModule.__file__))
+        self._scriptWatcher: Optional[FileWatcher] = None
+        if config.get(ConfigKeys.WatchScripts, False):
+            self._scriptWatcher = FileWatcher(self._onScriptChanged, suffix='.py')
+            self._scriptWatcher.watch(self._scriptsPath)
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    @property
+    def clients(self) -> Tuple[PooledRPC, ...]:
+        return tuple(self._clients)
+
+    def client(self, name: str) -> Optional[PooledRPC]:
+        return self._clientsByName.get(name)
+
+    def __iter__(self) -> Iterator[PooledRPC]:
+        return iter(self._clients)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    @property
+    def scriptEngine(self) -> ScriptEngine:
+        return self._scriptEngine
+
+    @property
+    def metrics(self) -> MetricsSampler:
+        """System metrics sampled in background, shared by every connection."""
+        return self._metrics
+
+    @property
+    def scheduler(self) -> Scheduler:
+        return self._scheduler
+
+    @property
+    def registry(self) -> MetricsRegistry:
+        """Runtime metrics of every connection, labeled by client name."""
+        return self._registry
+
+    @property
+    def wakeups(self) -> int:
+        """Times the loop woke up from sleep."""
+        return self._wakeups
+
+    def _onScriptChanged(self, path: str) -> None:
+        # Called on watcher thread. Changes are applied on the loop.
+        filename = os.path.basename(path)[:-len('.py')]
+        if self._scriptEngine.isLoaded(filename):
+            self._scriptsChanged.add(filename)
+            self._wake()
+
+    def _submitControl(self, commands: List[ControlCommand]) -> None:
+        # Called on control server threads. Commands go to the connection named by their `client` argument.
+        batches: Dict[PooledRPC, List[ControlCommand]] = {}
+        for command in commands:
+            name = command.args.get(ControlKeys.Client)
+            client = self._clients[0] if name is None else self._clientsByName.get(name)
+            if client is None:
+                command.reject(f'No client {name!r}')
+            else:
+                batches.setdefault(client, []).append(command)
+        for client, batch in batches.items():
+            client._submitControl(batch)
+
+    def requestUpdate(self) -> None:
+        """Send current profiles of every connection as soon as possible. See DiscordRPC.requestUpdate()."""
+        for client in self._clients:
+            client._updateRequested = True
+        self._wake()
+
+    def _wake(self) -> None:
+        self._wakeup.set()
+
+    def _wait(self, timeout: Optional[float]) -> None:
+        if self._wakeup.wait(timeout):
+            self._wakeup.clear()
+
+    def reloadScript(self, filename: str) -> bool:
+        """
+        Reload script module for every connection. Old scripts receive OnClose and new ones receive OnStart, once for
+        all connections. Current profiles using the module receive OnUnload and OnLoad. See DiscordRPC.reloadScript().
+        """
+        try:
+            scripts: Dict[str, Script] = self._scriptEngine.loadModule(filename)
+        except Exception as e:
+            self.logger.error(f'Failed to reload scripts in {filename} : {e!r}')
+            return False
+        current: List[Tuple[PooledRPC, Profile]] = [
+            (client, client.currentProfile) for client in self._clients
+            if client.currentProfile is not None and client.currentProfile.scriptInfo[0] == filename
+        ]
+        for _, profile in current:
+            self._scriptEngine.emit(ScriptEvent.OnUnload, profile)
+        self._scriptEngine.emitTo(self._scriptEngine.loadedScripts(filename).values(), ScriptEvent.OnClose)
+        self._scriptEngine.replaceScripts(filename, scripts)
+        for client in self._clients:
+            client._rebindScripts(filename, scripts)
+        self.logger.info(f'Reloaded scripts in {filename} : {", ".join(scripts)}')
+        self._scriptEngine.emitTo(scripts.values(), ScriptEvent.OnStart)
+        for client, profile in current:
+            self._scriptEngine.emit(ScriptEvent.OnLoad, profile)
+            client._scheduleReload(profile)
+            client._send(profile)
+        return True
+
+    def _handleRequests(self) -> None:
+        while self._scriptsChanged:
+            self.reloadScript(self._scriptsChanged.pop())
+        for client in self._clients:
+            client._handleRequests()
+
+    def _waitTimeout(self) -> Optional[float]:
+        timeout = self._scheduler.timeUntilNext()
+        dues = [client._pipeline.retryAfter for client in self._clients]
+        dues.append(self._scriptEngine.timeUntilBatch())
+        for due in dues:
+            if due is not None:
+                timeout = due if timeout is None else min(timeout, due)
+        return timeout
+
+    def start(self) -> None:
+        self.logger.info(f'Starting {len(self._clients)} presence clients...')
+        self._metrics.start()
+        if self._exporter is not None:
+            self._exporter.start()
+        if self._control is not None:
+            self._control.start()
+        if self._scriptWatcher is not None:
+            self._scriptWatcher.start()
+        self._scriptEngine.emit(ScriptEvent.OnStart)
+        for client in self._clients:
+            client.start()
+
+    def flush(self) -> None:
+        for client in self._clients:
+            client.flush()
+
+    def runOnce(self) -> None:
+        """One iteration of loop(). See DiscordRPC.runOnce()."""
+        self._wait(self._waitTimeout())
+        self._wakeups += 1
+        self._handleRequests()
+        tasks = self._scheduler.due()
+        if tasks:
+            self._loopDrift.observe(self._scheduler.lateness)
+        for task in tasks:
+            task.callback()
+        self._scriptEngine.flushBatches()
+        self.flush()
+
+    def loop(self) -> None:
+        while True:
+            self.runOnce()
+
+    def close(self) -> None:
+        self.logger.info('Closing presence clients...')
+        for client in self._clients:
+            client.close()
+        self._scheduler.clear()
+        self._scriptEngine.emit(ScriptEvent.OnClose)
+        self._scriptEngine.flushBatches(force=True)
+        self._scriptEngine.shutdown()
+        self._metrics.stop()
+        if self._exporter is not None:
+            self._exporter.stop()
+        if self._control is not None:
+            self._control.stop()
+        if self._scriptWatcher is not None:
+            self._scriptWatcher.stop()
+        report = self._scriptEngine.scriptStats.report()
+        if report:
+            self.logger.info(f'Script statistics :\n{report}')
@@ -0,0 +1,377 @@
+from __future__ import annotations
+
+import json
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.constants import (
+    ActivityLimits, ButtonKeys, ConfigKeys, PartyKeys, ProfileKeys, ResourceKeys, ScheduleKeys, SecretKeys
+)
+from src.scheduler import parseTimeOfDay
+from src.type_hints import JSON
+
+if TYPE_CHECKING:
+    from src.discordrpc import Profile
+    from src.snapshot import ProfileSnapshot
+
+ProfileFactory = Callable[[JSON], 'Profile']
+
+_TextKeys: Tuple[str, ...] = (ProfileKeys.Details, ProfileKeys.State, ProfileKeys.LargeText, ProfileKeys.SmallText)
+_RequiredTextKeys: Tuple[str, ...] = (ProfileKeys.Details, ProfileKeys.State)
+_IconKeys: Tuple[str, ...] = (ProfileKeys.LargeIcon, ProfileKeys.SmallIcon)
+
+
+class ProfileValidationError(ValueError):
+    """profiles.json does not follow the format, or exceeds limits of discord activity."""
+
+    def __init__(self, problems: List[str]) -> None:
+        super().__init__(f'{len(problems)} problem(s) in profiles : ' + '; '.join(problems))
+        self.problems: List[str] = problems
+
+
+def _checkText(problems: List[str], where: str, value, required: bool, minLength: int, maxLength: int) -> None:
+    if value is None:
+        if required:
+            problems.append(f'{where} is required')
+    elif not isinstance(value, str):
+        problems.append(f'{where} must be a string')
+    elif not minLength <= len(value) <= maxLength:
+        # Templates are checked as written, since their variables are only known at runtime.
+        problems.append(f'{where} must be {minLength} ~ {maxLength} characters long, not {len(value)}')
+
+
+def _checkScript(problems: List[str], where: str, value, required: bool) -> None:
+    if value is None:
+        if required:
+            problems.append(f'{where} is required')
+    elif not isinstance(value, str) or value.count('.') != 1 or not all(value.split('.')):
+        problems.append(f'{where} must be a script name like `module.ClassName`')
+
+
+def _checkButton(problems: List[str], where: str, button) -> None:
+    if not isinstance(button, dict):
+        problems.append(f'{where} must be an object')
+        return
+    _checkText(problems, f'{where}.{ButtonKeys.Label}', button.get(ButtonKeys.Label), True, 1,
+               ActivityLimits.MaxButtonLabelLength)
+    url = button.get(ButtonKeys.URL)
+    _checkText(problems, f'{where}.{ButtonKeys.URL}', url, True, 1, ActivityLimits.MaxButtonURLLength)
+    if isinstance(url, str) and not url.startswith(('http://', 'https://')):
+        problems.append(f'{where}.{ButtonKeys.URL} must be a http(s) url')
+    _checkScript(problems, f'{where}.{ButtonKeys.Script}', button.get(ButtonKeys.Script), False)
+
+
+def _checkParty(problems: List[str], where: str, party) -> None:
+    if not isinstance(party, dict):
+        problems.append(f'{where} must be an object')
+        return
+    _checkText(problems, f'{where}.{PartyKeys.Id}', party.get(PartyKeys.Id), True, 1, ActivityLimits.MaxPartyIdLength)
+    size = party.get(PartyKeys.Size)
+    if size is not None and not (
+            isinstance(size, list) and len(size) == 2 and all(_isInteger(n) for n in size) and 1 <= size[0] <= size[1]
+    ):
+        problems.append(f'{where}.{PartyKeys.Size} must be [current, max] with 1 <= current <= max')
+
+
+def _checkSecrets(problems: List[str], where: str, secrets, hasParty: bool) -> None:
+    if not isinstance(secrets, dict):
+        problems.append(f'{where} must be an object')
+        return
+    for key, secret in secrets.items():
+        if key not in (SecretKeys.Join, SecretKeys.Spectate, SecretKeys.Match):
+            problems.append(f'{where}.{key} is not a known secret')
+        else:
+            _checkText(problems, f'{where}.{key}', secret, True, 1, ActivityLimits.MaxSecretLength)
+    if SecretKeys.Join in secrets and not hasParty:
+        problems.append(f'{where}.{SecretKeys.Join} needs `{ProfileKeys.Party}` of the profile')
+
+
+def _isNumber(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _isInteger(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _checkSchedule(problems: List[str], where: str, schedule) -> None:
+    if not isinstance(schedule, dict):
+        problems.append(f'{where} must be an object')
+        return
+    duration = schedule.get(ScheduleKeys.Duration)
+    if duration is not None and (not _isNumber(duration) or duration <= 0):
+        problems.append(f'{where}.{ScheduleKeys.Duration} must be a positive number of seconds')
+    weight = schedule.get(ScheduleKeys.Weight, 1)
+    if not _isNumber(weight) or weight < 0:
+        problems.append(f'{where}.{ScheduleKeys.Weight} must be a non-negative number')
+    window = schedule.get(ScheduleKeys.Window)
+    if window is not None:
+        if not isinstance(window, list) or len(window) != 2 or not all(isinstance(t, str) for t in window):
+            problems.append(f'{where}.{ScheduleKeys.Window} must be ["HH:MM", "HH:MM"]')
+        else:
+            for value in window:
+                try:
+                    parseTimeOfDay(value)
+                except ValueError:
+                    problems.append(f'{where}.{ScheduleKeys.Window} has invalid time of day {value!r}')
+
+
+def _checkProfile(problems: List[str], where: str, data) -> None:
+    if not isinstance(data, dict):
+        problems.append(f'{where} must be an object')
+        return
+    if not isinstance(data.get(ProfileKeys.Enabled), bool):
+        problems.append(f'{where}.{ProfileKeys.Enabled} must be true or false')
+    for key in (ProfileKeys.Id, ProfileKeys.Name):
+        value = data.get(key)
+        if value is not None and (not isinstance(value, str) or not value):
+            problems.append(f'{where}.{key} must be a non-empty string')
+    tags = data.get(ProfileKeys.Tags)
+    if tags is not None and (not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags)):
+        problems.append(f'{where}.{ProfileKeys.Tags} must be an array of strings')
+    for key in _TextKeys:
+        _checkText(problems, f'{where}.{key}', data.get(key), key in _RequiredTextKeys,
+                   ActivityLimits.MinTextLength, ActivityLimits.MaxTextLength)
+    for key in _IconKeys:
+        icon = data.get(key)
+        if icon is not None and icon not in ResourceKeys:
+            problems.append(f'{where}.{key} is not a known resource : {icon!r}')
+    buttons = data.get(ProfileKeys.Buttons)
+    if buttons is not None:
+        if not isinstance(buttons, list):
+            problems.append(f'{where}.{ProfileKeys.Buttons} must be an array')
+        else:
+            if len(buttons) > ActivityLimits.MaxButtons:
+                problems.append(f'{where}.{ProfileKeys.Buttons} can have {ActivityLimits.MaxButtons} buttons at most')
+            for index, button in enumerate(buttons):
+                _checkButton(problems, f'{where}.{ProfileKeys.Buttons}[{index}]', button)
+    party = data.get(ProfileKeys.Party)
+    if party is not None:
+        _checkParty(problems, f'{where}.{ProfileKeys.Party}', party)
+    if data.get(ProfileKeys.Secrets) is not None:
+        _checkSecrets(problems, f'{where}.{ProfileKeys.Secrets}', data[ProfileKeys.Secrets], party is not None)
+    _checkScript(problems, f'{where}.{ProfileKeys.Script}', data.get(ProfileKeys.Script), True)
+    if data.get(ProfileKeys.Schedule) is not None:
+        _checkSchedule(problems, f'{where}.{ProfileKeys.Schedule}', data[ProfileKeys.Schedule])
+
+
+def validateProfiles(data: JSON) -> None:
+    """
+    Check the whole profiles.json data against its format and limits of discord activity.
+    Every problem is collected, so all of them can be fixed at once.
+
+    Args:
+        data (Dict[str, Any]) : Parsed profiles.json data.
+
+    Raises:
+        ProfileValidationError : If there is any problem.
+    """
+    problems: List[str] = []
+    if not isinstance(data, dict):
+        raise ProfileValidationError(['profiles file must be an object'])
+    if not isinstance(data.get(ConfigKeys.Format), str):
+        problems.append(f'{ConfigKeys.Format} must be a string')
+    profiles = data.get(ConfigKeys.Data)
+    if not isinstance(profiles, list):
+        problems.append(f'{ConfigKeys.Data} must be an array')
+        raise ProfileValidationError(problems)
+
+    ids: Dict[str, int] = {}
+    names: Dict[str, int] = {}
+    enabled = 0
+    for index, profile in enumerate(profiles):
+        where = f'{ConfigKeys.Data}[{index}]'
+        _checkProfile(problems, where, profile)
+        if not isinstance(profile, dict):
+            continue
+        for key, seen in ((ProfileKeys.Id, ids), (ProfileKeys.Name, names)):
+            value = profile.get(key)
+            if isinstance(value, str):
+                if value in seen:
+                    problems.append(f'{where}.{key} {value!r} is already used by {ConfigKeys.Data}[{seen[value]}]')
+                else:
+                    seen[value] = index
+        if profile.get(ProfileKeys.Enabled) is True:
+            enabled += 1
+    if not enabled:
+        problems.append('at least one profile must be enabled')
+    if problems:
+        raise ProfileValidationError(problems)
+
+
+class ProfileStore:
+    """
+    Validated profiles of profiles.json, indexed by id, name, tag and enabled flag.
+    Stores are not changed after they are built. Reloading builds a new store, reusing unchanged Profile objects.
+
+    Profiles without `id` can be found by their position in the file, like `'0'`.
+    """
+
+    def __init__(self, profileFormat: str, profiles: Sequence[Profile], keys: Sequence[str]) -> None:
+        self._format: str = profileFormat
+        self._profiles: Tuple[Profile, ...] = tuple(profiles)
+        self._keys: Tuple[str, ...] = tuple(keys)     # Canonical json of each profile, used to find changed profiles.
+        self._indices: Dict[int, int] = {}            # id(profile) : position
+        self._byId: Dict[str, Profile] = {}
+        self._byName: Dict[str, Profile] = {}
+        self._byTag: Dict[str, List[Profile]] = {}
+        self._enabledIndices: List[int] = []
+        self._scheduled: List[Profile] = []           # Enabled profiles with rotation schedule.
+        for index, profile in enumerate(self._profiles):
+            self._indices[id(profile)] = index
+            if profile.id is not None:
+                self._byId[profile.id] = profile
+            if profile.name is not None:
+                self._byName[profile.name] = profile
+            for tag in profile.tags:
+                self._byTag.setdefault(tag, []).append(profile)
+            if profile.enabled:
+                self._enabledIndices.append(index)
+                if profile.schedule is not None:
+                    self._scheduled.append(profile)
+        for index, profile in enumerate(self._profiles):
+            if profile.id is None:
+                self._byId.setdefault(str(index), profile)
+
+    @staticmethod
+    def profileKey(data: JSON) -> str:
+        return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+    @classmethod
+    def fromJson(cls, data: JSON, factory: ProfileFactory, previous: Optional[ProfileStore] = None) -> ProfileStore:
+        """
+        Validate profiles.json data, and build a store from it.
+        Profiles same as the ones in `previous` store are reused, keeping their script bindings and variables.
+
+        Args:
+            data (Dict[str, Any]) : Parsed profiles.json data.
+            factory (Callable[[Dict[str, Any]], Profile]) : Function creating Profile from its json data.
+            previous (Optional[ProfileStore]) : Store to reuse profiles from.
+
+        Raises:
+            ProfileValidationError : If data is invalid. Nothing is built in this case.
+        """
+        validateProfiles(data)
+        raws: List[JSON] = data[ConfigKeys.Data]
+        return cls._build(data[ConfigKeys.Format], raws, [cls.profileKey(raw) for raw in raws], factory, previous)
+
+    @classmethod
+    def _build(
+            cls,
+            profileFormat: str,
+            raws: Sequence[JSON],
+            keys: Sequence[str],
+            factory: ProfileFactory,
+            previous: Optional[ProfileStore]
+    ) -> ProfileStore:
+        reusable: Dict[str, List[Profile]] = {}
+        if previous is not None:
+            for key, profile in zip(reversed(previous._keys), reversed(previous._profiles)):
+                reusable.setdefault(key, []).append(profile)
+        profiles: List[Profile] = []
+        for raw, key in zip(raws, keys):
+            candidates = reusable.get(key)
+            profiles.append(candidates.pop() if candidates else factory(raw))
+        return cls(profileFormat, profiles, keys)
+
+    @classmethod
+    def load(
+            cls,
+            path: str,
+            factory: ProfileFactory,
+            previous: Optional[ProfileStore] = None,
+            snapshot: Optional[ProfileSnapshot] = None
+    ) -> ProfileStore:
+        """
+        Read profiles.json at `path`, and build a store from it. See fromJson().
+
+        Args:
+            snapshot (Optional[ProfileSnapshot]) : Snapshot of validated profiles. If it matches the file,
+                the file is neither parsed nor validated. Otherwise, it is taken again after validation.
+        """
+        source = b''
+        if snapshot is not None:
+            source, cached = snapshot.load(path)
+            if cached is not None:
+                return cls._build(*cached, factory, previous)
+        if not source:
+            with open(path, mode='rb') as f:
+                source = f.read()
+        data = json.loads(source.decode('utf-8'))
+        store = cls.fromJson(data, factory, previous)
+        if snapshot is not None:
+            snapshot.save(path, source, store._format, data[ConfigKeys.Data], list(store._keys))
+        return store
+
+    @property
+    def format(self) -> str:
+        return self._format
+
+    @property
+    def profiles(self) -> Tuple[Profile, ...]:
+        return self._profiles
+
+    @property
+    def enabledProfiles(self) -> Tuple[Profile, ...]:
+        return tuple(self._profiles[index] for index in self._enabledIndices)
+
+    @property
+    def scheduledProfiles(self) -> Tuple[Profile, ...]:
+        """Enabled profiles with rotation schedule."""
+        return tuple(self._scheduled)
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def __iter__(self) -> Iterator[Profile]:
+        return iter(self._profiles)
+
+    def __getitem__(self, index: int) -> Profile:
+        return self._profiles[index]
+
+    def __contains__(self, profile: Profile) -> bool:
+        return id(profile) in self._indices
+
+    def indexOf(self, profile: Profile) -> int:
+        """Position of profile in the file. Raises ValueError if profile is not in this store."""
+        try:
+            return self._indices[id(profile)]
+        except KeyError:
+            raise ValueError(f'{profile!r} is not in this store') from None
+
+    def get(self, profileId: str) -> Optional[Profile]:
+        return self._byId.get(profileId)
+
+    def byName(self, name: str) -> Optional[Profile]:
+        return self._byName.get(name)
+
+    def withTag(self, tag: str) -> Tuple[Profile, ...]:
+        return tuple(self._byTag.get(tag, ()))
+
+    def find(self, key: str) -> Optional[Profile]:
+        """Find profile by id, and then by name."""
+        profile = self._byId.get(key)
+        return self._byName.get(key) if profile is None else profile
+
+    def nearestEnabled(self, index: int) -> Optional[Profile]:
+        """
+        Enabled profile at `index`, or the next enabled one after it.
+        If there is none after it, the last enabled profile is returned.
+        """
+        if not self._enabledIndices:
+            return None
+        position = min(bisect_left(self._enabledIndices, index), len(self._enabledIndices) - 1)
+        return self._profiles[self._enabledIndices[position]]
+
+    def default(self, key: Optional[str] = None) -> Optional[Profile]:
+        """
+        Profile to show on start. Profile found by `key` if it is enabled, otherwise the first enabled profile.
+
+        Args:
+            key (Optional[str]) : Id or name of profile. (`default_profile` of config.json)
+        """
+        if key is not None:
+            profile = self.find(key)
+            if profile is not None and profile.enabled:
+                return profile
+        return self.nearestEnabled(0)
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import heapq
+import random
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import Any, Callable, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from src.constants import ScheduleKeys
+from src.type_hints import JSON
+
+if TYPE_CHECKING:
+    from src.discordrpc import Profile
+
+_DaySeconds: float = 24 * 60 * 60
+
+
+class ScheduledTask:
+    """Callback scheduled on Scheduler. Repeating tasks have `interval`."""
+    __slots__ = ('when', 'interval', 'callback', 'name', 'cancelled', 'queued')
+
+    def __init__(self, when: float, callback: Callable[[], Any], interval: Optional[float], name: str) -> None:
+        self.when: float = when
+        self.interval: Optional[float] = interval
+        self.callback: Callable[[], Any] = callback
+        self.name: str = name
+        self.cancelled: bool = False
+        self.queued: bool = False       # Whether task is in the heap of Scheduler.
+
+    def __repr__(self) -> str:
+        return f'ScheduledTask(name={self.name!r}, when={self.when:.3f}, interval={self.interval})'
+
+
+class Scheduler:
+    """
+    Timer queue of the client loop, kept as a binary heap ordered by due time.
+    The loop sleeps until the earliest task is due (see timeUntilNext()), and runs tasks returned by due().
+    Cancelled tasks are dropped lazily when they reach the top of the heap.
+    """
+
+    def __init__(self, clock: Callable[[], float] = monotonic, wakeup: Optional[Callable[[], None]] = None) -> None:
+        """
+        Initialize Scheduler.
+
+        Args:
+            clock (Callable[[], float]) : Monotonic clock in seconds.
+            wakeup (Optional[Callable[[], None]]) : Called when a new task becomes the earliest one,
+                so the loop sleeping for the previous deadline can wake up.
+        """
+        self._clock: Callable[[], float] = clock
+        self._wakeup: Optional[Callable[[], None]] = wakeup
+        self._heap: List[Tuple[float, int, ScheduledTask]] = []
+        self._counter: int = 0      # Keeps tasks due at the same time in insertion order.
+        self._cancelled: int = 0
+        self._lock = threading.Lock()
+        self.lateness: float = 0.0      # Seconds the earliest task of the last due() call was run behind its time.
+
+    def __len__(self) -> int:
+        return len(self._heap) - self._cancelled
+
+    @property
+    def clock(self) -> Callable[[], float]:
+        return self._clock
+
+    def _push(self, task: ScheduledTask) -> None:
+        with self._lock:
+            earliest = not self._heap or task.when < self._heap[0][0]
+            heapq.heappush(self._heap, (task.when, self._counter, task))
+            self._counter += 1
+            task.queued = True
+        if earliest and self._wakeup is not None:
+            self._wakeup()
+
+    def callAt(self, when: float, callback: Callable[[], Any], name: str = '') -> ScheduledTask:
+        """Run callback once at `when`, in time of the scheduler's clock."""
+        task = ScheduledTask(when, callback, None, name or getattr(callback, '__name__', ''))
+        self._push(task)
+        return task
+
+    def callLater(self, delay: float, callback: Callable[[], Any], name: str = '') -> ScheduledTask:
+        """Run callback once after `delay` seconds."""
+        return self.callAt(self._clock() + delay, callback, name)
+
+    def every(
+            self,
+            interval: float,
+            callback: Callable[[], Any],
+            name: str = '',
+            delay: Optional[float] = None
+    ) -> ScheduledTask:
+        """
+        Run callback every `interval` seconds, first after `delay` seconds (`interval` if not given).
+        Runs missed while the loop was busy are skipped, instead of being run back to back.
+        """
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        task = ScheduledTask(
+            self._clock() + (interval if delay is None else delay), callback, interval,
+            name or getattr(callback, '__name__', '')
+        )
+        self._push(task)
+        return task
+
+    def cancel(self, task: Optional[ScheduledTask]) -> None:
+        if task is None or task.cancelled:
+            return
+        with self._lock:
+            task.cancelled = True
+            if not task.queued:
+                return
+            self._cancelled += 1
+            if self._cancelled > 32 and self._cancelled * 2 > len(self._heap):
+                # Too many dead entries. Rebuild heap without them.
+                for entry in self._heap:
+                    entry[2].queued = not entry[2].cancelled
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _dropCancelled(self) -> None:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)[2].queued = False
+            self._cancelled -= 1
+
+    @property
+    def nextDeadline(self) -> Optional[float]:
+        """Due time of the earliest task, or None if nothing is scheduled."""
+        with self._lock:
+            self._dropCancelled()
+            return self._heap[0][0] if self._heap else None
+
+    def timeUntilNext(self) -> Optional[float]:
+        """Seconds until the earliest task is due. 0 if it is already due, None if nothing is scheduled."""
+        deadline = self.nextDeadline
+        return None if deadline is None else max(0.0, deadline - self._clock())
+
+    def due(self) -> List[ScheduledTask]:
+        """
+        Take tasks which are due now, in order of their due time. Repeating tasks are scheduled again.
+
+        Returns:
+            Tasks to run. Caller runs their callbacks.
+        """
+        now = self._clock()
+        tasks: List[ScheduledTask] = []
+        with self._lock:
+            while self._heap:
+                self._dropCancelled()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, _, task = heapq.heappop(self._heap)
+                task.queued = False
+                tasks.append(task)
+            if tasks:
+                self.lateness = now - tasks[0].when
+            for task in tasks:
+                if task.interval is not None:
+                    task.when += task.interval
+                    if task.when <= now:
+                        task.when = now + task.interval
+                    heapq.heappush(self._heap, (task.when, self._counter, task))
+                    self._counter += 1
+                    task.queued = True
+        return tasks
+
+    def clear(self) -> None:
+        with self._lock:
+            for _, _, task in self._heap:
+                task.cancelled = True
+                task.queued = False
+            self._heap.clear()
+            self._cancelled = 0
+
+
+def parseTimeOfDay(value: str) -> float:
+    hour, minute = value.split(':')
+    seconds = int(hour) * 3600 + int(minute) * 60
+    if not 0 <= seconds < _DaySeconds or not 0 <= int(minute) < 60:
+        raise ValueError(f'Invalid time of day {value!r}')
+    return seconds
+
+
+def _secondsOfDay(now: datetime) -> float:
+    return now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+
+
+class ProfileSchedule:
+    """
+    Rotation schedule of a profile (`schedule` of profiles.json).
+
+    - duration : Seconds to show the profile before rotating to another one.
+    - weight : Relative chance of being chosen as the next profile.
+    - window : `["HH:MM", "HH:MM"]`, local time of day the profile can be shown in. Windows can wrap midnight.
+    """
+    __slots__ = ('duration', 'weight', 'window')
+
+    @classmethod
+    def fromJson(cls, data: JSON) -> ProfileSchedule:
+        window = data.get(ScheduleKeys.Window)
+        return cls(
+            duration=data.get(ScheduleKeys.Duration),
+            weight=data.get(ScheduleKeys.Weight, 1),
+            window=None if window is None else (parseTimeOfDay(window[0]), parseTimeOfDay(window[1]))
+        )
+
+    def __init__(
+            self,
+            duration: Optional[float] = None,
+            weight: float = 1,
+            window: Optional[Tuple[float, float]] = None
+    ) -> None:
+        self.duration: Optional[float] = duration
+        self.weight: float = weight
+        self.window: Optional[Tuple[float, float]] = window     # (start, end) in seconds of day.
+
+    def isActive(self, now: datetime) -> bool:
+        """Whether profile can be shown at `now`."""
+        if self.window is None:
+            return True
+        start, end = self.window
+        seconds = _secondsOfDay(now)
+        if start == end:
+            return True
+        if start < end:
+            return start <= seconds < end
+        return seconds >= start or seconds < end
+
+    def dwell(self, now: datetime) -> Optional[float]:
+        """
+        Seconds to show the profile from `now`, until its duration passes or its window ends.
+
+        Returns:
+            None if the profile can be shown as long as it wants.
+        """
+        remaining = self.duration
+        if self.window is not None and self.window[0] != self.window[1] and self.isActive(now):
+            untilEnd = self.window[1] - _secondsOfDay(now)
+            if untilEnd <= 0:
+                untilEnd += _DaySeconds
+            remaining = untilEnd if remaining is None else min(remaining, untilEnd)
+        return remaining
+
+
+class ProfileRotation:
+    """Chooses the next profile among profiles with schedule, by weight and time-of-day window."""
+
+    # Seconds to wait before checking again, when no other profile can be shown.
+    RetryAfter: float = 60
+
+    def __init__(self, rng: Optional[random.Random] = None, now: Callable[[], datetime] = datetime.now) -> None:
+        self._random: random.Random = random.Random() if rng is None else rng
+        self._now: Callable[[], datetime] = now
+
+    def dwell(self, profile: Profile) -> Optional[float]:
+        """Seconds until profile should be rotated. None if profile does not rotate."""
+        if profile.schedule is None:
+            return None
+        return profile.schedule.dwell(self._now())
+
+    def choose(self, candidates: Sequence[Profile], current: Optional[Profile]) -> Optional[Profile]:
+        """
+        Choose the next profile among candidates which can be shown now. Current profile is chosen only if
+        there is no other one.
+
+        Returns:
+            Profile to show, or None if no candidate can be shown now.
+        """
+        now = self._now()
+        active = [profile for profile in candidates if profile.schedule.isActive(now)]
+        others = [profile for profile in active if profile is not current]
+        if others:
+            active = others
+        active = [profile for profile in active if profile.schedule.weight > 0]
+        if not active:
+            return None
+        return self._random.choices(active, weights=[profile.schedule.weight for profile in active])[0]
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from src.script_stats import ScriptStats
+
+logger = logging.getLogger('pyrorpc.scripts')
+
+
+class ListenerState:
+    """Deadline misses of a listener run on ScriptPool."""
+    __slots__ = ('running', 'misses', 'resumeAt')
+
+    def __init__(self) -> None:
+        self.running: Optional[Future] = None   # Abandoned call which is still running.
+        self.misses: int = 0                    # Consecutive deadline misses.
+        self.resumeAt: float = 0.0              # Listener is skipped until this time.
+
+
+class ScriptPool:
+    """
+    Runs script listeners of one event concurrently on a bounded thread pool, and waits for them until deadline.
+    Listeners missing the deadline are abandoned for that event, so presence is updated with the last good values.
+    Listeners missing deadline repeatedly are skipped for exponentially growing backoff.
+    """
+
+    def __init__(
+            self,
+            workers: int = 4,
+            deadline: float = 1.0,
+            strikes: int = 2,
+            backoff: float = 15.0,
+            maxBackoff: float = 300.0,
+            clock: Callable[[], float] = monotonic
+    ) -> None:
+        """
+        Initialize ScriptPool.
+
+        Args:
+            workers (int) : Number of worker threads.
+            deadline (float) : Seconds to wait for listeners of one event.
+            strikes (int) : Consecutive deadline misses before listener is put on backoff.
+            backoff (float) : Seconds to skip listener on its first backoff. Doubled on each further miss.
+            maxBackoff (float) : Upper bound of backoff, in seconds.
+            clock (Callable[[], float]) : Monotonic clock used for backoff.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pyrorpc-script')
+        self._deadline: float = deadline
+        self._strikes: int = strikes
+        self._backoff: float = backoff
+        self._maxBackoff: float = maxBackoff
+        self._clock: Callable[[], float] = clock
+        self._states: Dict[Callable[..., Any], ListenerState] = {}
+
+    @property
+    def deadline(self) -> float:
+        return self._deadline
+
+    def isAvailable(self, callback: Callable[..., Any]) -> bool:
+        """
+        Check whether listener can be called now.
+
+        Returns:
+            False if the listener is on backoff, or its abandoned call is still running.
+        """
+        state = self._states.get(callback)
+        if state is None:
+            return True
+        if state.running is not None:
+            if not state.running.done():
+                return False
+            state.running = None
+        return state.resumeAt <= self._clock()
+
+    def run(self, listeners: Iterable[Callable[..., Any]], invoke: Callable[..., None], *args, **kwargs) -> None:
+        """
+        Call listeners on worker threads, and wait for them until deadline.
+
+        Args:
+            listeners (Iterable[Callable]) : Listeners to call.
+            invoke (Callable) : Function calling listener, called as `invoke(listener, *args, **kwargs)`.
+            *args (Any) : Positional arguments passed to listeners.
+            **kwargs (Any) : Keyword arguments passed to listeners.
+        """
+        futures: Dict[Future, Callable[..., Any]] = {}
+        for callback in listeners:
+            if not self.isAvailable(callback):
+                logger.debug(f'Script > {ScriptStats.listenerName(callback)} is skipped.')
+                continue
+            futures[self._executor.submit(invoke, callback, *args, **kwargs)] = callback
+        if not futures:
+            return
+        done, notDone = wait(futures, timeout=self._deadline)
+        for future in done:
+            callback = futures[future]
+            self._states.pop(callback, None)
+            error = future.exception()
+            if error is not None:
+                logger.error(f'Script > {ScriptStats.listenerName(callback)} raised {error!r}')
+        for future in notDone:
+            self._miss(futures[future], future)
+
+    def _miss(self, callback: Callable[..., Any], future: Future) -> None:
+        state = self._states.get(callback)
+        if state is None:
+            self._states[callback] = state = ListenerState()
+        state.running = future
+        state.misses += 1
+        name = ScriptStats.listenerName(callback)
+        if state.misses < self._strikes:
+            logger.warning(f'Script > {name} missed the deadline of {self._deadline}s, and is abandoned.')
+            return
+        backoff = min(self._maxBackoff, self._backoff * 2 ** (state.misses - self._strikes))
+        state.resumeAt = self._clock() + backoff
+        logger.warning(
+            f'Script > {name} missed the deadline {state.misses} times in a row, and is skipped for {backoff}s.'
+        )
+
+    def shutdown(self) -> None:
+        """Stop worker threads. Abandoned calls are not waited."""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import logging
+import threading
+from math import ceil, log
+from typing import Callable, Dict, List, Optional
+
+from src.type_hints import JSON
+
+logger = logging.getLogger('pyrorpc.scripts')
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies using exponentially growing buckets.
+    Bucket i counts samples up to `lowest * growth ** i` seconds, so percentiles are accurate within `growth` ratio.
+    """
+
+    def __init__(self, lowest: float = 1e-6, growth: float = 1.2, buckets: int = 100) -> None:
+        self._lowest: float = lowest
+        self._growth: float = growth
+        self._logGrowth: float = log(growth)
+        self._counts: List[int] = [0] * buckets
+        self._count: int = 0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def record(self, seconds: float) -> None:
+        if seconds <= self._lowest:
+            index = 0
+        else:
+            index = min(len(self._counts) - 1, ceil(log(seconds / self._lowest) / self._logGrowth))
+        self._counts[index] += 1
+        self._count += 1
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Estimate latency percentile.
+
+        Args:
+            percent (float) : Percentile to get, between 0 and 100.
+
+        Returns:
+            Upper bound of the bucket containing the percentile, or None if nothing is recorded.
+        """
+        if self._count == 0:
+            return None
+        target = max(1, ceil(percent / 100 * self._count))
+        cumulative = 0
+        for index, count in enumerate(self._counts):
+            cumulative += count
+            if cumulative >= target:
+                return self._lowest * self._growth ** index
+        return self._lowest * self._growth ** (len(self._counts) - 1)
+
+
+class HandlerStats:
+    """Timing statistics of one (script, event) pair."""
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.calls: int = 0
+        self.totalTime: float = 0.0
+        self.maxTime: float = 0.0
+        self.overBudget: int = 0
+        self.errors: int = 0
+        self.histogram: LatencyHistogram = LatencyHistogram()
+
+    def record(self, elapsed: float) -> None:
+        self.calls += 1
+        self.totalTime += elapsed
+        if elapsed > self.maxTime:
+            self.maxTime = elapsed
+        self.histogram.record(elapsed)
+
+    def toJson(self) -> JSON:
+        return {
+            'calls': self.calls,
+            'total': self.totalTime,
+            'mean': self.totalTime / self.calls if self.calls else None,
+            'max': self.maxTime,
+            'p50': self.histogram.percentile(50),
+            'p95': self.histogram.percentile(95),
+            'p99': self.histogram.percentile(99),
+            'over_budget': self.overBudget,
+            'errors': self.errors
+        }
+
+
+class ScriptStats:
+    """Collects HandlerStats of every script listener called by ScriptEngine."""
+
+    def __init__(self, budget: float = 0.1) -> None:
+        """
+        Initialize ScriptStats.
+
+        Args:
+            budget (float) : Seconds a listener may take. Slower calls are reported as warning.
+        """
+        self._budget: float = budget
+        self._handlers: Dict[Callable[..., None], HandlerStats] = {}
+        self._lock = threading.Lock()     # Listeners may be called from executor threads.
+
+    @property
+    def budget(self) -> float:
+        return self._budget
+
+    @budget.setter
+    def budget(self, new: float):
+        if new <= 0:
+            raise ValueError('ScriptStats.budget must be positive!')
+        self._budget = new
+
+    @staticmethod
+    def listenerName(callback: Callable[..., None]) -> str:
+        """
+        Name of listener, like `sample.HWStatus.onReload`.
+
+        Args:
+            callback (Callable) : Listener callable.
+
+        Returns:
+            Name of the listener.
+        """
+        module = getattr(callback, '__module__', None) or ''
+        return f'{module.rsplit(".", 1)[-1]}.{callback.__qualname__}'.lstrip('.')
+
+    def record(self, callback: Callable[..., None], elapsed: float) -> None:
+        with self._lock:
+            stats = self._handlers.get(callback)
+            if stats is None:
+                self._handlers[callback] = stats = HandlerStats(self.listenerName(callback))
+            stats.record(elapsed)
+            if elapsed <= self._budget:
+                return
+            stats.overBudget += 1
+        logger.warning(
+            f'Script > {stats.name} took {elapsed * 1000:.1f}ms, over the budget of {self._budget * 1000:.1f}ms.'
+        )
+
+    def recordError(self, callback: Callable[..., None]) -> None:
+        """Count an exception raised by listener. Its time is recorded by record() as usual."""
+        with self._lock:
+            stats = self._handlers.get(callback)
+            if stats is None:
+                self._handlers[callback] = stats = HandlerStats(self.listenerName(callback))
+            stats.errors += 1
+
+    def handlers(self) -> List[HandlerStats]:
+        with self._lock:
+            return list(self._handlers.values())
+
+    def forget(self, callback: Callable[..., None]) -> None:
+        with self._lock:
+            self._handlers.pop(callback, None)
+
+    def toJson(self) -> Dict[str, JSON]:
+        with self._lock:
+            return {stats.name: stats.toJson() for stats in self._handlers.values()}
+
+    def report(self) -> str:
+        """
+        Human readable summary of collected statistics, slowest listener first.
+
+        Returns:
+            Multiline string.
+        """
+        with self._lock:
+            collected = [(stats.name, stats.toJson()) for stats in self._handlers.values()]
+        lines = []
+        for name, data in sorted(collected, key=lambda item: item[1]['total'], reverse=True):
+            lines.append(
+                f'{name} : calls={data["calls"]}, total={data["total"] * 1000:.1f}ms, '
+                f'p50={data["p50"] * 1000:.2f}ms, p95={data["p95"] * 1000:.2f}ms, p99={data["p99"] * 1000:.2f}ms, '
+                f'over_budget={data["over_budget"]}' + (f', errors={data["errors"]}' if data["errors"] else '')
+            )
+        return '\n'.join(lines)
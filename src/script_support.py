@@ -1,13 +1,31 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import importlib
 import inspect
+import logging
+import sys
+import threading
 from enum import Enum
 from os.path import sep
 from pprint import pprint
-from typing import List, Optional, Any, Union, Dict, Callable
+from time import monotonic, perf_counter
+from typing import List, Optional, Any, Union, Dict, Callable, Tuple, Iterable, NamedTuple, Set, FrozenSet
+
+from src.constants import ConfigKeys
+from src.script_pool import ScriptPool
+from src.script_stats import ScriptStats
+from src.telemetry import MetricsRegistry
+from src.type_hints import JSON
+
+logger = logging.getLogger('pyrorpc.scripts')
 
 
 class Script:
+    # Seconds between OnReload of profiles using this script. None uses `interval` of config.json.
+    tickInterval: Optional[float] = None
+
     def __init__(self, client) -> None:
         self._client = client
         self._name = self.__class__.__name__
@@ -79,6 +97,16 @@ class Script:
         """
         pass
 
+    def onConnectionChange(self, state, previous) -> None:
+        """
+        An event called when state of the connection to discord is changed, like when discord is restarted.
+
+        Args:
+            state (src.connection.ConnectionState) : New state of the connection.
+            previous (src.connection.ConnectionState) : Previous state of the connection.
+        """
+        pass
+
     # Alias support
     @classmethod
     def register(cls, script_cls: type) -> type:
@@ -102,11 +130,19 @@ class ScriptEventWrapper:
     mock: Callable[..., None]
     name: str
     doc: str
+    scoped: bool
+    scope: Optional[Tuple[int, str]]
 
-    def __init__(self, func):
+    def __init__(self, func, name: Optional[str] = None):
         self.mock = func    # Save mock function object
-        self.name = func.__name__
+        self.name = func.__name__ if name is None else name
         self.doc = inspect.cleandoc(func.__doc__)
+        # Events taking button or profile are only delivered to the script attached to it.
+        # scope is (position, name) of the argument, not counting self.
+        parameters = list(inspect.signature(func).parameters)
+        scope = next((key for key in ('button', 'profile') if key in parameters), None)
+        self.scope = None if scope is None else (parameters.index(scope) - 1, scope)
+        self.scoped = scope is not None
 
 
 class ScriptEvent(Enum):
@@ -117,6 +153,7 @@ class ScriptEvent(Enum):
     OnReload = ScriptEventWrapper(Script.onReload)
     OnUpdate = ScriptEventWrapper(Script.onUpdate)
     OnClick = ScriptEventWrapper(Script.onClick)
+    OnConnectionChange = ScriptEventWrapper(Script.onConnectionChange)
 
     @property
     def eventName(self) -> str:
@@ -126,6 +163,10 @@ class ScriptEvent(Enum):
     def doc(self) -> str:
         return self.value.doc
 
+    @property
+    def scoped(self) -> bool:
+        return self.value.scoped
+
     # Remains of attempt to create ScriptEvent enumeration with `doc` attribute from function.__doc__
     # OnStart = Script.onStart
     # OnClose = Script.onClose
@@ -136,6 +177,389 @@ class ScriptEvent(Enum):
     # OnClick = Script.onClick
 
 
+class CustomEvent:
+    """
+    Event declared by scripts with ScriptEngine.event(). It has the same interface as ScriptEvent members,
+    so it is emitted and subscribed to the same way.
+    """
+    __slots__ = ('name', 'value')
+
+    def __init__(self, wrapper: ScriptEventWrapper) -> None:
+        self.value: ScriptEventWrapper = wrapper
+        self.name: str = wrapper.name[0].upper() + wrapper.name[1:]
+
+    @property
+    def eventName(self) -> str:
+        return self.value.name
+
+    @property
+    def doc(self) -> str:
+        return self.value.doc
+
+    @property
+    def scoped(self) -> bool:
+        return self.value.scoped
+
+    def __repr__(self) -> str:
+        return f'<CustomEvent.{self.name}>'
+
+
+Event = Union[ScriptEvent, CustomEvent]
+
+
+class Subscription:
+    __slots__ = ('event', 'priority', 'batch')
+
+    def __init__(self, event: Union[Event, str], priority: int, batch: Optional[float]) -> None:
+        self.event: Union[Event, str] = event
+        self.priority: int = priority
+        self.batch: Optional[float] = batch
+
+    def matches(self, event: Event) -> bool:
+        return self.event is event or self.event in (event.eventName, event.name)
+
+
+def subscribe(event: Union[Event, str], priority: int = 0, batch: Optional[float] = None):
+    """
+    Decorator subscribing a method of Script to an event. Hooks named after events (like `onReload`) are
+    subscribed without it, with priority 0.
+
+    Args:
+        event (Union[ScriptEvent, CustomEvent, str]) : Event, or its name like `onCalled`. Names are matched when
+            the event is first emitted, so events declared later by other modules can be subscribed to.
+        priority (int) : Listeners with higher priority are called first. Same priorities keep the order of loading.
+        batch (Optional[float]) : If given, events are queued, and delivered as one call with a list of EventArgs,
+            `batch` seconds after the first one is queued. 0 delivers them at the end of the current loop iteration.
+    """
+    if batch is not None and batch < 0:
+        raise ValueError('batch must not be negative')
+
+    def decorator(func):
+        func.__dict__.setdefault('__subscriptions__', []).append(Subscription(event, priority, batch))
+        return func
+    return decorator
+
+
+class EventArgs(NamedTuple):
+    """Arguments of one event, delivered to batched listeners."""
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+
+
+class BatchQueue:
+    """
+    Stands for a batched listener in listener tables. Calling it queues the event,
+    and take() returns queued events to deliver to the listener at once.
+    """
+    __slots__ = ('callback', 'event', 'window', 'dueAt', '_clock', '_items', '_lock')
+
+    def __init__(
+            self,
+            callback: Callable[..., Any],
+            event: Event,
+            window: float,
+            clock: Callable[[], float] = monotonic
+    ) -> None:
+        self.callback: Callable[..., Any] = callback
+        self.event: Event = event
+        self.window: float = window
+        self._clock: Callable[[], float] = clock
+        self.dueAt: Optional[float] = None      # Time to deliver queued events. None if nothing is queued.
+        self._items: List[EventArgs] = []
+        self._lock = threading.Lock()
+
+    @property
+    def __self__(self) -> Script:
+        return self.callback.__self__
+
+    def __call__(self, *args, **kwargs) -> bool:
+        """
+        Queue an event.
+
+        Returns:
+            True if the queue was empty.
+        """
+        with self._lock:
+            self._items.append(EventArgs(args, kwargs))
+            if self.dueAt is not None:
+                return False
+            self.dueAt = self._clock() + self.window
+            return True
+
+    def take(self) -> List[EventArgs]:
+        with self._lock:
+            items, self._items = self._items, []
+            self.dueAt = None
+        return items
+
+    def __repr__(self) -> str:
+        return f'BatchQueue({self.callback.__qualname__}, window={self.window})'
+
+
+_Missing = object()
+
+# Seconds before a failed provider is called again, when it has no ttl to wait instead.
+_ErrorRetry: float = 5.0
+
+
+class Provider:
+    """Declaration of a template variable provider, made by provide()."""
+    __slots__ = ('name', 'ttl', 'depends', 'default')
+
+    def __init__(self, name: str, ttl: Optional[float], depends: Tuple[str, ...], default: Any = _Missing) -> None:
+        self.name: str = name
+        self.ttl: Optional[float] = ttl
+        self.depends: Tuple[str, ...] = depends
+        self.default: Any = default
+
+
+def provide(
+        name: Optional[str] = None,
+        ttl: Optional[float] = None,
+        depends: Iterable[str] = (),
+        default: Any = _Missing
+):
+    """
+    Decorator declaring a method of Script as provider of a template variable. Values are shared by every profile
+    using the variable, so each value is computed once however many templates use it.
+
+    Args:
+        name (Optional[str]) : Name of the variable. Name of the method if not given.
+        ttl (Optional[float]) : Seconds the value is reused before it is computed again.
+            None keeps the value until it is invalidated (see VariableRegistry.invalidate()).
+        depends (Iterable[str]) : Names of variables the value is computed from. Their values are passed to the
+            method as positional arguments, and the value is computed again when one of them is changed.
+        default (Any) : Value used while the method raises before it has ever returned. Without it, placeholders
+            of the variable are sent as-is.
+    """
+    if ttl is not None and ttl < 0:
+        raise ValueError('ttl must not be negative')
+
+    def decorator(func):
+        func.__provider__ = Provider(name or func.__name__, ttl, tuple(depends), default)
+        return func
+    return decorator
+
+
+class _Variable:
+    __slots__ = ('name', 'callback', 'ttl', 'depends', 'default', 'value', 'expires', 'stale')
+
+    def __init__(
+            self,
+            name: str,
+            callback: Callable[..., Any],
+            ttl: Optional[float],
+            depends: Tuple[str, ...],
+            default: Any = _Missing
+    ):
+        self.name: str = name
+        self.callback: Callable[..., Any] = callback
+        self.ttl: Optional[float] = ttl
+        self.depends: Tuple[str, ...] = depends
+        self.default: Any = default
+        self.value: Any = _Missing
+        self.expires: float = float('-inf')
+        self.stale: bool = True     # Computed again on next use, even if not expired.
+
+
+class VariableRegistry:
+    """
+    Template variables computed by providers declared in scripts with provide().
+
+    Values are memoized for their ttl, and computed lazily: only when a template of the active profile uses them.
+    When a value is changed, variables depending on it are computed again on their next use.
+    Registry is shared by every profile (and every client of PresencePool).
+    """
+
+    def __init__(
+            self,
+            stats: ScriptStats,
+            clock: Callable[[], float] = monotonic,
+            onInvalidate: Optional[Callable[[], None]] = None
+    ) -> None:
+        """
+        Initialize VariableRegistry.
+
+        Args:
+            stats (ScriptStats) : Statistics to record provider calls in.
+            clock (Callable[[], float]) : Monotonic clock in seconds, for ttl.
+            onInvalidate (Optional[Callable[[], None]]) : Called when a variable is invalidated,
+                so the client can send its new value without waiting for the next reload.
+        """
+        self._stats: ScriptStats = stats
+        self._clock: Callable[[], float] = clock
+        self._onInvalidate: Optional[Callable[[], None]] = onInvalidate
+        self._variables: Dict[str, _Variable] = {}
+        self._dependents: Dict[str, Set[str]] = {}      # name : names of variables depending on it
+        self._lock = threading.RLock()      # Providers may read other variables with get().
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._variables
+
+    def __len__(self) -> int:
+        return len(self._variables)
+
+    @property
+    def names(self) -> FrozenSet[str]:
+        return frozenset(self._variables)
+
+    def _dependsOn(self, name: str, target: str) -> bool:
+        variable = self._variables.get(name)
+        return variable is not None and any(
+            depend == target or self._dependsOn(depend, target) for depend in variable.depends
+        )
+
+    def add(
+            self,
+            name: str,
+            callback: Callable[..., Any],
+            ttl: Optional[float] = None,
+            depends: Iterable[str] = (),
+            default: Any = _Missing
+    ):
+        """
+        Add provider of variable.
+
+        Args:
+            name (str) : Name of the variable.
+            callback (Callable[..., Any]) : Function computing the value from values of `depends`.
+            ttl (Optional[float]) : Seconds the value is reused. None keeps it until invalidated.
+            depends (Iterable[str]) : Names of variables the value is computed from.
+            default (Any) : Value used while callback raises before it has ever returned.
+
+        Raises:
+            ValueError : If the variable is already provided, or depends on itself.
+        """
+        depends = tuple(depends)
+        with self._lock:
+            if name in self._variables:
+                provider = self._variables[name].callback.__qualname__
+                raise ValueError(f'Variable {name} is already provided by {provider}')
+            if name in depends or any(self._dependsOn(depend, name) for depend in depends):
+                raise ValueError(f'Variable {name} depends on itself')
+            self._variables[name] = _Variable(name, callback, ttl, depends, default)
+            for depend in depends:
+                self._dependents.setdefault(depend, set()).add(name)
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            variable = self._variables.pop(name, None)
+            if variable is None:
+                return
+            for depend in variable.depends:
+                names = self._dependents[depend]
+                names.discard(name)
+                if not names:
+                    del self._dependents[depend]
+            self._stats.forget(variable.callback)
+            self._changed(name)
+
+    def removeScripts(self, scripts: Iterable[Script]) -> None:
+        """Remove providers of scripts, like scripts of reloaded module."""
+        scripts = set(scripts)
+        with self._lock:
+            for variable in tuple(self._variables.values()):
+                if getattr(variable.callback, '__self__', None) in scripts:
+                    self.remove(variable.name)
+
+    def _changed(self, name: str) -> None:
+        for dependent in self._dependents.get(name, ()):
+            variable = self._variables.get(dependent)
+            if variable is not None:
+                variable.stale = True
+
+    def invalidate(self, name: str) -> None:
+        """Compute variable again on its next use. Variables depending on it follow, if its value is changed."""
+        with self._lock:
+            variable = self._variables.get(name)
+            if variable is None:
+                return
+            variable.stale = True
+        if self._onInvalidate is not None:
+            self._onInvalidate()
+
+    def _evaluate(self, variable: _Variable, now: float) -> Any:
+        args = []
+        for depend in variable.depends:
+            value = self._refresh(depend, now)
+            if value is _Missing:
+                return variable.value   # Not computable yet. Keep the last value, if any.
+            args.append(value)
+        if not variable.stale and variable.expires > now:
+            return variable.value
+        started = perf_counter()
+        try:
+            value = variable.callback(*args)
+        except Exception as e:
+            self._stats.recordError(variable.callback)
+            logger.error(f'Script > {variable.callback.__qualname__} raised {e!r} while providing {variable.name}')
+            # Keep the last good value (or the default), and wait before calling the provider again.
+            variable.stale = False
+            variable.expires = now + (variable.ttl or _ErrorRetry)
+            if variable.value is _Missing and variable.default is not _Missing:
+                variable.value = variable.default
+                self._changed(variable.name)
+            return variable.value
+        finally:
+            self._stats.record(variable.callback, perf_counter() - started)
+        variable.stale = False
+        variable.expires = float('inf') if variable.ttl is None else now + variable.ttl
+        if variable.value is _Missing or variable.value != value:
+            variable.value = value
+            self._changed(variable.name)
+        return value
+
+    def _refresh(self, name: str, now: float) -> Any:
+        variable = self._variables.get(name)
+        return _Missing if variable is None else self._evaluate(variable, now)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """Value of variable, computed if it is expired or invalidated."""
+        with self._lock:
+            value = self._refresh(name, self._clock())
+        return default if value is _Missing else value
+
+    def resolve(
+            self,
+            names: Iterable[str],
+            check: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Values of variables with providers among names, like variables used by templates of a profile.
+
+        Args:
+            names (Iterable[str]) : Names of variables to resolve.
+            check (Optional[Callable[[Dict[str, Any]], None]]) : Called with {name: value} of each variable,
+                like RenderPlan.check. Values it raises for are counted as errors of their provider and left out,
+                so the previous value is kept where it is used.
+
+        Returns:
+            Dict of name : value. Variables without provider, failed to be computed or checked, are left out.
+        """
+        values: Dict[str, Any] = {}
+        if not self._variables:
+            return values
+        with self._lock:
+            now = self._clock()
+            for name in names:
+                value = self._refresh(name, now)
+                if value is _Missing:
+                    continue
+                if check is not None:
+                    try:
+                        check({name: value})
+                    except Exception as e:
+                        callback = self._variables[name].callback
+                        self._stats.recordError(callback)
+                        logger.error(
+                            f'Script > {callback.__qualname__} provided {value!r} for {name}, '
+                            f'which templates can\'t use : {e!r}'
+                        )
+                        continue
+                values[name] = value
+        return values
+
+
 class ScriptEngine:
     @classmethod
     def register(cls, script_cls: type, filename: str = None) -> type:
@@ -159,16 +583,104 @@ class ScriptEngine:
 
         return script_cls
 
-    def __init__(self, client, module):
+    @classmethod
+    def event(cls, func) -> CustomEvent:
+        """
+        Decorator declaring a custom event from a mock hook, like ScriptEvent members are declared from hooks of
+        Script. Scripts overriding the hook (`onCalled` for `def OnCalled(self)`) receive the event.
+        Events taking `profile` are only delivered to the script attached to that profile.
+        Declaring an event again (like when its module is reloaded) returns the same event object.
+
+        Returns:
+            CustomEvent object, which can be emitted with ScriptEngine.emit().
+        """
+        hookName = func.__name__[0].lower() + func.__name__[1:]
+        if any(member.eventName == hookName for member in ScriptEvent):
+            raise ValueError(f'{hookName} is a built-in event')
+        wrapper = ScriptEventWrapper(func, hookName)
+        events: Optional[Dict[str, CustomEvent]] = getattr(cls, '__events__', None)
+        if events is None:
+            events = {}
+            setattr(cls, '__events__', events)
+        event = events.get(hookName)
+        if event is None:
+            events[hookName] = event = CustomEvent(wrapper)
+        elif event.value.scope != wrapper.scope:
+            raise ValueError(f'Event {hookName} is already declared with different scope')
+        else:
+            event.value = wrapper
+        return event
+
+    @classmethod
+    def resolveEvent(cls, event: Union[Event, str]) -> Event:
+        """
+        Find event by its name, like `OnReload`, `onReload` or `onCalled`.
+
+        Raises:
+            ValueError : If there is no such event.
+        """
+        if not isinstance(event, str):
+            return event
+        member = ScriptEvent.__members__.get(event)
+        if member is not None:
+            return member
+        for member in ScriptEvent:
+            if member.eventName == event:
+                return member
+        events: Dict[str, CustomEvent] = getattr(cls, '__events__', None) or {}
+        custom = events.get(event[:1].lower() + event[1:])
+        if custom is None:
+            raise ValueError(f'Unknown event {event!r}')
+        return custom
+
+    @classmethod
+    def fromConfig(cls, client, module, config: JSON, clock: Callable[[], float] = monotonic) -> ScriptEngine:
+        """
+        Create ScriptEngine with `script_budget`, `script_workers` and `script_deadline` of config.json.
+        Worker pool backs off slow listeners on `clock` too.
+        """
+        workers: int = config.get(ConfigKeys.ScriptWorkers, 0)
+        return cls(
+            client, module,
+            budget=config.get(ConfigKeys.ScriptBudget, 0.1),
+            pool=ScriptPool(workers, config.get(ConfigKeys.ScriptDeadline, 1.0), clock=clock) if workers > 0 else None,
+            wakeup=getattr(client, '_wake', None),
+            clock=clock
+        )
+
+    def __init__(
+            self,
+            client,
+            module,
+            budget: float = 0.1,
+            pool: Optional[ScriptPool] = None,
+            wakeup: Optional[Callable[[], None]] = None,
+            clock: Callable[[], float] = monotonic
+    ):
         """
         Initialize ScriptEngine.
         Args:
             client (src.discordrpc.DiscordRPC) : RPC client to register scripts.
             module : Python module object referencing 'scripts/' module.
+            budget (float) : Seconds a listener may take before it is reported as slow.
+            pool (Optional[ScriptPool]) : Worker pool to run listeners on. Listeners are called inline if not given.
+            wakeup (Optional[Callable[[], None]]) : Called when a batched event is queued,
+                so the client loop can deliver it in time. (See timeUntilBatch())
+            clock (Callable[[], float]) : Monotonic clock in seconds, for batch windows and ttl of variables.
+                The scheduler's clock of the client.
         """
         print('Initializing ScriptEngine')
         self._client = client
         self._module = module
+        self._stats: ScriptStats = ScriptStats(budget)
+        self._pool: Optional[ScriptPool] = pool
+        self._wakeup: Optional[Callable[[], None]] = wakeup
+        self._clock: Callable[[], float] = clock
+        self._batchQueues: List[BatchQueue] = []
+        self._sequence: int = 0     # Keeps listeners of the same priority in the order of loading.
+        self._variables: VariableRegistry = VariableRegistry(
+            self._stats, clock=clock, onInvalidate=getattr(client, 'requestUpdate', None)
+        )
         registeredScripts = getattr(self.__class__, '__scripts__', None)
         pprint(registeredScripts, indent=4)
         self._scriptsMap: Dict[str, Dict[str, Script]] = {}        # filename: {classname: cls, classname: cls, ...}
@@ -184,38 +696,457 @@ class ScriptEngine:
         print('scripts list :')
         pprint(self._scriptsList)
         print('Collecting script event listeners...')
-        self._eventMap: Dict[ScriptEvent, List[Callable[..., Any]]] = {}
-        for event in ScriptEvent.__members__.values():
-            print(f'Collecting listeners of event {event.eventName}')
-            print(event)
-            for script in self._scriptsList:
-                callback = getattr(script, event.eventName, None)
-                if callback is not None:
-                    try:
-                        self._eventMap[event].append(callback)
-                    except KeyError:
-                        self._eventMap[event] = [callback]
+        # event : listeners, for events delivered to every script. Custom events are added on first use.
+        self._eventMap: Dict[Event, Tuple[Callable[..., Any], ...]] = {}
+        # event : [(-priority, sequence, listener)], kept sorted to build _eventMap.
+        self._ordered: Dict[Event, List[Tuple[int, int, Callable[..., Any]]]] = {}
+        # event : {(filename, classname) : listeners}, for events delivered to the script attached to profile.
+        self._profileEventMap: Dict[Event, Dict[Tuple[str, str], Tuple[Callable[..., Any], ...]]] = {}
+        self._buildDispatchTables()
         print('Collected event listener map : ')
         pprint(self._eventMap, indent=4)
+        logger.debug(f'Collected profile event map : {self._profileEventMap}')
+
+    @staticmethod
+    def isOverridden(script: Script, eventName: str) -> bool:
+        """
+        Check whether script overrides the hook of Script base class.
+
+        Args:
+            script (Script) : Script object to check.
+            eventName (str) : Name of the hook.
+
+        Returns:
+            False if the hook is an inherited no-op handler of Script.
+        """
+        return getattr(type(script), eventName, None) is not getattr(Script, eventName, None)
+
+    def _buildDispatchTables(self) -> None:
+        for event in ScriptEvent.__members__.values():
+            self._initEvent(event)
+        for filename, scripts in self._scriptsMap.items():
+            self._addListeners(filename, scripts)
+            self._addProviders(scripts)
+
+    def _initEvent(self, event: Event) -> None:
+        self._eventMap[event] = ()
+        self._ordered[event] = []
+        if event.scoped:
+            self._profileEventMap[event] = {}
+
+    def _ensureEvent(self, event: Event) -> None:
+        """Build listener table of custom event, on its first use."""
+        if event in self._eventMap:
+            return
+        self._initEvent(event)
+        for filename, scripts in self._scriptsMap.items():
+            self._addListeners(filename, scripts, (event,))
+
+    @staticmethod
+    def _subscribedMethods(scriptClass: type) -> Tuple[Tuple[str, Subscription], ...]:
+        """Methods of script class decorated with subscribe(). Cached in the class."""
+        methods = scriptClass.__dict__.get('__subscribed__')
+        if methods is None:
+            methods = tuple(
+                (attrName, subscription) for attrName in dir(scriptClass)
+                for subscription in getattr(getattr(scriptClass, attrName, None), '__subscriptions__', ())
+            )
+            setattr(scriptClass, '__subscribed__', methods)
+        return methods
+
+    def _subscriptions(self, script: Script, event: Event) -> List[Tuple[int, Callable[..., Any]]]:
+        """Listeners of script for the event, with their priority."""
+        found: List[Tuple[int, Callable[..., Any]]] = []
+        named = self.isOverridden(script, event.eventName)
+        for attrName, subscription in self._subscribedMethods(type(script)):
+            if subscription.matches(event):
+                if attrName == event.eventName:
+                    named = False   # Subscribed explicitly, with its own priority.
+                callback = getattr(script, attrName)
+                if subscription.batch is not None:
+                    callback = BatchQueue(callback, event, subscription.batch, self._clock)
+                    self._batchQueues.append(callback)
+                found.append((subscription.priority, callback))
+        if named:
+            found.append((0, getattr(script, event.eventName)))
+        return found
+
+    def _addListeners(
+            self,
+            filename: str,
+            scripts: Dict[str, Script],
+            events: Optional[Iterable[Event]] = None
+    ) -> None:
+        for event in tuple(self._eventMap) if events is None else events:
+            ordered = self._ordered[event]
+            for scriptName, script in scripts.items():
+                entries = []
+                for priority, callback in self._subscriptions(script, event):
+                    entries.append((-priority, self._sequence, callback))
+                    self._sequence += 1
+                if not entries:
+                    continue
+                if event.scoped:
+                    entries.sort(key=lambda entry: entry[:2])
+                    self._profileEventMap[event][(filename, scriptName)] = tuple(entry[2] for entry in entries)
+                else:
+                    ordered.extend(entries)
+            if not event.scoped:
+                ordered.sort(key=lambda entry: entry[:2])
+                self._eventMap[event] = tuple(entry[2] for entry in ordered)
+
+    @staticmethod
+    def _providedMethods(scriptClass: type) -> Tuple[Tuple[str, Provider], ...]:
+        """Methods of script class decorated with provide(). Cached in the class."""
+        methods = scriptClass.__dict__.get('__provided__')
+        if methods is None:
+            methods = tuple(
+                (attrName, provider) for attrName in dir(scriptClass)
+                for provider in (getattr(getattr(scriptClass, attrName, None), '__provider__', None),)
+                if provider is not None
+            )
+            setattr(scriptClass, '__provided__', methods)
+        return methods
+
+    def _addProviders(self, scripts: Dict[str, Script]) -> None:
+        for script in scripts.values():
+            for attrName, provider in self._providedMethods(type(script)):
+                try:
+                    self._variables.add(
+                        provider.name, getattr(script, attrName), provider.ttl, provider.depends, provider.default
+                    )
+                except ValueError as e:
+                    logger.error(f'Ignored variable provider {script.name}.{attrName} : {e}')
+
+    def _forget(self, callback: Callable[..., Any]) -> None:
+        if isinstance(callback, BatchQueue):
+            self._batchQueues.remove(callback)
+            callback = callback.callback
+        self._stats.forget(callback)
+
+    def _removeListeners(self, filename: str, scripts: Dict[str, Script]) -> None:
+        removed = set(scripts.values())
+        for event in tuple(self._eventMap):
+            if event.scoped:
+                table = self._profileEventMap[event]
+                for scriptName in scripts:
+                    for callback in table.pop((filename, scriptName), ()):
+                        self._forget(callback)
+                continue
+            kept = []
+            for entry in self._ordered[event]:
+                if getattr(entry[2], '__self__', None) in removed:
+                    self._forget(entry[2])
+                else:
+                    kept.append(entry)
+            self._ordered[event] = kept
+            self._eventMap[event] = tuple(entry[2] for entry in kept)
+
+    def loadModule(self, filename: str) -> Dict[str, Script]:
+        """
+        Import (or re-import, if already imported) script module, and instantiate scripts registered in it.
+        Scripts in use are not changed. Use replaceScripts() to apply returned scripts.
+        If the module fails to import, previously registered scripts are kept, and the error is raised.
+
+        Args:
+            filename (str) : Name of the module in scripts package, like `sample`.
+
+        Returns:
+            Dict of class name : new script object.
+        """
+        registered = getattr(ScriptEngine, '__scripts__', None)
+        if registered is None:
+            registered = {}
+            setattr(ScriptEngine, '__scripts__', registered)
+        previous = registered.pop(filename, None)
+        moduleName = f'{self._module.__name__}.{filename}'
+        try:
+            module = sys.modules.get(moduleName)
+            if module is None:
+                importlib.import_module(moduleName)
+            else:
+                importlib.reload(module)
+        except BaseException:
+            if previous is not None:
+                registered[filename] = previous
+            raise
+        return {scriptName: script(self._client) for scriptName, script in registered.get(filename, {}).items()}
+
+    def replaceScripts(self, filename: str, scripts: Dict[str, Script]) -> Dict[str, Script]:
+        """
+        Replace scripts of a module, rebuilding only listeners of that module.
+
+        Args:
+            filename (str) : Name of the module in scripts package.
+            scripts (Dict[str, Script]) : Dict of class name : script object, returned by loadModule().
+
+        Returns:
+            Dict of class name : replaced script object.
+        """
+        old = self._scriptsMap.get(filename, {})
+        self._removeListeners(filename, old)
+        self._variables.removeScripts(old.values())
+        self._scriptsMap[filename] = scripts
+        self._scriptsList = [script for script in self._scriptsList if script not in old.values()]
+        self._scriptsList.extend(scripts.values())
+        self._addListeners(filename, scripts)
+        self._addProviders(scripts)
+        return old
+
+    def listeners(self, event: Union[Event, str], *args, **kwargs) -> Tuple[Callable[..., Any], ...]:
+        """
+        Listeners which should receive the event, in order of priority.
+
+        Args:
+            event (Union[ScriptEvent, CustomEvent, str]) : Event to emit, or its name.
+            *args (Any) : Positional arguments of the event.
+            **kwargs (Any) : Keyword arguments of the event.
+
+        Returns:
+            Tuple of listener callables. Batched listeners are BatchQueue objects.
+        """
+        if event.__class__ is str:
+            event = self.resolveEvent(event)
+        if not event.scoped:
+            listeners = self._eventMap.get(event)
+            if listeners is None:
+                self._ensureEvent(event)
+                listeners = self._eventMap[event]
+            return listeners
+        table = self._profileEventMap.get(event)
+        if table is None:
+            self._ensureEvent(event)
+            table = self._profileEventMap[event]
+        index, name = event.value.scope
+        target = args[index] if len(args) > index else kwargs[name]
+        return table.get(target.scriptInfo, ())
 
     @property
     def client(self):
         return self._client
 
+    @property
+    def variables(self) -> VariableRegistry:
+        """Template variables provided by scripts."""
+        return self._variables
+
     @property
     def module(self):
         return self._module
 
-    def emit(self, event: ScriptEvent, *args, **kwargs):
-        for callback in self._eventMap[event]:
-            callback(*args, **kwargs)
+    def stats(self) -> Dict[str, JSON]:
+        """
+        Timing statistics of every listener called so far.
 
-    def getScript(self, fileName: str, scriptName: str) -> Optional[Script]:
-        print(f'{fileName=},{scriptName=}')
-        pprint(f'{self._scriptsMap=}')
-        result = tuple(filter(lambda script: script.name == scriptName, self._scriptsMap[fileName].values()))
-        pprint(result)
+        Returns:
+            Dict of listener name (like `sample.HWStatus.onReload`) : calls, total/mean/max time and p50/p95/p99.
+        """
+        return self._stats.toJson()
+
+    @property
+    def scriptStats(self) -> ScriptStats:
+        return self._stats
+
+    def registerMetrics(self, registry: MetricsRegistry) -> None:
+        """Report calls, time and errors of every listener to registry, labeled by listener name."""
+        def collect(field: str):
+            return lambda: (({'listener': stats.name}, getattr(stats, field)) for stats in self._stats.handlers())
+        registry.counter('script_calls_total', 'Calls of script listeners.').collect(collect('calls'))
+        registry.counter('script_seconds_total', 'Time spent in script listeners.').collect(collect('totalTime'))
+        registry.counter('script_errors_total', 'Exceptions raised by script listeners.').collect(collect('errors'))
+        registry.counter(
+            'script_over_budget_total', 'Calls of script listeners slower than script_budget.'
+        ).collect(collect('overBudget'))
+        registry.gauge('script_batches_pending', 'Batched listeners with queued events.').track(
+            lambda: sum(queue.dueAt is not None for queue in self._batchQueues)
+        )
+
+    def _invoke(self, callback: Callable[..., Any], *args, **kwargs) -> None:
+        started = perf_counter()
         try:
-            return result[0]
-        except IndexError:
+            result = callback(*args, **kwargs)
+            if inspect.iscoroutine(result):
+                # Async hooks are also supported on the blocking client. They are driven to completion here.
+                asyncio.run(result)
+        except Exception:
+            self._stats.recordError(callback)
+            raise
+        finally:
+            self._stats.record(callback, perf_counter() - started)
+
+    async def _invokeAsync(self, callback: Callable[..., Any], *args, **kwargs) -> None:
+        started = perf_counter()
+        try:
+            await callback(*args, **kwargs)
+        except Exception:
+            self._stats.recordError(callback)
+            raise
+        finally:
+            self._stats.record(callback, perf_counter() - started)
+
+    @property
+    def pool(self) -> Optional[ScriptPool]:
+        return self._pool
+
+    def emit(self, event: Union[Event, str], *args, **kwargs):
+        self._dispatch(self.listeners(event, *args, **kwargs), *args, **kwargs)
+
+    def emitTo(self, scripts: Iterable[Script], event: Union[Event, str], *args, **kwargs):
+        """
+        Emit event only to given scripts, like OnStart to scripts loaded after the client is started.
+
+        Args:
+            scripts (Iterable[Script]) : Scripts to receive the event.
+            event (Union[ScriptEvent, CustomEvent, str]) : Event to emit.
+            *args (Any) : Positional arguments passed to listeners.
+            **kwargs (Any) : Keyword arguments passed to listeners.
+        """
+        self._dispatch(self.listenersOf(scripts, event, *args, **kwargs), *args, **kwargs)
+
+    def listenersOf(
+            self,
+            scripts: Iterable[Script],
+            event: Union[Event, str],
+            *args,
+            **kwargs
+    ) -> Tuple[Callable[..., Any], ...]:
+        """Listeners of given scripts which should receive the event. See listeners()."""
+        targets = set(scripts)
+        return tuple(
+            callback for callback in self.listeners(event, *args, **kwargs)
+            if getattr(callback, '__self__', None) in targets
+        )
+
+    def _enqueue(self, listeners: Tuple[Callable[..., Any], ...], args, kwargs) -> Tuple[Callable[..., Any], ...]:
+        """Queue the event to batched listeners, and return the other listeners."""
+        immediate: List[Callable[..., Any]] = []
+        queued = False
+        for callback in listeners:
+            if isinstance(callback, BatchQueue):
+                queued |= callback(*args, **kwargs)
+            else:
+                immediate.append(callback)
+        if queued and self._wakeup is not None:
+            self._wakeup()
+        return tuple(immediate)
+
+    def timeUntilBatch(self) -> Optional[float]:
+        """Seconds until queued events of batched listeners should be delivered. None if nothing is queued."""
+        deadlines = [queue.dueAt for queue in self._batchQueues if queue.dueAt is not None]
+        if not deadlines:
             return None
+        return max(0.0, min(deadlines) - self._clock())
+
+    def _takeBatches(self, force: bool) -> List[Tuple[BatchQueue, List[EventArgs]]]:
+        now = self._clock()
+        return [
+            (queue, queue.take()) for queue in tuple(self._batchQueues)
+            if queue.dueAt is not None and (force or queue.dueAt <= now)
+        ]
+
+    def flushBatches(self, force: bool = False) -> None:
+        """
+        Deliver queued events to batched listeners whose batch window has passed. Called by the client loop.
+
+        Args:
+            force (bool) : Deliver every queued event now, like when the client is closed.
+        """
+        for queue, events in self._takeBatches(force):
+            self._dispatch((queue.callback,), events)
+
+    async def flushBatchesAsync(self, force: bool = False) -> None:
+        """Coroutine version of flushBatches()."""
+        for queue, events in self._takeBatches(force):
+            await self._dispatchAsync((queue.callback,), queue.event, events)
+
+    def _dispatch(self, listeners: Tuple[Callable[..., Any], ...], *args, **kwargs):
+        if self._batchQueues:
+            listeners = self._enqueue(listeners, args, kwargs)
+        if self._pool is not None:
+            self._pool.run(listeners, self._invoke, *args, **kwargs)
+            return
+        for callback in listeners:
+            self._invoke(callback, *args, **kwargs)
+
+    async def emitAsync(self, event: Union[Event, str], *args, **kwargs):
+        """
+        Emit event on the running event loop.
+        Coroutine hooks are awaited directly, and blocking hooks are run on the loop's default executor
+        (or on ScriptPool, if engine has one), so a slow script does not block the event loop.
+        Listeners run concurrently.
+
+        Args:
+            event (Union[ScriptEvent, CustomEvent, str]) : Event to emit.
+            *args (Any) : Positional arguments passed to listeners.
+            **kwargs (Any) : Keyword arguments passed to listeners.
+        """
+        event = self.resolveEvent(event)
+        await self._dispatchAsync(self.listeners(event, *args, **kwargs), event, *args, **kwargs)
+
+    async def emitToAsync(self, scripts: Iterable[Script], event: Union[Event, str], *args, **kwargs):
+        """Coroutine version of emitTo()."""
+        event = self.resolveEvent(event)
+        await self._dispatchAsync(self.listenersOf(scripts, event, *args, **kwargs), event, *args, **kwargs)
+
+    async def _dispatchAsync(self, listeners: Tuple[Callable[..., Any], ...], event: Event, *args, **kwargs):
+        if self._batchQueues:
+            listeners = self._enqueue(listeners, args, kwargs)
+        loop = asyncio.get_running_loop()
+        callbacks: List[Callable[..., Any]] = []
+        pending = []
+        blocking: List[Callable[..., Any]] = []
+        for callback in listeners:
+            if inspect.iscoroutinefunction(callback):
+                coroutine = self._invokeAsync(callback, *args, **kwargs)
+                if self._pool is not None:
+                    coroutine = asyncio.wait_for(coroutine, self._pool.deadline)
+                callbacks.append(callback)
+                pending.append(coroutine)
+            elif self._pool is None:
+                callbacks.append(callback)
+                pending.append(loop.run_in_executor(None, functools.partial(self._invoke, callback, *args, **kwargs)))
+            else:
+                blocking.append(callback)
+        if blocking:
+            callbacks.append(self._pool.run)
+            pending.append(loop.run_in_executor(
+                None, functools.partial(self._pool.run, blocking, self._invoke, *args, **kwargs)
+            ))
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        for callback, result in zip(callbacks, results):
+            if isinstance(result, BaseException):
+                self._client.logger.error(
+                    f'Script > {callback.__qualname__} raised {result!r} while handling {event.eventName}'
+                )
+
+    def shutdown(self) -> None:
+        """Release resources of ScriptEngine, like worker threads of ScriptPool."""
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def isLoaded(self, fileName: str) -> bool:
+        return fileName in self._scriptsMap
+
+    def loadedScripts(self, fileName: str) -> Dict[str, Script]:
+        """Scripts of module if it is loaded, without importing it."""
+        return self._scriptsMap.get(fileName, {})
+
+    def getScripts(self, fileName: str) -> Dict[str, Script]:
+        """
+        Scripts of module. Module is imported on first use, so unused modules and their dependencies are never loaded.
+
+        Args:
+            fileName (str) : Name of the module in scripts package, like `sample`.
+
+        Returns:
+            Dict of class name : script object.
+        """
+        scripts = self._scriptsMap.get(fileName)
+        if scripts is None:
+            logger.info(f'Loading scripts in {fileName}')
+            scripts = self.loadModule(fileName)
+            self.replaceScripts(fileName, scripts)
+        return scripts
+
+    def getScript(self, fileName: str, scriptName: str) -> Optional[Script]:
+        return self.getScripts(fileName).get(scriptName)
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import marshal
+import os
+import time
+from typing import List, Optional, Tuple
+
+from src.constants import ActivityLimits, ResourceKeys
+from src.type_hints import JSON
+
+logger = logging.getLogger('pyrorpc.snapshot')
+
+# Bumped when the layout of snapshot, or the way profiles are validated, is changed.
+SnapshotVersion: int = 2
+
+# Validation depends on known resources and limits. Snapshots validated against other ones are not used.
+_Rules: str = hashlib.sha256(repr((
+    sorted(ResourceKeys), sorted((key, value) for key, value in vars(ActivityLimits).items() if not key.startswith('_'))
+)).encode()).hexdigest()
+
+# Files changed less than this many nanoseconds before the snapshot was taken may be changed again
+# without changing their mtime. Snapshots of them are checked by hash instead.
+_RacyWindow: int = 2_000_000_000
+
+
+class ProfileSnapshot:
+    """
+    Binary snapshot of validated profiles.json, so starting again does not parse and validate the file again.
+
+    Snapshots are keyed on mtime and size of the source file. If they are changed but the content hash is the same
+    (the file was touched or copied), the snapshot is still used. Snapshots are written with marshal,
+    which is smaller and much faster to load than json. Broken or outdated snapshots are ignored.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Initialize ProfileSnapshot.
+
+        Args:
+            path (str) : Path of the snapshot file.
+        """
+        self._path: str = path
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @staticmethod
+    def _digest(source: bytes) -> bytes:
+        return hashlib.sha256(source).digest()
+
+    def _read(self) -> Optional[tuple]:
+        try:
+            with open(self._path, mode='rb') as f:
+                # marshal.load() reads file objects in small pieces, which is several times slower.
+                record = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(record, tuple) or len(record) != 7 or record[0] != (SnapshotVersion, _Rules):
+            return None
+        return record
+
+    def load(self, sourcePath: str) -> Tuple[bytes, Optional[Tuple[str, List[JSON], List[str]]]]:
+        """
+        Load snapshot of the source file.
+
+        Args:
+            sourcePath (str) : Path of profiles.json.
+
+        Returns:
+            Tuple of content of the source file (empty if it was not read), and (format, profiles, keys)
+            of the snapshot. Snapshot is None if there is no valid snapshot of the current content.
+        """
+        stat = os.stat(sourcePath)
+        record = self._read()
+        if record is not None and (record[1], record[2]) == (stat.st_mtime_ns, stat.st_size):
+            self.hits += 1
+            return b'', record[4:]
+        with open(sourcePath, mode='rb') as f:
+            source = f.read()
+        if record is not None and record[3] == self._digest(source):
+            # Same content with different mtime. Take snapshot again, so the next start is matched by stat.
+            self.hits += 1
+            self.save(sourcePath, source, *record[4:])
+            return source, record[4:]
+        self.misses += 1
+        return source, None
+
+    def save(self, sourcePath: str, source: bytes, profileFormat: str, profiles: List[JSON], keys: List[str]) -> bool:
+        """
+        Write snapshot of validated profiles. Snapshots are replaced atomically, so readers never see half of it.
+
+        Args:
+            sourcePath (str) : Path of profiles.json.
+            source (bytes) : Content of profiles.json the profiles were parsed from.
+            profileFormat (str) : `format` of profiles.json.
+            profiles (List[Dict[str, Any]]) : Validated json data of each profile.
+            keys (List[str]) : Canonical json of each profile. See ProfileStore.profileKey().
+
+        Returns:
+            True if snapshot is written.
+        """
+        try:
+            stat = os.stat(sourcePath)
+            mtime = stat.st_mtime_ns
+            if stat.st_size != len(source) or time.time_ns() - mtime < _RacyWindow:
+                mtime = 0   # Never matched by stat. Hash decides.
+            record = ((SnapshotVersion, _Rules), mtime, stat.st_size, self._digest(source), profileFormat, profiles, keys)
+            temp = f'{self._path}.{os.getpid()}.tmp'
+            try:
+                with open(temp, mode='wb') as f:
+                    f.write(marshal.dumps(record))
+                os.replace(temp, self._path)
+            except BaseException:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+        except (OSError, ValueError) as e:
+            # Snapshots only make starting faster. Failing to write one is not an error of the client.
+            logger.debug(f'Failed to write profile snapshot {self._path} : {e!r}')
+            return False
+        return True
+
+    def clear(self) -> None:
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
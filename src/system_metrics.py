@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import deque
+from time import monotonic, sleep
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+try:
+    import psutil
+except ImportError:     # psutil is only needed for the default cpu/ram metrics.
+    psutil = None
+
+logger = logging.getLogger('pyrorpc.metrics')
+
+
+class RingBuffer:
+    """
+    Fixed size history of samples.
+    Latest value, average, min and max of the stored samples are available in O(1).
+    """
+
+    def __init__(self, capacity: int) -> None:
+        if capacity <= 0:
+            raise ValueError('RingBuffer.capacity must be positive!')
+        self._capacity: int = capacity
+        self._values: List[float] = [0.0] * capacity
+        self._count: int = 0        # Number of samples ever appended.
+        self._sum: float = 0.0
+        # Monotonic queues of (sample number, value), used to get min/max of the window in O(1).
+        self._mins: Deque[Tuple[int, float]] = deque()
+        self._maxs: Deque[Tuple[int, float]] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def __len__(self) -> int:
+        return min(self._count, self._capacity)
+
+    def append(self, value: float) -> None:
+        with self._lock:
+            index = self._count % self._capacity
+            if self._count >= self._capacity:
+                self._sum -= self._values[index]
+            self._values[index] = value
+            self._sum += value
+            oldest = self._count - self._capacity + 1
+            while self._mins and self._mins[-1][1] >= value:
+                self._mins.pop()
+            self._mins.append((self._count, value))
+            if self._mins[0][0] < oldest:
+                self._mins.popleft()
+            while self._maxs and self._maxs[-1][1] <= value:
+                self._maxs.pop()
+            self._maxs.append((self._count, value))
+            if self._maxs[0][0] < oldest:
+                self._maxs.popleft()
+            self._count += 1
+
+    @property
+    def latest(self) -> Optional[float]:
+        if self._count == 0:
+            return None
+        return self._values[(self._count - 1) % self._capacity]
+
+    @property
+    def average(self) -> Optional[float]:
+        with self._lock:
+            if self._count == 0:
+                return None
+            return self._sum / min(self._count, self._capacity)
+
+    @property
+    def min(self) -> Optional[float]:
+        with self._lock:
+            return self._mins[0][1] if self._mins else None
+
+    @property
+    def max(self) -> Optional[float]:
+        with self._lock:
+            return self._maxs[0][1] if self._maxs else None
+
+    def values(self) -> List[float]:
+        """
+        Stored samples.
+
+        Returns:
+            List of samples, from oldest to latest.
+        """
+        with self._lock:
+            if self._count <= self._capacity:
+                return self._values[:self._count]
+            index = self._count % self._capacity
+            return self._values[index:] + self._values[:index]
+
+
+class MetricsSampler:
+    """
+    Samples system metrics on its own thread at fixed interval, and keeps their history in RingBuffers.
+    Scripts read sampled values from here instead of measuring them on the presence thread.
+
+    Sampling stops while nobody reads metrics, like while discord is not connected or no template uses them,
+    and starts again on the next read. That read gets values from before sampling stopped.
+    """
+
+    def __init__(
+            self,
+            interval: float = 1.0,
+            capacity: int = 60,
+            defaults: bool = True,
+            idleAfter: Optional[float] = 60.0
+    ) -> None:
+        """
+        Initialize MetricsSampler.
+
+        Args:
+            interval (float) : Seconds between two samples.
+            capacity (int) : Number of samples to keep for each metric.
+            defaults (bool) : Register default `cpu` and `ram` metrics, if psutil is available.
+            idleAfter (Optional[float]) : Seconds without reads (by get(), latest() or average()) after which
+                sampling stops until the next read. None samples all the time.
+        """
+        self._interval: float = interval
+        self._capacity: int = capacity
+        self._idleAfter: Optional[float] = idleAfter
+        self._sources: Dict[str, Callable[[], float]] = {}
+        self._buffers: Dict[str, RingBuffer] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._demand = threading.Event()    # Set by reads, to wake the idle sampler up.
+        self._idle: bool = False
+        self._readAt: float = monotonic()
+        self._wakeups: int = 0
+        if defaults and psutil is not None:
+            self.addMetric('cpu', lambda: psutil.cpu_percent(interval=None))
+            self.addMetric('ram', lambda: psutil.virtual_memory().percent)
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def metrics(self) -> Tuple[str, ...]:
+        return tuple(self._sources)
+
+    @property
+    def idle(self) -> bool:
+        """Whether sampling is stopped until metrics are read again."""
+        return self._idle
+
+    @property
+    def wakeups(self) -> int:
+        """Times the sampler thread woke up."""
+        return self._wakeups
+
+    def addMetric(self, name: str, source: Callable[[], float]) -> RingBuffer:
+        """
+        Register new metric to sample.
+
+        Args:
+            name (str) : Name of the metric.
+            source (Callable[[], float]) : Function measuring the metric. Called on sampler thread.
+
+        Returns:
+            RingBuffer storing samples of the metric.
+        """
+        if name in self._sources:
+            raise ValueError(f'Metric {name} is already registered!')
+        self._buffers[name] = buffer = RingBuffer(self._capacity)
+        self._sources[name] = source
+        return buffer
+
+    def _read(self) -> None:
+        self._readAt = monotonic()
+        if self._idle:
+            self._demand.set()
+
+    def get(self, name: str) -> RingBuffer:
+        self._read()
+        return self._buffers[name]
+
+    def latest(self, name: str) -> Optional[float]:
+        self._read()
+        return self._buffers[name].latest
+
+    def average(self, name: str) -> Optional[float]:
+        self._read()
+        return self._buffers[name].average
+
+    def sample(self) -> None:
+        """Take one sample of every metric."""
+        for name, source in tuple(self._sources.items()):
+            try:
+                value = source()
+            except Exception as e:
+                logger.error(f'Failed to sample metric {name} : {e!r}')
+                continue
+            self._buffers[name].append(value)
+
+    def _unread(self) -> bool:
+        return self._idleAfter is not None and monotonic() - self._readAt > self._idleAfter
+
+    def _run(self) -> None:
+        while True:
+            if self._unread():
+                self._idle = True
+                self._demand.clear()
+                if self._unread():  # Not read while going idle.
+                    self._demand.wait()
+                self._idle = False
+                if self._stopped.is_set():
+                    return
+            elif self._stopped.wait(self._interval):
+                return
+            self._wakeups += 1
+            self.sample()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        if psutil is not None and 'cpu' in self._sources:
+            # The first cpu_percent() call has nothing to compare with, and always returns 0.
+            psutil.cpu_percent(interval=None)
+            sleep(0.1)
+        # Take the first sample right away, so values are available to scripts from the start.
+        self.sample()
+        self._stopped.clear()
+        self._readAt = monotonic()
+        self._thread = threading.Thread(target=self._run, name='pyrorpc-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._demand.set()
+        self._thread.join()
+        self._thread = None
+        self._idle = False
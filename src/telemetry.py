@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import socketserver
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from src.constants import ExportKeys
+from src.type_hints import JSON
+
+try:
+    import psutil
+except ImportError:     # Resident memory is read from /proc without psutil.
+    psutil = None
+
+logger = logging.getLogger('pyrorpc.telemetry')
+
+LabelKey = Tuple[Tuple[str, str], ...]
+Sample = Union[float, Callable[[], Optional[float]]]
+
+# Upper bounds (seconds) of latency histograms, from sub-millisecond IPC round trips to stalled loops.
+LatencyBuckets: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _labelKey(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _formatLabels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _formatValue(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricFamily:
+    """
+    Metric and its samples by label set. Samples are either values set by the code, or callables which are
+    evaluated only when the metric is scraped, so counters already kept elsewhere cost nothing until then.
+    """
+    type: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self._samples: Dict[LabelKey, Sample] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = []
+        self._lock = threading.Lock()
+
+    def track(self, func: Callable[[], Optional[float]], **labels: str) -> None:
+        """Report the value returned by func when scraped. Nothing is reported while it returns None."""
+        self._samples[_labelKey(labels)] = func
+
+    def collect(self, func: Callable[[], Iterable[Tuple[Dict[str, str], float]]]) -> None:
+        """Report (labels, value) pairs returned by func when scraped, for label sets which are not known ahead."""
+        self._collectors.append(func)
+
+    def remove(self, **labels: str) -> None:
+        self._samples.pop(_labelKey(labels), None)
+
+    def _lines(self) -> Iterable[str]:
+        for key, sample in tuple(self._samples.items()):
+            value = sample() if callable(sample) else sample
+            if value is not None:
+                yield f'{self.name}{_formatLabels(key)} {_formatValue(value)}'
+        for collector in self._collectors:
+            for labels, value in collector():
+                yield f'{self.name}{_formatLabels(_labelKey(labels))} {_formatValue(value)}'
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.type}']
+        try:
+            lines.extend(self._lines())
+        except Exception as e:
+            # A broken callback must not break the whole scrape.
+            logger.warning(f'Failed to collect {self.name} : {e!r}')
+        return '\n'.join(lines)
+
+
+class Counter(MetricFamily):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labelKey(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+
+class Gauge(MetricFamily):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        self._samples[_labelKey(labels)] = value
+
+
+class HistogramChild:
+    """Histogram of one label set. Counts are not cumulative here, and summed up when rendered."""
+    __slots__ = ('_bounds', '_counts', 'sum', 'count')
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self._bounds: Sequence[float] = bounds
+        self._counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        # Called from the client loop only, so no lock. A scrape may see one observation half recorded.
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """(upper bound, cumulative count) of each bucket, ending with +Inf."""
+        cumulative = 0
+        result = []
+        for bound, count in zip(tuple(self._bounds) + (math.inf,), self._counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+
+class Histogram(MetricFamily):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LatencyBuckets) -> None:
+        super().__init__(name, documentation)
+        self._bounds: Tuple[float, ...] = tuple(sorted(buckets))
+        self._children: Dict[LabelKey, HistogramChild] = {}
+
+    def labels(self, **labels: str) -> HistogramChild:
+        """Histogram of the label set. Keep it to observe values without building label keys every time."""
+        key = _labelKey(labels)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, HistogramChild(self._bounds))
+        return child
+
+    def observe(self, value: float, **labels: str) -> None:
+        self.labels(**labels).observe(value)
+
+    def _lines(self) -> Iterable[str]:
+        for key, child in tuple(self._children.items()):
+            for bound, count in child.buckets():
+                yield f'{self.name}_bucket{_formatLabels(key, (("le", _formatValue(bound)),))} {count}'
+            yield f'{self.name}_sum{_formatLabels(key)} {_formatValue(child.sum)}'
+            yield f'{self.name}_count{_formatLabels(key)} {child.count}'
+
+
+def residentMemory() -> Optional[float]:
+    """Resident set size of this process in bytes, or None if it cannot be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', mode='rt') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MetricsRegistry:
+    """
+    Metrics of the presence runtime, rendered in Prometheus text format.
+    Families are created on first use and shared afterwards, so several clients (see PresencePool) can report
+    into one registry with their own labels.
+    """
+
+    ContentType: str = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix: str = 'pyrorpc_') -> None:
+        self._prefix: str = prefix
+        self._families: Dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+        self.gauge('process_resident_memory_bytes', 'Resident memory size of the process.').track(residentMemory)
+
+    def _family(self, cls, name: str, documentation: str, *args) -> MetricFamily:
+        name = self._prefix + name
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                self._families[name] = family = cls(name, documentation, *args)
+            elif type(family) is not cls:
+                raise ValueError(f'Metric {name} is already registered as {family.type}')
+        return family
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._family(Counter, name, documentation)
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._family(Gauge, name, documentation)
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LatencyBuckets) -> Histogram:
+        return self._family(Histogram, name, documentation, buckets)
+
+    def get(self, name: str) -> Optional[MetricFamily]:
+        return self._families.get(self._prefix + name)
+
+    def render(self) -> str:
+        """Every metric in Prometheus text exposition format."""
+        with self._lock:
+            families = tuple(self._families.values())
+        return '\n'.join(family.render() for family in families) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', MetricsRegistry.ContentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix sockets have no peer address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f'{self.address_string()} > {format % args}')
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self) -> None:
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # Left by a previous run which was killed.
+        super().server_bind()
+
+
+class MetricsExporter:
+    """
+    Serves MetricsRegistry over HTTP on a local port or a unix socket (`GET /metrics`),
+    and optionally writes it to a file every `interval` seconds. Metrics are rendered only when requested.
+    """
+
+    @classmethod
+    def fromConfig(cls, registry: MetricsRegistry, config: JSON) -> MetricsExporter:
+        """Create MetricsExporter from `metrics_export` object of config.json."""
+        return cls(
+            registry,
+            host=config.get(ExportKeys.Host, '127.0.0.1'),
+            port=config.get(ExportKeys.Port),
+            socketPath=config.get(ExportKeys.Socket),
+            filePath=config.get(ExportKeys.File),
+            interval=config.get(ExportKeys.Interval, 15)
+        )
+
+    def __init__(
+            self,
+            registry: MetricsRegistry,
+            host: str = '127.0.0.1',
+            port: Optional[int] = None,
+            socketPath: Optional[str] = None,
+            filePath: Optional[str] = None,
+            interval: float = 15
+    ) -> None:
+        """
+        Initialize MetricsExporter.
+
+        Args:
+            registry (MetricsRegistry) : Metrics to export.
+            host (str) : Address to listen on. Only local address by default.
+            port (Optional[int]) : TCP port to serve metrics on. 0 chooses a free port.
+            socketPath (Optional[str]) : Unix socket to serve metrics on, like `curl --unix-socket PATH localhost`.
+            filePath (Optional[str]) : File to write metrics to, in the format of node exporter's textfile collector.
+            interval (float) : Seconds between two writes of the file.
+        """
+        self._registry: MetricsRegistry = registry
+        self._host: str = host
+        self._port: Optional[int] = port
+        self._socketPath: Optional[str] = socketPath
+        self._filePath: Optional[str] = filePath
+        self._interval: float = interval
+        self._servers: List[socketserver.BaseServer] = []
+        self._threads: List[threading.Thread] = []
+        self._stopped = threading.Event()
+
+    @property
+    def address(self) -> Optional[Tuple[str, int]]:
+        """(host, port) the HTTP server is listening on, or None if it is not serving on TCP."""
+        for server in self._servers:
+            if isinstance(server, _HTTPServer):
+                return server.server_address[:2]
+        return None
+
+    def _serve(self, server: socketserver.BaseServer) -> None:
+        server.registry = self._registry
+        self._servers.append(server)
+        thread = threading.Thread(target=server.serve_forever, name='pyrorpc-metrics', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def writeFile(self) -> None:
+        temp = f'{self._filePath}.{os.getpid()}.tmp'
+        with open(temp, mode='wt', encoding='utf-8') as f:
+            f.write(self._registry.render())
+        os.replace(temp, self._filePath)     # Never let collectors read a half written file.
+
+    def _writeLoop(self) -> None:
+        while not self._stopped.wait(self._interval):
+            try:
+                self.writeFile()
+            except OSError as e:
+                logger.warning(f'Failed to write metrics to {self._filePath} : {e!r}')
+
+    def start(self) -> None:
+        if self._port is not None:
+            self._serve(_HTTPServer((self._host, self._port), _MetricsHandler))
+            logger.info(f'Serving metrics on http://{self.address[0]}:{self.address[1]}/metrics')
+        if self._socketPath is not None:
+            self._serve(_UnixHTTPServer(self._socketPath, _MetricsHandler))
+            logger.info(f'Serving metrics on unix socket {self._socketPath}')
+        if self._filePath is not None:
+            thread = threading.Thread(target=self._writeLoop, name='pyrorpc-metrics-file', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        if self._socketPath is not None and os.path.exists(self._socketPath):
+            os.remove(self._socketPath)
+        for thread in self._threads:
+            thread.join()
+        self._servers.clear()
+        self._threads.clear()
+        if self._filePath is not None:
+            try:
+                self.writeFile()    # Final values.
+            except OSError as e:
+                logger.warning(f'Failed to write metrics to {self._filePath} : {e!r}')
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import logging
+import re
+from functools import lru_cache
+from string import Formatter
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, List, Mapping, Optional, Set, Tuple
+
+logger = logging.getLogger('pyrorpc.templates')
+
+_formatter = Formatter()
+_rootName = re.compile(r'[^.\[]*')
+_CacheSize: int = 256    # Compiled templates kept. Scripts setting changing text must not grow the cache forever.
+
+
+class TemplateField:
+    """A replacement field of template, like `{cpu:.1f}`."""
+    __slots__ = ('name', 'fieldName', 'conversion', 'formatSpec', 'raw')
+
+    def __init__(self, fieldName: str, conversion: Optional[str], formatSpec: str) -> None:
+        self.name: str = _rootName.match(fieldName).group()
+        self.fieldName: str = fieldName
+        self.conversion: Optional[str] = conversion
+        self.formatSpec: str = formatSpec
+        self.raw: str = '{' + fieldName + ('' if conversion is None else '!' + conversion) \
+                        + (':' + formatSpec if formatSpec else '') + '}'
+
+    def render(self, variables: Mapping[str, Any]) -> str:
+        if self.name not in variables:
+            # Keep the placeholder until some script provides the value.
+            return self.raw
+        try:
+            value, _ = _formatter.get_field(self.fieldName, (), variables)
+        except (KeyError, AttributeError, IndexError):
+            return self.raw
+        return format(_formatter.convert_field(value, self.conversion), self.formatSpec)
+
+
+class Template:
+    """
+    Format string compiled once into literal text and replacement fields.
+    Rendering never changes the template itself, so it can be rendered again with new values.
+    """
+    __slots__ = ('_source', '_parts', '_variables', '_static')
+
+    @staticmethod
+    @lru_cache(maxsize=_CacheSize)
+    def compile(source: str) -> Template:
+        """
+        Compile format string into Template. Recently used format strings share one Template object.
+
+        Args:
+            source (str) : Format string using str.format syntax.
+
+        Returns:
+            Template object.
+        """
+        return Template(source)
+
+    def __init__(self, source: str) -> None:
+        self._source: str = source
+        parts: List[Tuple[str, Optional[TemplateField]]] = []
+        for literal, fieldName, formatSpec, conversion in _formatter.parse(source):
+            parts.append((literal, None if fieldName is None else TemplateField(fieldName, conversion, formatSpec)))
+        self._parts: Tuple[Tuple[str, Optional[TemplateField]], ...] = tuple(parts)
+        self._variables: FrozenSet[str] = frozenset(field.name for _, field in parts if field is not None)
+        # Templates without fields always render the same text.
+        self._static: Optional[str] = ''.join(literal for literal, _ in parts) if not self._variables else None
+
+    @property
+    def source(self) -> str:
+        return self._source
+
+    @property
+    def variables(self) -> FrozenSet[str]:
+        """Names of variables used in this template."""
+        return self._variables
+
+    def render(self, variables: Mapping[str, Any]) -> str:
+        if self._static is not None:
+            return self._static
+        return ''.join(
+            literal if field is None else literal + field.render(variables)
+            for literal, field in self._parts
+        )
+
+    def __str__(self) -> str:
+        return self._source
+
+    def __repr__(self) -> str:
+        return f'Template({self._source!r})'
+
+
+class RenderPlan:
+    """
+    Set of named templates rendered with shared variables.
+    Each template is rendered again only when one of variables it uses is changed.
+    """
+
+    def __init__(self, templates: Optional[Dict[str, Optional[str]]] = None) -> None:
+        self._templates: Dict[str, Template] = {}
+        self._dependents: Dict[str, Set[str]] = {}      # variable name : keys of templates using it
+        self._variables: Dict[str, Any] = {}
+        self._rendered: Dict[str, str] = {}
+        self._dirty: Set[str] = set()
+        if templates is not None:
+            for key, source in templates.items():
+                self.setTemplate(key, source)
+
+    @property
+    def variables(self) -> Mapping[str, Any]:
+        return MappingProxyType(self._variables)
+
+    @property
+    def dependencies(self) -> FrozenSet[str]:
+        """Names of variables used by any template in this plan."""
+        return frozenset(self._dependents)
+
+    def getTemplate(self, key: str) -> Optional[Template]:
+        return self._templates.get(key)
+
+    def setTemplate(self, key: str, source: Optional[str]) -> None:
+        """
+        Set (or remove, if source is None) template of key.
+
+        Args:
+            key (str) : Name of the template.
+            source (Optional[str]) : Format string of the template.
+        """
+        old = self._templates.pop(key, None)
+        if old is not None:
+            for name in old.variables:
+                keys = self._dependents[name]
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[name]
+        self._rendered.pop(key, None)
+        self._dirty.discard(key)
+        if source is None:
+            return
+        template = Template.compile(source)
+        self._templates[key] = template
+        for name in template.variables:
+            self._dependents.setdefault(name, set()).add(key)
+        self._dirty.add(key)
+
+    def update(self, variables: Mapping[str, Any]) -> Set[str]:
+        """
+        Update variables used to render templates.
+
+        Args:
+            variables (Mapping[str, Any]) : Name and new value of variables.
+
+        Returns:
+            Keys of templates which should be rendered again.
+        """
+        changed: Set[str] = set()
+        for name, value in variables.items():
+            if name in self._variables and self._variables[name] == value:
+                continue
+            self._variables[name] = value
+            changed.update(self._dependents.get(name, ()))
+        self._dirty |= changed
+        return changed
+
+    def check(self, variables: Mapping[str, Any]) -> None:
+        """
+        Render templates using any of variables with their new values, without keeping the result.
+        Raises errors of formatting (like ValueError of a format spec not matching the value), so values can be
+        rejected before they are set.
+        """
+        merged = {**self._variables, **variables}
+        keys = set()
+        for name in variables:
+            keys.update(self._dependents.get(name, ()))
+        for key in keys:
+            self._templates[key].render(merged)
+
+    def render(self) -> Dict[str, str]:
+        """
+        Render templates changed since the last render.
+
+        Returns:
+            Rendered text of every template. This dict is owned by RenderPlan, and must not be modified.
+        Templates failing to render with current values keep their last rendered text (or the template itself),
+        until one of their variables is changed.
+        """
+        # Variables may be updated by scripts running on worker threads while rendering.
+        dirty, self._dirty = self._dirty, set()
+        for key in dirty:
+            template = self._templates[key]
+            try:
+                self._rendered[key] = template.render(self._variables)
+            except Exception as e:
+                logger.warning(f'Failed to render {key} template {template.source!r} : {e!r}')
+                self._rendered.setdefault(key, template.source)
+        return self._rendered
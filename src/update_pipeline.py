@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import json
+from time import monotonic
+from typing import Callable, Optional
+
+from src.constants import RateLimits
+from src.type_hints import JSON
+
+
+class TokenBucket:
+    """Token bucket rate limiter. `capacity` tokens are refilled evenly over `period` seconds."""
+
+    def __init__(
+            self,
+            capacity: int = RateLimits.ActivityUpdates,
+            period: float = RateLimits.ActivityPeriod,
+            clock: Callable[[], float] = monotonic
+    ) -> None:
+        self._capacity: int = capacity
+        self._rate: float = capacity / period
+        self._clock: Callable[[], float] = clock
+        self._tokens: float = capacity
+        self._updatedAt: float = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updatedAt) * self._rate)
+        self._updatedAt = now
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def tryAcquire(self) -> bool:
+        """
+        Take one token from the bucket if available.
+
+        Returns:
+            True if token is taken, otherwise False.
+        """
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def timeUntilAvailable(self) -> float:
+        """
+        Seconds to wait until next token is available.
+
+        Returns:
+            0 if token is available right now.
+        """
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+
+class UpdateStats:
+    def __init__(self) -> None:
+        self.sent: int = 0          # payloads delivered to discord
+        self.queued: int = 0        # payloads kept by the connection while disconnected. The latest one is sent later.
+        self.suppressed: int = 0    # payloads dropped because they are same as the last sent one
+        self.coalesced: int = 0     # pending payloads replaced by newer one before being sent
+
+    def toJson(self) -> JSON:
+        return {
+            'sent': self.sent,
+            'queued': self.queued,
+            'suppressed': self.suppressed,
+            'coalesced': self.coalesced
+        }
+
+    def __repr__(self) -> str:
+        return (
+            f'UpdateStats(sent={self.sent}, queued={self.queued}, suppressed={self.suppressed}, '
+            f'coalesced={self.coalesced})'
+        )
+
+
+class UpdatePipeline:
+    """
+    Filters presence payloads between DiscordRPC and discord.
+    Payloads same as the last sent one are dropped, and payloads over the rate limit are kept as pending,
+    and replaced by newer payloads until the bucket has token again. So only the latest state is sent.
+    """
+
+    def __init__(self, bucket: Optional[TokenBucket] = None) -> None:
+        self._bucket: TokenBucket = TokenBucket() if bucket is None else bucket
+        self._lastKey: Optional[str] = None
+        self._lastPayload: Optional[JSON] = None     # Profile.toJson() returns the same object while unchanged.
+        self._pending: Optional[JSON] = None
+        self._pendingKey: Optional[str] = None
+        self._stats: UpdateStats = UpdateStats()
+
+    @staticmethod
+    def _key(payload: JSON) -> str:
+        return json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+
+    @property
+    def stats(self) -> UpdateStats:
+        return self._stats
+
+    @property
+    def pending(self) -> bool:
+        return self._pending is not None
+
+    @property
+    def retryAfter(self) -> Optional[float]:
+        """Seconds until pending payload can be sent. None if there is no pending payload."""
+        if self._pending is None:
+            return None
+        return self._bucket.timeUntilAvailable()
+
+    def submit(self, payload: JSON) -> Optional[JSON]:
+        """
+        Submit new presence payload.
+
+        Args:
+            payload (Dict[str, Any]) : Payload to send to discord.
+
+        Returns:
+            Payload to send right now, or None if there is nothing to send for now.
+        """
+        if payload is self._lastPayload and self._pending is None:
+            self._stats.suppressed += 1
+            return None
+        key = self._key(payload)
+        if self._pending is not None:
+            self._stats.coalesced += 1
+            self._pending = self._pendingKey = None
+        if key == self._lastKey:
+            self._stats.suppressed += 1
+            return None
+        self._pending, self._pendingKey = payload, key
+        return self.flush()
+
+    def flush(self) -> Optional[JSON]:
+        """
+        Take pending payload if rate limit allows it.
+
+        Returns:
+            Payload to send right now, or None if there is nothing to send for now.
+        """
+        if self._pending is None or not self._bucket.tryAcquire():
+            return None
+        payload = self._lastPayload = self._pending
+        self._lastKey = self._pendingKey
+        self._pending = self._pendingKey = None
+        return payload
+
+    def delivered(self) -> None:
+        """Count payload taken from submit() or flush() (or kept by the connection) as delivered to discord."""
+        self._stats.sent += 1
+
+    def queued(self) -> None:
+        """Count payload taken from submit() or flush() as kept by the connection until it is connected."""
+        self._stats.queued += 1
+
+    def invalidate(self) -> None:
+        """Forget the last sent payload, so the next payload is sent even if it is not changed. Used when sending failed."""
+        self._lastKey = self._lastPayload = None